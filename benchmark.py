@@ -0,0 +1,981 @@
+"""Micro-benchmarks for the display drivers.
+
+They run without the display hardware attached and compare the current code
+paths against the original pure Python implementations, which are kept here as
+reference. Every benchmark checks that both produce identical output.
+
+    pipenv run python ./benchmark.py pack-it8951
+"""
+import collections
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import click
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+import drivers.driver_it8951 as driver_it8951
+import drivers.drivers_base as drivers_base
+import drivers.drivers_color as drivers_color
+import drivers.drivers_colordraw as drivers_colordraw
+import drivers.drivers_full as drivers_full
+import drivers.drivers_partial as drivers_partial
+from drivers import packing, profiler, simulated
+from drivers.driver_it8951 import IT8951
+from infra.display_worker import DisplayWorker
+from infra.driver_manager import DRIVERS, get_driver_manager
+from infra.refresh_ledger import RefreshLedger
+from infra.update_planner import UpdatePlanner
+from widget.line import LineWidget
+from widget.panel import PanelWidget
+from widget.text import TextWidget
+
+
+def test_image(width, height, mode="L", seed=0):
+    """Noise image with the given size - the worst case for any packing code."""
+    rnd = random.Random(seed)
+    image = Image.frombytes("L", (width, height), rnd.randbytes(width * height))
+    return image.convert(mode)
+
+
+def measure(func, repeat):
+    """Best wall clock time of a function call in seconds."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def report(name, legacy, current):
+    logging.info("%-28s legacy %9.1f ms   current %9.1f ms   speedup %6.1fx",
+                 name, legacy * 1000, current * 1000, legacy / current)
+
+
+class FakeGPIO:
+    """Stand-in for RPi.GPIO with every input reading high (not busy)"""
+    HIGH = 1
+    LOW = 0
+    RISING = 31
+    FALLING = 32
+
+    @staticmethod
+    def output(pin, value):
+        pass
+
+    @staticmethod
+    def input(pin):
+        return 1
+
+
+class FakeSpiDev:
+    """Stand-in for spidev.SpiDev that only counts the written bytes.
+
+    Both write methods copy the data once, like the ioctl in spidev does."""
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def writebytes(self, data):
+        # spidev converts the list item by item into its transfer buffer
+        self.bytes_written += len(bytes(data))
+
+    def writebytes2(self, data):
+        self.bytes_written += len(bytes(data))
+
+    @staticmethod
+    def readbytes(n):
+        return [0] * n
+
+
+def fake_it8951():
+    driver_it8951.GPIO = FakeGPIO
+    driver = IT8951()
+    driver.SPI = FakeSpiDev()
+    return driver
+
+
+def legacy_it8951_pack_image(image):
+    """The original IT8951.pack_image."""
+    image_grey = image.convert("L")
+    pixels = image_grey.load()
+    frame_buffer = [
+        pixels[x, y]
+        for y in range(image.height)
+        for x in range(image.width)
+    ]
+    packed_buffer = []
+    for i in range(0, len(frame_buffer), 2):
+        value = (frame_buffer[i] >> 4) & 0x0F
+        if i + 1 < len(frame_buffer):
+            value |= frame_buffer[i + 1] & 0xF0
+        packed_buffer += [value]
+    for i in range(0, len(packed_buffer), 2):
+        packed_buffer[i], packed_buffer[i + 1] = (
+                packed_buffer[i + 1], packed_buffer[i])
+    return packed_buffer
+
+
+@click.command(name='pack-it8951')
+@click.option('--repeat', default=3, show_default=True, help='Number of timed runs')
+def pack_it8951(repeat):
+    """IT8951 packing for the supported panel sizes"""
+    driver = IT8951()
+    for width, height in [(800, 600), (1200, 825), (1872, 1404)]:
+        image = test_image(width, height)
+        assert bytes(driver.pack_image(image)) == bytes(legacy_it8951_pack_image(image))
+        legacy = measure(lambda: legacy_it8951_pack_image(image), repeat)
+        current = measure(lambda: driver.pack_image(image), repeat)
+        report("pack_image {}x{}".format(width, height), legacy, current)
+        black_white = test_image(width, height, mode="1")
+        for bpp in (1, 2, 4):
+            current = measure(lambda: driver.pack_image(black_white, bpp), repeat)
+            logging.info("%-28s %9.1f ms %9d bytes", "pack_image {}x{} {}bpp".format(width, height, bpp),
+                         current * 1000, len(driver.pack_image(black_white, bpp)))
+
+
+def legacy_it8951_write_data_bytes(driver, data):
+    """The original IT8951.write_data_bytes."""
+    max_transfer_size = 4096
+    driver.wait_for_ready()
+    driver_it8951.GPIO.output(driver.CS_PIN, driver_it8951.GPIO.LOW)
+    driver.SPI.writebytes([0x00, 0x00])
+    driver.wait_for_ready()
+    for i in range(0, len(data), max_transfer_size):
+        driver.SPI.writebytes(data[i: i + max_transfer_size])
+    driver_it8951.GPIO.output(driver.CS_PIN, driver_it8951.GPIO.HIGH)
+
+
+@click.command(name='spi-it8951')
+@click.option('--repeat', default=3, show_default=True, help='Number of timed runs')
+@click.option('--chunk-size', default=4096, show_default=True, help='SPI chunk size of the current code')
+def spi_it8951(repeat, chunk_size):
+    """IT8951 bulk data transfer to a fake SPI device"""
+    driver = fake_it8951()
+    driver.spi_chunk_size = chunk_size
+    for width, height in [(800, 600), (1872, 1404)]:
+        image = test_image(width, height)
+        packed_list = legacy_it8951_pack_image(image)
+        packed = driver.pack_image(image)
+        megabytes = len(packed) / 1e6
+        legacy = measure(lambda: legacy_it8951_write_data_bytes(driver, packed_list), repeat)
+        current = measure(lambda: driver.write_data_bytes(packed), repeat)
+        report("write_data_bytes {}x{}".format(width, height), legacy, current)
+        logging.info("%-28s legacy %9.1f MB/s %6.1f ms/MB   current %9.1f MB/s %6.1f ms/MB",
+                     "", megabytes / legacy, legacy * 1000 / megabytes,
+                     megabytes / current, current * 1000 / megabytes)
+
+
+@click.command(name='transactions-it8951')
+@click.option('--frames', default=3, show_default=True, help='Number of frames to draw')
+def transactions_it8951(frames):
+    """IT8951 SPI transactions per frame of four quadrant updates"""
+    for cache in (False, True):
+        driver = fake_it8951()
+        driver.width, driver.height, driver.img_addr = 800, 600, 0x1000
+        driver.register_cache = driver.coalesce_data = cache
+        quadrants = [(x, y, test_image(400, 300, seed=x + y), None) for x in (0, 400) for y in (0, 300)]
+        for frame in range(frames):
+            before = dict(driver.spi_stats)
+            driver.draw_regions(quadrants)
+            logging.info("%-28s frame %d: %5d transactions %5d commands %5d register writes, %5d skipped",
+                         "register cache " + ("on" if cache else "off"), frame,
+                         *(driver.spi_stats[key] - before[key] for key in
+                           ("transactions", "commands", "register_writes", "register_writes_skipped")))
+
+
+def legacy_waveshare_get_frame_buffer(driver, image, reverse=False):
+    """The original WavesharePartial.get_frame_buffer (reverse=False) and
+    WaveshareFull.get_frame_buffer."""
+    buf = [0xFF if reverse else 0x00] * int(driver.width * driver.height / 8)
+    image_monocolor = image.convert('1')
+    pixels = image_monocolor.load()
+    for y in range(driver.height):
+        for x in range(driver.width):
+            if reverse:
+                if pixels[x, y] == 0:
+                    buf[int((x + y * driver.width) / 8)] &= ~(0x80 >> (x % 8))
+            else:
+                if pixels[x, y] != 0:
+                    buf[int((x + y * driver.width) / 8)] |= (0x80 >> (x % 8))
+    return buf
+
+
+def waveshare_mono_drivers():
+    return [drivers_partial.EPD1in54(), drivers_partial.EPD2in13(), drivers_partial.EPD2in9(),
+            drivers_partial.EPD2in13d(), drivers_full.EPD2in7(), drivers_full.EPD4in2(),
+            drivers_full.EPD7in5(), drivers_full.EPD7in5v2()]
+
+
+@click.command(name='frame-buffer')
+@click.option('--repeat', default=3, show_default=True, help='Number of timed runs')
+def frame_buffer(repeat):
+    """Waveshare monochrome frame buffers for every panel size"""
+    for driver in waveshare_mono_drivers():
+        image = test_image(driver.width, driver.height)
+        reverse_options = (False, True) if isinstance(driver, drivers_full.WaveshareFull) else (False,)
+        for reverse in reverse_options:
+            legacy_buffer = legacy_waveshare_get_frame_buffer(driver, image, reverse)
+            if reverse:
+                current_buffer = driver.get_frame_buffer(image, reverse=True)
+            else:
+                current_buffer = driver.get_frame_buffer(image)
+            assert bytes(current_buffer) == bytes(b & 0xFF for b in legacy_buffer)
+        legacy = measure(lambda: legacy_waveshare_get_frame_buffer(driver, image), repeat)
+        current = measure(lambda: driver.get_frame_buffer(image), repeat)
+        report("{} {}x{}".format(type(driver).__name__, driver.width, driver.height), legacy, current)
+
+
+def fake_waveshare(driver):
+    drivers_base.GPIO = FakeGPIO
+    driver.SPI = FakeSpiDev()
+    return driver
+
+
+def legacy_waveshare_send_buffer(driver, data):
+    """The original per byte loop of display_frame and friends."""
+    for i in range(0, len(data)):
+        driver.send_data(data[i])
+
+
+@click.command(name='send-waveshare')
+@click.option('--repeat', default=3, show_default=True, help='Number of timed runs')
+def send_waveshare(repeat):
+    """Waveshare full frame transfer to a fake SPI device"""
+    for driver in waveshare_mono_drivers():
+        fake_waveshare(driver)
+        frame = driver.get_frame_buffer(test_image(driver.width, driver.height))
+        driver.SPI.bytes_written = 0
+        legacy_waveshare_send_buffer(driver, frame)
+        legacy_bytes = driver.SPI.bytes_written
+        driver.SPI.bytes_written = 0
+        driver.send_data_bulk(frame)
+        assert driver.SPI.bytes_written == legacy_bytes == len(frame)
+        legacy = measure(lambda: legacy_waveshare_send_buffer(driver, frame), repeat)
+        current = measure(lambda: driver.send_data_bulk(frame), repeat)
+        report("{} {} bytes".format(type(driver).__name__, len(frame)), legacy, current)
+
+
+def legacy_epd7in5_expand(frame_buffer):
+    """The bit expansion loop of the original EPD7in5.display_frame."""
+    data = []
+    for i in range(0, 30720):
+        temp1 = frame_buffer[i]
+        j = 0
+        while j < 8:
+            if temp1 & 0x80:
+                temp2 = 0x03
+            else:
+                temp2 = 0x00
+            temp2 = (temp2 << 4) & 0xFF
+            temp1 = (temp1 << 1) & 0xFF
+            j += 1
+            if temp1 & 0x80:
+                temp2 |= 0x03
+            else:
+                temp2 |= 0x00
+            temp1 = (temp1 << 1) & 0xFF
+            data.append(temp2)
+            j += 1
+    return data
+
+
+def legacy_epd1in54b_expand(frame_buffer_black):
+    """The black plane loop of the original EPD1in54b.display_frame."""
+    data = []
+    for i in range(0, len(frame_buffer_black)):
+        temp = 0x00
+        for bit in range(0, 4):
+            if frame_buffer_black[i] & (0x80 >> bit) != 0:
+                temp |= 0xC0 >> (bit * 2)
+        data.append(temp)
+        temp = 0x00
+        for bit in range(4, 8):
+            if frame_buffer_black[i] & (0x80 >> bit) != 0:
+                temp |= 0xC0 >> ((bit - 4) * 2)
+        data.append(temp)
+    return data
+
+
+@click.command(name='expand-waveshare')
+@click.option('--repeat', default=3, show_default=True, help='Number of timed runs')
+def expand_waveshare(repeat):
+    """Waveshare 1 bit per pixel buffers expanded to the controller formats"""
+    epd7in5 = drivers_full.EPD7in5()
+    epd1in54b = drivers_colordraw.EPD1in54b()
+    cases = [
+        ("EPD7in5 1bpp -> 4bpp", epd7in5, legacy_epd7in5_expand, epd7in5.expand_frame_buffer),
+        ("EPD1in54b 1bpp -> 2bpp", epd1in54b, legacy_epd1in54b_expand,
+         lambda buffer: packing.expand(buffer, epd1in54b.BLACK_TABLES)),
+    ]
+    for name, driver, legacy_expand, current_expand in cases:
+        frame = random.Random(0).randbytes(driver.width * driver.height // 8)
+        assert bytes(current_expand(frame)) == bytes(legacy_expand(frame))
+        legacy = measure(lambda: legacy_expand(frame), repeat)
+        current = measure(lambda: current_expand(frame), repeat)
+        report(name, legacy, current)
+
+
+def legacy_epd7in5b_get_frame_buffer(driver, image):
+    """The original EPD7in5b.get_frame_buffer."""
+    buf = [0x00] * int(driver.width * driver.height / 4)
+    image_grayscale = image.convert('L')
+    pixels = image_grayscale.load()
+    for y in range(driver.height):
+        for x in range(driver.width):
+            if pixels[x, y] < 64:  # black
+                buf[int((x + y * driver.width) / 4)] &= ~(0xC0 >> (x % 4 * 2))
+            elif pixels[x, y] < 192:  # convert gray to red
+                buf[int((x + y * driver.width) / 4)] &= ~(0xC0 >> (x % 4 * 2))
+                buf[int((x + y * driver.width) / 4)] |= 0x40 >> (x % 4 * 2)
+            else:  # white
+                buf[int((x + y * driver.width) / 4)] |= 0xC0 >> (x % 4 * 2)
+    return buf
+
+
+def legacy_epd7in5b_expand(driver, frame_buffer):
+    """The 2bpp -> 4bpp loop of the original EPD7in5b.display_frame."""
+    data = []
+    for i in range(0, int(driver.width / 4 * driver.height)):
+        temp1 = frame_buffer[i]
+        j = 0
+        while j < 4:
+            if (temp1 & 0xC0) == 0xC0:
+                temp2 = 0x03
+            elif (temp1 & 0xC0) == 0x00:
+                temp2 = 0x00
+            else:
+                temp2 = 0x04
+            temp2 = (temp2 << 4) & 0xFF
+            temp1 = (temp1 << 2) & 0xFF
+            j += 1
+            if (temp1 & 0xC0) == 0xC0:
+                temp2 |= 0x03
+            elif (temp1 & 0xC0) == 0x00:
+                temp2 |= 0x00
+            else:
+                temp2 |= 0x04
+            temp1 = (temp1 << 2) & 0xFF
+            data.append(temp2)
+            j += 1
+    return data
+
+
+@click.command(name='tricolor-waveshare')
+@click.option('--repeat', default=3, show_default=True, help='Number of timed runs')
+def tricolor_waveshare(repeat):
+    """Black / red / white quantization and controller stream of EPD7in5b and EPD5in83"""
+    for driver in (drivers_color.EPD7in5b(), drivers_color.EPD5in83()):
+        image = test_image(driver.width, driver.height)
+        legacy_buffer = legacy_epd7in5b_get_frame_buffer(driver, image)
+        legacy_data = legacy_epd7in5b_expand(driver, legacy_buffer)
+        assert bytes(driver.get_frame_buffer(image)) == bytes(b & 0xFF for b in legacy_buffer)
+        assert bytes(driver.get_frame_data(image)) == bytes(legacy_data)
+        assert bytes(packing.expand(legacy_buffer, driver.FRAME_TABLES)) == bytes(legacy_data)
+        assert driver.get_frame_data(image.convert('P')) == driver.get_frame_data(image.convert('P').convert('L'))
+        # black and white gray on request
+        driver.gray_to_red = False
+        assert 0x1 not in driver.color_codes(image, 0x0, 0x1, 0x3)
+        driver.gray_to_red = True
+        legacy = measure(lambda: legacy_epd7in5b_expand(driver, legacy_epd7in5b_get_frame_buffer(driver, image)),
+                         repeat)
+        current = measure(lambda: driver.get_frame_data(image), repeat)
+        report("{} {}x{}".format(type(driver).__name__, driver.width, driver.height), legacy, current)
+
+
+def legacy_color_planes(driver, image):
+    """Black and red frame buffers the way the drivers built one plane: a per pixel pass
+    each, clearing the bits of black / red pixels and flipping them afterwards for the
+    drivers with set ink bits."""
+    pixels = image.convert('L').load()
+    planes = []
+    for is_ink in (lambda level: level < 64, lambda level: 64 <= level < 192):
+        buf = [0xFF] * int(driver.width * driver.height / 8)
+        for y in range(driver.height):
+            for x in range(driver.width):
+                if is_ink(pixels[x, y]):
+                    buf[int((x + y * driver.width) / 8)] &= ~(0x80 >> (x % 8))
+        if driver.INK_BIT:
+            buf = [~value & 0xFF for value in buf]
+        planes.append(buf)
+    return planes
+
+
+def legacy_epd5in83b_merge(driver, frame_buffer_black, frame_buffer_red):
+    """The loop of the original EPD5in83b.display_frame."""
+    data = []
+    for i in range(0, int(driver.width / 8 * driver.height)):
+        temp1 = frame_buffer_black[i]
+        temp2 = frame_buffer_red[i]
+        j = 0
+        while j < 8:
+            if (temp2 & 0x80) == 0x00:
+                temp3 = 0x04  # red
+            elif (temp1 & 0x80) == 0x00:
+                temp3 = 0x00  # black
+            else:
+                temp3 = 0x03  # white
+            temp3 = (temp3 << 4) & 0xFF
+            temp1 = (temp1 << 1) & 0xFF
+            temp2 = (temp2 << 1) & 0xFF
+            j += 1
+            if (temp2 & 0x80) == 0x00:
+                temp3 |= 0x04  # red
+            elif (temp1 & 0x80) == 0x00:
+                temp3 |= 0x00  # black
+            else:
+                temp3 |= 0x03  # white
+            temp1 = (temp1 << 1) & 0xFF
+            temp2 = (temp2 << 1) & 0xFF
+            data.append(temp3)
+            j += 1
+    return data
+
+
+@click.command(name='planes-waveshare')
+@click.option('--repeat', default=3, show_default=True, help='Number of timed runs')
+def planes_waveshare(repeat):
+    """Black and red frame buffers of the tri-color panels"""
+    for driver in (drivers_color.EPD4in2b(), drivers_color.EPD5in83b(), drivers_colordraw.EPD1in54b(),
+                   drivers_colordraw.EPD1in54c(), drivers_colordraw.EPD2in13b(), drivers_colordraw.EPD2in7b(),
+                   drivers_colordraw.EPD2in9b()):
+        image = test_image(driver.width, driver.height)
+        # gray is red or black and white, whatever the panel does by default
+        legacy_planes = legacy_color_planes(driver, image)
+        black_white = [packing.pack_1bpp(image, invert=bool(driver.INK_BIT)),
+                       bytes([0x00 if driver.INK_BIT else 0xFF]) * len(legacy_planes[1])]
+        expected = legacy_planes if driver.GRAY_TO_RED else black_white
+        assert [bytes(plane) for plane in driver.get_frame_buffers(image)] == [bytes(p) for p in expected]
+        driver.gray_to_red = not driver.GRAY_TO_RED
+        expected = black_white if driver.GRAY_TO_RED else legacy_planes
+        assert [bytes(plane) for plane in driver.get_frame_buffers(image)] == [bytes(p) for p in expected]
+        # time the three level mapping of the legacy code
+        driver.gray_to_red = True
+        legacy = measure(lambda: legacy_color_planes(driver, image), repeat)
+        current = measure(lambda: driver.get_frame_buffers(image), repeat)
+        report("{} {}x{}".format(type(driver).__name__, driver.width, driver.height), legacy, current)
+        if isinstance(driver, drivers_color.EPD5in83b):
+            black, red = driver.get_frame_buffers(image)
+            assert bytes(driver.merge_frame_buffers(black, red)) == bytes(legacy_epd5in83b_merge(driver, black, red))
+            assert driver.merge_frame_buffers(black, red) == driver.get_frame_data(image)
+            legacy = measure(lambda: legacy_epd5in83b_merge(driver, black, red), repeat)
+            current = measure(lambda: driver.merge_frame_buffers(black, red), repeat)
+            report("EPD5in83b merge planes", legacy, current)
+
+
+def reference_absolute(driver, x, y):
+    """(x, y) of the rotated panel -> (x, y) in the panel orientation, one rotation at a time"""
+    if driver.rotate == driver.ROTATE_90:
+        return driver.EPD_WIDTH - 1 - y, x
+    if driver.rotate == driver.ROTATE_180:
+        return driver.EPD_WIDTH - 1 - x, driver.EPD_HEIGHT - 1 - y
+    if driver.rotate == driver.ROTATE_270:
+        return y, driver.EPD_HEIGHT - 1 - x
+    return x, y
+
+
+def reference_set_pixel(driver, frame_buffer, x, y, colored):
+    if 0 <= x < driver.width and 0 <= y < driver.height:
+        driver.set_absolute_pixel(frame_buffer, *reference_absolute(driver, x, y), colored)
+
+
+def reference_fill_rectangle(driver, frame_buffer, x0, y0, x1, y1, colored):
+    for y in range(min(y0, y1), max(y0, y1) + 1):
+        for x in range(min(x0, x1), max(x0, x1) + 1):
+            reference_set_pixel(driver, frame_buffer, x, y, colored)
+
+
+def reference_draw_line(driver, frame_buffer, x0, y0, x1, y1, colored):
+    """Bresenham from (x0, y0) to (x1, y1), both included, a pixel at a time"""
+    dx, sx = abs(x1 - x0), 1 if x0 < x1 else -1
+    dy, sy = -abs(y1 - y0), 1 if y0 < y1 else -1
+    err = dx + dy
+    while True:
+        reference_set_pixel(driver, frame_buffer, x0, y0, colored)
+        if x0 == x1 and y0 == y1:
+            break
+        e2 = 2 * err
+        if e2 >= dy:
+            err += dy
+            x0 += sx
+        if e2 <= dx:
+            err += dx
+            y0 += sy
+
+
+def reference_display_string_at(driver, frame_buffer, x, y, text, font, colored):
+    """The text rendered into an image of the rotated panel, set a pixel at a time"""
+    image = Image.new('1', (driver.width, driver.height))
+    ImageDraw.Draw(image).text((x, y), text, font=font, fill=255)
+    pixels = image.load()
+    for py in range(driver.height):
+        for px in range(driver.width):
+            if pixels[px, py]:
+                reference_set_pixel(driver, frame_buffer, px, py, colored)
+
+
+def colordraw_scene(draw, font, width, height):
+    """Rectangles (a byte wide column, clipped ones too), lines in every direction and text"""
+    draw.fill(5, 3, width - 9, height // 3, True)
+    draw.fill(2, height // 2, 5, height - 1, True)
+    draw.fill(-10, -4, 12, 9, False)
+    draw.fill(width - 6, height - 6, width + 10, height + 10, True)
+    draw.fill(width // 2, height // 2 + 7, width // 2 - 20, height // 2 - 3, False)
+    for x0, y0, x1, y1 in ((0, 0, width - 1, height - 1), (width - 1, 3, 2, height - 2), (4, height - 5, 4, 6),
+                           (width - 3, height // 4, 1, height // 4), (7, 9, 30, 12), (30, 40, 27, 5)):
+        draw.line(x0, y0, x1, y1, True)
+    draw.line(3, 3, width // 2, height // 3, False)
+    draw.text(8, height // 2, "12:34", font, True)
+    draw.text(width // 3, 10, "-5.2", font, False)
+
+
+@click.command(name='colordraw')
+@click.option('--repeat', default=3, show_default=True, help='Number of timed runs')
+def colordraw(repeat):
+    """The drawing primitives of the tri-color panels on byte arrays against setting one
+    pixel at a time, in all four rotations"""
+    font_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "resources", "RobotoCondensed-Regular.ttf")
+    font = ImageFont.truetype(font_file, size=24)
+    for driver in (drivers_colordraw.EPD1in54b(), drivers_colordraw.EPD2in13b(), drivers_colordraw.EPD2in7b()):
+        for rotate in (driver.ROTATE_0, driver.ROTATE_90, driver.ROTATE_180, driver.ROTATE_270):
+            driver.set_rotate(rotate)
+            current = collections.namedtuple('Draw', 'fill line text')(
+                lambda *args: driver.fill_rectangle(frame_buffer, *args),
+                lambda *args: driver.draw_line(frame_buffer, *args),
+                lambda *args: driver.display_string_at(frame_buffer, *args))
+            reference = collections.namedtuple('Draw', 'fill line text')(
+                lambda *args: reference_fill_rectangle(driver, frame_buffer, *args),
+                lambda *args: reference_draw_line(driver, frame_buffer, *args),
+                lambda *args: reference_display_string_at(driver, frame_buffer, *args))
+            buffers = []
+            for draw in (reference, current):
+                frame_buffer = driver.new_frame_buffer()
+                colordraw_scene(draw, font, driver.width, driver.height)
+                buffers.append(bytes(frame_buffer))
+            assert buffers[0] == buffers[1], (type(driver).__name__, rotate)
+            frame_buffer = driver.new_frame_buffer()
+            legacy = measure(lambda: colordraw_scene(reference, font, driver.width, driver.height), repeat)
+            now = measure(lambda: colordraw_scene(current, font, driver.width, driver.height), repeat)
+            report("{} rotate {}".format(type(driver).__name__, rotate * 90), legacy, now)
+
+
+@click.command(name='partial-waveshare')
+@click.option('--repeat', default=3, show_default=True, help='Number of timed runs')
+def partial_waveshare(repeat):
+    """EPD2in13d partial refresh of the whole screen and of a clock digit sized window, drawn
+    the way the app does it: init with partial updates on, then draw"""
+    driver = drivers_partial.EPD2in13d()
+    hardware = simulated.simulate(driver)
+    driver.init(partial=True)
+    assert driver.partial_refresh
+    image = test_image(driver.width, driver.height)
+    for name, window in (("full screen", (0, 0, driver.width, driver.height)), ("clock digit 20x32", (43, 90, 63, 122))):
+        region = image.crop(window)
+        written = hardware.stats["bytes"]
+        driver.draw(window[0], window[1], region)
+        written = hardware.stats["bytes"] - written
+        current = measure(lambda: driver.draw(window[0], window[1], region), repeat)
+        logging.info("%-28s %9.2f ms %9d bytes written", "draw " + name, current * 1000, written)
+
+
+@click.command(name='delta-upload')
+def delta_upload():
+    """Image bytes sent for a frame, the same frame again and a frame with a clock digit changed"""
+    waveshare = drivers_partial.EPD2in9()
+    simulated.simulate(waveshare)
+    waveshare.init(partial=True)
+    it8951 = fake_it8951()
+    it8951.width, it8951.height, it8951.img_addr = 800, 600, 0x1000
+    it8951.frame = Image.new("L", (800, 600), 0xFF)
+    for driver, width, height in ((waveshare, waveshare.width, waveshare.height), (it8951, 800, 600)):
+        image = test_image(width, height, mode="1").convert("L")
+        changed = image.copy()
+        changed.paste(0, (40, 100, 60, 132))
+        for name, frame in (("first frame", image), ("same frame", image), ("clock digit", changed)):
+            if driver is waveshare:
+                # both RAM banks get every frame, two frames are needed to fill their shadows
+                for bank in range(2):
+                    driver.set_frame_memory(frame, 0, 0)
+                    driver.display_frame()
+            else:
+                it8951.draw_regions([(0, 0, frame, None)])
+            stats = driver.delta_stats
+            logging.info("%-28s %-12s %9d bytes sent %9d saved", type(driver).__name__, name,
+                         stats["last_bytes"], stats["last_bytes_saved"])
+
+
+@click.command(name='bitmap-formats')
+@click.option('--frames', default=10, show_default=True, help='Number of frames to draw')
+def bitmap_formats(frames):
+    """Bitmap driver: time spent in draw and until the frames are written, per file format"""
+    image = test_image(drivers_base.Bitmap.default_width, drivers_base.Bitmap.default_height)
+    with tempfile.TemporaryDirectory() as directory:
+        for file_format, compress_level in (("png", 6), ("png", 1), ("png", 0), ("pgm", 0)):
+            driver = drivers_base.Bitmap(file_format=file_format, compress_level=compress_level,
+                                         log_file=os.path.join(directory, "frames.jsonl"),
+                                         directory=directory)
+            driver.init()
+            start = time.monotonic()
+            for frame in range(frames):
+                driver.draw(0, 0, image)
+            drawn = time.monotonic() - start
+            driver.flush()
+            written = time.monotonic() - start
+            logging.info("%-28s %9.2f ms draw %9.2f ms written per frame",
+                         "{} compress_level {}".format(file_format, compress_level),
+                         drawn / frames * 1000, written / frames * 1000)
+
+
+@click.command(name='simulate-drivers')
+def simulate_drivers():
+    """Every hardware driver on simulated hardware: init, a full frame and a second draw.
+    Reports the SPI traffic, the modelled display time and a digest of the command stream"""
+    manager = get_driver_manager()
+    for name in sorted(manager.get_drivers()):
+        driver = manager.get_driver_class(name)()
+        if isinstance(driver, drivers_base.SpecialDriver):
+            continue
+        hardware = simulated.simulate(driver)
+        start = time.monotonic()
+        driver.init(partial=True)
+        image = test_image(driver.width, driver.height, mode="1")
+        driver.draw(0, 0, image)
+        if driver.supports_partial:
+            driver.draw(32, 32, image.crop((0, 0, 64, 64)))
+        else:
+            driver.draw(0, 0, image.transpose(Image.FLIP_LEFT_RIGHT))
+        driver.flush()
+        stats = hardware.stats
+        logging.info("%-12s %9d bytes %6d commands %3d busy %8.2f s modelled %8.2f ms real  %s",
+                     name, stats["bytes"], stats["commands"], stats["busy_periods"], hardware.clock,
+                     (time.monotonic() - start) * 1000, hardware.stream_digest()[:16])
+
+
+@click.command(name='profile-drivers')
+def profile_drivers():
+    """Where the time of every hardware driver goes on simulated hardware, for init and two draws"""
+    manager = get_driver_manager()
+    for name in sorted(manager.get_drivers()):
+        driver = manager.get_driver_class(name)()
+        if isinstance(driver, drivers_base.SpecialDriver):
+            continue
+        simulated.simulate(driver)
+        driver_profiler = profiler.DriverProfiler(driver).attach()
+        driver.init(partial=True)
+        image = test_image(driver.width, driver.height, mode="1")
+        driver.draw(0, 0, image)
+        driver.draw(0, 0, image.transpose(Image.FLIP_LEFT_RIGHT))
+        driver.flush()
+        logging.info("%-12s %s", name, driver_profiler.format(driver_profiler.summary()))
+
+
+# what importing infra.driver_manager and picking a driver cost before the registry: all the driver modules
+LEGACY_STARTUP = ("import drivers.drivers_base, drivers.drivers_partial, drivers.drivers_full, drivers.drivers_color, "
+                  "drivers.drivers_colordraw, drivers.driver_it8951 as m; m.IT8951")
+# what the CLI does before a command runs: check the driver name
+STARTUP_LOOKUP = "from infra.driver_manager import get_driver_manager; get_driver_manager().get_driver_by_name('IT8951')"
+# and what creating the driver imports
+STARTUP_DRIVER = "from infra.driver_manager import get_driver_manager; get_driver_manager().get_driver_class('IT8951')"
+
+
+def cold_start(args, repeat):
+    """Best wall clock time of a new Python process running args, in seconds"""
+    times = []
+    for run in range(repeat):
+        start = time.monotonic()
+        result = subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append(time.monotonic() - start)
+        if result.returncode != 0:
+            logging.warning("%s failed: %s", " ".join(args), result.stderr.decode(errors="replace").strip()[-200:])
+            return None
+    return min(times)
+
+
+@click.command(name='startup')
+@click.option('--repeat', default=5, show_default=True, help='Number of timed runs')
+def startup(repeat):
+    """Cold start of the driver registry and of weather_main.py --driver=IT8951 demo"""
+    for name, (module, desc) in DRIVERS.items():
+        driver_class = get_driver_manager().get_driver_class(name)
+        assert driver_class.__module__ == module and driver_class.__doc__.strip().splitlines()[0] == desc, name
+    legacy = cold_start(["-c", LEGACY_STARTUP], repeat)
+    report("driver name lookup", legacy, cold_start(["-c", STARTUP_LOOKUP], repeat))
+    report("driver class lookup", legacy, cold_start(["-c", STARTUP_DRIVER], repeat))
+    demo = cold_start(["weather_main.py", "--driver=IT8951", "demo"], repeat)
+    if demo is not None:
+        logging.info("%-28s %9.2f ms", "weather_main.py demo", demo * 1000)
+
+
+def legacy_band(box):
+    """The original Desktop.band."""
+    return (int(box[0] / 8) * 8, box[1], int((box[2] + 7) / 8) * 8, box[3])
+
+
+def legacy_plan(image, previous, boxes):
+    """The region planning of the original main loop: byte aligned changes, one region per box."""
+    regions = []
+    for box in boxes:
+        banded = legacy_band(box)
+        diff = ImageChops.difference(image.crop(banded), previous.crop(banded)).getbbox()
+        if diff:
+            diff = legacy_band(diff)
+            regions.append((banded[0] + diff[0], banded[1] + diff[1], image.crop(banded).crop(diff), None))
+    return regions
+
+
+def planned_cost(capabilities, regions):
+    """Estimated seconds of drawing the regions, at the smallest bit depth each one allows.
+    Without partial updates every region is a frame of its own"""
+    if not capabilities.partial and len(regions) > 1:
+        return sum(planned_cost(capabilities, [region]) for region in regions)
+    cost = capabilities.frame_cost if regions else 0.0
+    for x, y, image, mode in regions:
+        box = (x, y, x + image.width, y + image.height)
+        black_white = UpdatePlanner.black_white(image)
+        cost += min(capabilities.cost(box, bpp) for bpp, alignment in capabilities.alignment.items()
+                    if x % alignment == 0 and image.width % alignment == 0
+                    and (black_white or bpp >= capabilities.gray_bpp))
+    return cost
+
+
+@click.command(name='plan-updates')
+def plan_updates():
+    """Regions, estimated and modelled draw time of four changed widgets, the original
+    planning against the capability based planner, on simulated hardware initialized the way
+    the app does it. The original sent the cropped changes to full refresh displays too,
+    which need the whole frame - that is counted as a full frame"""
+    for driver, partial in ((drivers_partial.EPD2in9(), True), (drivers_partial.EPD2in13d(), True),
+                            (drivers_partial.EPD2in13d(), False), (drivers_full.EPD4in2(), True), (IT8951(), True)):
+        hardware = simulated.simulate(driver)
+        driver.init(partial=partial)
+        capabilities = driver.capabilities()
+        width, height = driver.width, driver.height
+        previous = Image.new("L", (width, height), 255)
+        image = previous.copy()
+        boxes = [(int(width * left), int(height * top), int(width * right), int(height * bottom))
+                 for left, top, right, bottom in ((0.05, 0.05, 0.45, 0.25), (0.55, 0.05, 0.95, 0.25),
+                                                  (0.05, 0.55, 0.45, 0.75), (0.2, 0.8, 0.6, 0.95))]
+        for left, top, right, bottom in boxes:
+            image.paste(0, (left + 3, top + 2, left + 3 + (right - left) // 3, bottom - 2))
+        planner = UpdatePlanner(capabilities, width, height)
+        legacy = legacy_plan(image, previous, boxes)
+        planned = planner.plan(image, previous, boxes)
+        if isinstance(driver, drivers_full.WaveshareFull):
+            legacy = [(0, 0, image, None)]
+        modelled = []
+        for regions in (legacy, planned):
+            driver.draw_regions([(0, 0, previous, None)])
+            driver.flush()
+            start = hardware.clock
+            driver.draw_regions(regions)
+            driver.flush()
+            modelled.append(hardware.clock - start)
+        name = "{}{}".format(type(driver).__name__, "" if partial else " full")
+        logging.info("%-15s legacy %d regions %7.3f s (%7.3f s modelled)   planned %d regions %7.3f s (%7.3f s modelled)",
+                     name, len(legacy), planned_cost(capabilities, legacy), modelled[0],
+                     len(planned), planned_cost(capabilities, planned), modelled[1])
+        assert modelled[1] <= modelled[0] * 1.05
+
+
+@click.command(name='ghosting-budget')
+@click.option('--frames', default=60, show_default=True, help='Number of frames to draw')
+def ghosting_budget(frames):
+    """Clean (flashing) refreshes of an IT8951 and a Waveshare partial refresh screen with a
+    clock that changes every frame and a widget that changes every tenth: a full refresh every
+    fifth frame against the per tile budget of the refresh ledger of the display family. The
+    frames are drawn on simulated hardware, the clean refreshes of the Waveshare screen have to
+    take as long as its full LUT"""
+    for driver in (IT8951(), drivers_partial.EPD2in9()):
+        hardware = simulated.simulate(driver)
+        driver.init(partial=True)
+        width, height = driver.width, driver.height
+        capabilities = driver.capabilities()
+        planner = UpdatePlanner(capabilities, width, height)
+        ledger = RefreshLedger(width, height, driver.GHOSTING_UPDATES, driver.GHOSTING_CHANGED)
+        clock = (width * 4 // 100, height * 5 // 100, width * 36 // 100, height * 21 // 100)
+        widget = (width * 52 // 100, height * 53 // 100, width * 92 // 100, height * 91 // 100)
+        previous = Image.new("L", (width, height), 255)
+        driver.draw_regions(planner.full(previous))
+        ledger.cleaned((0, 0, width, height))
+        legacy_area = ledger_area = cleans = 0
+        times = {"partial": [], "clean": []}
+        for frame in range(1, frames + 1):
+            image = previous.copy()
+            # the minute digit of the clock
+            image.paste(0 if frame % 2 else 255, (clock[2] - (clock[2] - clock[0]) // 4, clock[1] + 8,
+                                                  clock[2] - 8, clock[3] - 8))
+            if frame % 10 == 0:
+                image.paste(0 if frame % 20 else 255, (widget[0] + 8, widget[1] + 8, widget[2] - 8, widget[3] - 8))
+            if frame % 5 == 0:
+                legacy_area += width * height
+            regions = planner.plan(image, previous, [clock, widget])
+            ledger.record(image, previous, regions)
+            worn = ledger.worn()
+            clean = planner.clean(image, worn) if worn else []
+            if clean:
+                cleans += 1
+                assert all(mode == capabilities.full_mode for _, _, _, mode in clean)
+                regions = [region for region in regions if not planner.covered(region, clean)] + clean
+                for x, y, clean_image, _ in clean:
+                    ledger.cleaned((x, y, x + clean_image.width, y + clean_image.height))
+                    ledger_area += clean_image.width * clean_image.height
+            if regions:
+                start = hardware.clock
+                driver.draw_regions(regions)
+                driver.flush()
+                times["clean" if clean else "partial"].append(hardware.clock - start)
+            previous = image
+        assert cleans and not ledger.worn()
+        if isinstance(driver, drivers_partial.WavesharePartial):
+            assert min(times["clean"]) >= simulated.FULL_LUT_LATENCY > max(times["partial"])
+        logging.info("%-12s every fifth frame: %d refreshes, %d kpx flashed   ledger (%d updates, %.1fx changed): "
+                     "%d refreshes, %d kpx flashed   modelled %.2f s partial, %.2f s clean",
+                     type(driver).__name__, frames // 5, legacy_area // 1000, driver.GHOSTING_UPDATES,
+                     driver.GHOSTING_CHANGED, cleans, ledger_area // 1000, sum(times["partial"]),
+                     sum(times["clean"]))
+
+
+class SlowDisplay(drivers_base.Dummy):
+    """Keeps what it is shown, every draw_regions takes refresh seconds like a panel refresh"""
+
+    def __init__(self, refresh):
+        super().__init__()
+        self.refresh = refresh
+        self.frame_buffer = Image.new("L", (self.width, self.height), 255)
+        self.refreshes = 0
+
+    def draw_regions(self, regions):
+        for x, y, image, mode in regions:
+            self.frame_buffer.paste(image, (x, y))
+        time.sleep(self.refresh)
+        self.refreshes += 1
+        return [self.refresh / len(regions)] * len(regions)
+
+
+@click.command(name='display-worker')
+@click.option('--frames', default=20, show_default=True, help='Number of frames to draw')
+@click.option('--render', default=0.02, show_default=True, help='Seconds to load and render a frame')
+@click.option('--refresh', default=0.05, show_default=True, help='Seconds of a panel refresh')
+def display_worker(frames, render, refresh):
+    """Load, render and draw frames one after another against drawing them on the display
+    worker while the next one renders. Frames that come faster than the panel refreshes are
+    superseded, the panel still ends up showing the last one"""
+    width, height = drivers_base.SpecialDriver.default_width, drivers_base.SpecialDriver.default_height
+    rendered = []
+    for frame in range(frames):
+        image = Image.new("L", (width, height), 255)
+        image.paste(0, (16 * frame, 32, 16 * frame + 12, 64))
+        rendered.append((image, [(0, 32, width, 64)]))
+    results = {}
+    for name in ("serial", "worker"):
+        driver = SlowDisplay(refresh)
+        planner = UpdatePlanner(driver.capabilities(), width, height)
+        ledger = RefreshLedger(width, height, driver.GHOSTING_UPDATES, driver.GHOSTING_CHANGED)
+        worker = DisplayWorker(driver, planner, ledger)
+        start = time.perf_counter()
+        if name == "worker":
+            worker.start()
+        for image, boxes in rendered:
+            time.sleep(render)
+            if name == "worker":
+                worker.submit(image, boxes)
+            else:
+                worker.draw(image, boxes)
+                worker.previous = image
+        if name == "worker":
+            worker.stop()
+        results[name] = time.perf_counter() - start
+        assert not ImageChops.difference(driver.frame_buffer, rendered[-1][0]).getbbox()
+        assert name == "serial" or worker.drawn + worker.superseded == frames
+        logging.info("%-6s %6.3f s, %d refreshes, %d frames superseded", name, results[name],
+                     driver.refreshes, worker.superseded)
+    assert results["worker"] < results["serial"]
+
+
+def clock_tree(font_huge, font_medium):
+    """A clock, a date and three values around a line, like the quadrant of the desktop"""
+    window = PanelWidget(800, 600)
+    texts = []
+    for left, top, width, height, font in ((400, 80, 400, 150, font_huge), (400, 40, 400, 50, font_medium),
+                                           (80, 100, 190, 120, font_huge), (250, 40, 90, 40, font_medium),
+                                           (140, 230, 100, 30, font_medium), (480, 400, 190, 120, font_huge)):
+        text = TextWidget(width, height, font=font)
+        text.left = left
+        text.top = top
+        window.add_child(text)
+        texts.append(text)
+    line = LineWidget(3, 271)
+    line.left = 399
+    line.top = 20
+    window.add_child(line)
+    return window, texts
+
+
+@click.command(name='widget-repaint')
+@click.option('--frames', default=30, show_default=True, help='Number of frames to render')
+def widget_repaint(frames):
+    """A widget tree drawn on a new image every frame against the retained tree that repaints
+    the dirty widgets only - the clock changes every frame, the values now and then. The
+    repainted canvas has to equal the fresh image, outside the damage nothing may change"""
+    font_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "resources", "RobotoCondensed-Regular.ttf")
+    font_huge, font_medium = ImageFont.truetype(font_file, size=140), ImageFont.truetype(font_file, size=40)
+    contents = [["%2d:%02d" % (12 + frame // 60, frame % 60), "17 October 2026", str(20 + frame // 7),
+                 "%d%%" % (40 + frame // 11), str(800 + 10 * (frame // 5)), str(-frame // 13)] for frame in range(frames)]
+    fresh_time = retained_time = 0.0
+    retained, retained_texts = clock_tree(font_huge, font_medium)
+    canvas = Image.new("L", (800, 600), 255)
+    for frame, content in enumerate(contents):
+        start = time.perf_counter()
+        window, texts = clock_tree(font_huge, font_medium)
+        for text, value in zip(texts, content):
+            text.text = value
+        image = Image.new("L", (800, 600), 255)
+        window.draw(ImageDraw.Draw(image))
+        fresh_time += time.perf_counter() - start
+
+        previous = canvas.copy()
+        start = time.perf_counter()
+        for text, value in zip(retained_texts, content):
+            text.text = value
+        damage = retained.repaint(canvas)
+        retained_time += time.perf_counter() - start
+        assert not ImageChops.difference(canvas, image).getbbox()
+        outside = ImageChops.difference(canvas, previous)
+        for box in damage:
+            outside.paste(0, box)
+        assert not outside.getbbox()
+        assert all(ImageChops.difference(canvas.crop(box), previous.crop(box)).getbbox() ==
+                   (0, 0, box[2] - box[0], box[3] - box[1]) for box in damage)
+    logging.info("fresh tree %.2f ms/frame   retained tree %.2f ms/frame",
+                 fresh_time / frames * 1000, retained_time / frames * 1000)
+
+
+@click.group()
+def cli():
+    """Driver micro-benchmarks"""
+    pass
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    cli.add_command(pack_it8951)
+    cli.add_command(spi_it8951)
+    cli.add_command(transactions_it8951)
+    cli.add_command(frame_buffer)
+    cli.add_command(send_waveshare)
+    cli.add_command(expand_waveshare)
+    cli.add_command(tricolor_waveshare)
+    cli.add_command(planes_waveshare)
+    cli.add_command(colordraw)
+    cli.add_command(partial_waveshare)
+    cli.add_command(delta_upload)
+    cli.add_command(bitmap_formats)
+    cli.add_command(simulate_drivers)
+    cli.add_command(profile_drivers)
+    cli.add_command(startup)
+    cli.add_command(plan_updates)
+    cli.add_command(ghosting_budget)
+    cli.add_command(display_worker)
+    cli.add_command(widget_repaint)
+    cli()
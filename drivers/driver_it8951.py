@@ -1,6 +1,11 @@
 from PIL import Image
-from drivers.drivers_base import DisplayDriver
+from drivers import packing
+from drivers.drivers_base import Capabilities, DisplayDriver
+from drivers.wait_strategies import AdaptiveWait
 import array
+import hashlib
+import json
+import os
 import struct
 import time
 import logging
@@ -11,6 +16,21 @@ try:
 except ImportError:
     pass
 
+# Translation tables for IT8951.pack_image: for each bit depth and pixel
+# position within a byte, keep the most significant bits of a gray level and
+# move them to the position of the pixel.
+_PACK_TABLES = {
+    bpp: [
+        bytes((value >> (8 - bpp)) << (position * bpp) for value in range(256))
+        for position in range(8 // bpp)
+    ]
+    for bpp in (1, 2, 4)
+}
+
+# Gray level -> the part of it the display can show at 4bpp.
+_VISIBLE_LEVELS = bytes(value & 0xF0 for value in range(256))
+
+
 class IT8951(DisplayDriver):
     """A generic driver for displays that use a IT8951 controller board.
 
@@ -23,6 +43,23 @@ class IT8951(DisplayDriver):
 
     VCOM = 2000
 
+    SPI_SPEED_HZ = 2000000
+
+    # Nominal seconds of a GC16 refresh, regions refresh in parallel. Setting up
+    # a region takes a few SPI transactions.
+    REFRESH_TIME = 0.45
+    REGION_TIME = 0.002
+
+    # DU, A2 and GL16 ghost much less than the partial LUTs of the small panels, a tile
+    # takes more partial updates before it needs a GC16 refresh
+    GHOSTING_UPDATES = 10
+    GHOSTING_CHANGED = 4.0
+
+    # Timeouts in seconds for the controller to accept the next command and for
+    # the display to finish refreshing.
+    READY_TIMEOUT = 5.0
+    DISPLAY_READY_TIMEOUT = 30.0
+
     CMD_GET_DEVICE_INFO = [0x03, 0x02]
     CMD_WRITE_REGISTER = [0x00, 0x11]
     CMD_READ_REGISTER = [0x00, 0x10]
@@ -36,6 +73,8 @@ class IT8951(DisplayDriver):
 
     REG_DISPLAY_BASE = 0x1000
     REG_LUTAFSR = REG_DISPLAY_BASE + 0x224 # LUT Status Reg (status of All LUT Engines)
+    REG_UP1SR = REG_DISPLAY_BASE + 0x138 # Update Parameter1 Setting Reg (1bpp mode)
+    REG_BGVR = REG_DISPLAY_BASE + 0x250 # Bitmap (1bpp) image color table
 
     REG_MEMORY_CONV_BASE_ADDR = 0x0200
     REG_MEMORY_CONV = REG_MEMORY_CONV_BASE_ADDR + 0x0000
@@ -51,6 +90,17 @@ class IT8951(DisplayDriver):
     BPP_4 = 2
     BPP_8 = 3
 
+    BPP_FORMATS = {2: BPP_2, 3: BPP_3, 4: BPP_4, 8: BPP_8}
+
+    # Horizontal alignment (in pixels) of regions per bits per pixel. Rows must
+    # fill whole 16 bit words, 1bpp regions are loaded as 8bpp images of 8
+    # pixels per byte and need 32 pixel alignment.
+    PIXEL_ALIGNMENT = {1: 32, 2: 8, 4: 4}
+
+    # Gray levels of the 0 and 1 bits in 1bpp mode.
+    BITMAP_BLACK = 0x00
+    BITMAP_WHITE = 0xF0
+
     LOAD_IMAGE_L_ENDIAN = 0
     LOAD_IMAGE_B_ENDIAN = 1
 
@@ -63,26 +113,101 @@ class IT8951(DisplayDriver):
     # A flashy update mode that can go from any gray scale color to any other
     # gray scale color.
     DISPLAY_UPDATE_MODE_GC16 = 2
+    # A non-flashy update mode for gray scale content on a white background,
+    # such as anti-aliased text.
+    DISPLAY_UPDATE_MODE_GL16 = 3
+    # The fastest update mode, only for going from black or white to black or
+    # white. It accumulates ghosting. Some panels (e.g. 9.7") use mode 4.
+    DISPLAY_UPDATE_MODE_A2 = 6
     # For more documentation on display update modes see the reference document:
     # http://www.waveshare.net/w/upload/c/c4/E-paper-mode-declaration.pdf
 
-    def __init__(self):
+    MODE_NAMES = {
+        DISPLAY_UPDATE_MODE_INIT: "INIT",
+        DISPLAY_UPDATE_MODE_DU: "DU",
+        DISPLAY_UPDATE_MODE_GC16: "GC16",
+        DISPLAY_UPDATE_MODE_GL16: "GL16",
+        DISPLAY_UPDATE_MODE_A2: "A2",
+    }
+
+    def __init__(self, wait_strategy=None, spi_chunk_size=4096, pipelined=False,
+                 state_file=None):
         super().__init__()
         self.name = "IT8951"
         self.supports_partial = True
+        # How to wait for the busy pin and the display, see
+        # drivers.wait_strategies. Wait times are collected in its stats.
+        self.wait_strategy = wait_strategy or AdaptiveWait()
+        # Bit depths draw may choose from. Regions that contain only black and
+        # white are sent with the smallest one their alignment allows, anything
+        # else always falls back to 4bpp.
+        self.bit_depths = (1, 2, 4)
+        # Per bit depth counters of draws and transferred bytes, including the
+        # number of bytes the same draws would have needed at 4bpp.
+        self.transfer_stats = {}
+        self.bitmap_mode = False
+        # Largest single SPI write. Chunks are memoryview slices of the data,
+        # so chunking never copies it.
+        self.spi_chunk_size = spi_chunk_size
+        # In pipelined mode draw doesn't wait for earlier refreshes to finish
+        # unless the new region overlaps one of them. A region that doesn't
+        # overlap a running refresh is loaded into memory that refresh doesn't
+        # read, so all regions share the image buffer of the device.
+        self.pipelined = pipelined
+        self.pending_regions = []
+        # Shadow copy of the registers written to the controller, writes of a
+        # value that is already there are skipped. The command arguments that
+        # follow a command are sent in one data transaction when coalescing.
+        self.registers = {}
+        self.register_cache = True
+        self.coalesce_data = True
+        # SPI traffic counters, a transaction is one chip select frame.
+        self.spi_stats = {
+            "transactions": 0, "commands": 0, "data_bytes": 0,
+            "register_writes": 0, "register_writes_skipped": 0,
+        }
+        # The frame on the display as far as the driver knows, None if it
+        # doesn't, used to pick update modes. Optional JSON file with the device info, VCOM and a hash
+        # of the frame, which is kept next to it as a PNG image. With a valid
+        # state init skips the reset, the device queries and the INIT refresh
+        # if the controller is still configured. The state is only saved by
+        # flush, once the display shows the frame. Until then the file says that
+        # the frame is unknown, so a crash in between means a full redraw.
+        self.state_file = state_file
+        self.state_saved = False
+        self.device_info = None
+        self.frame = None
+        # With the shadow, regions drawn without an explicit update mode only
+        # load and refresh the windows whose pixels differ from the frame.
+        # Changed rows with up to shadow_merge_gap unchanged rows between them
+        # share a window. The bytes sent and saved, in total and for the last
+        # draw_regions call, are kept in delta_stats.
+        self.use_shadow = True
+        self.shadow_merge_gap = 32
+        self.delta_stats = {
+            "frames": 0, "bytes": 0, "bytes_saved": 0,
+            "last_bytes": 0, "last_bytes_saved": 0,
+        }
+        # Picks the update mode of regions drawn without an explicit one.
+        self.waveform_policy = WaveformPolicy()
 
     def delay_ms(self, delaytime):
         time.sleep(float(delaytime) / 1000.0)
 
     def spi_write(self, data):
-        """Write raw bytes over SPI."""
-        self.SPI.writebytes(data)
+        """Write raw bytes over SPI.
+
+        Accepts lists as well as any object supporting the buffer protocol,
+        buffers are handed to spidev without being converted to a list."""
+        self.SPI.writebytes2(data)
 
     def spi_read(self, n):
         """Read n raw bytes over SPI."""
         return self.SPI.readbytes(n)
 
     def write_command(self, command):
+        self.spi_stats["transactions"] += 1
+        self.spi_stats["commands"] += 1
         self.wait_for_ready()
         GPIO.output(self.CS_PIN, GPIO.LOW)
         self.spi_write([0x60, 0x00])
@@ -91,16 +216,23 @@ class IT8951(DisplayDriver):
         GPIO.output(self.CS_PIN, GPIO.HIGH)
 
     def write_data_bytes(self, data):
-        max_transfer_size = 4096
+        """Writes data to the controller.
+
+        data can be bytes, a bytearray, a memoryview or anything else that
+        supports the buffer protocol."""
+        view = memoryview(data).cast("B")
+        self.spi_stats["transactions"] += 1
+        self.spi_stats["data_bytes"] += len(view)
         self.wait_for_ready()
         GPIO.output(self.CS_PIN, GPIO.LOW)
         self.spi_write([0x00, 0x00])
         self.wait_for_ready()
-        for i in range(0, len(data), max_transfer_size):
-            self.spi_write(data[i: i + max_transfer_size])
+        for i in range(0, len(view), self.spi_chunk_size):
+            self.spi_write(view[i: i + self.spi_chunk_size])
         GPIO.output(self.CS_PIN, GPIO.HIGH)
 
     def read_bytes(self, n):
+        self.spi_stats["transactions"] += 1
         self.wait_for_ready()
         GPIO.output(self.CS_PIN, GPIO.LOW)
         self.spi_write([0x10, 0x00])
@@ -117,29 +249,52 @@ class IT8951(DisplayDriver):
         The standard integer format for passing data to and from the controller
         is little endian 16 bit words.
         """
-        self.write_data_bytes([(half_word >> 8) & 0xFF, half_word & 0xFF])
+        self.write_data_bytes(struct.pack(">H", half_word & 0xFFFF))
+
+    def write_data_half_words(self, *half_words):
+        """Writes several half words of data, in a single transaction when
+        coalescing is enabled."""
+        if self.coalesce_data:
+            self.write_data_bytes(struct.pack(
+                    ">%dH" % len(half_words), *(w & 0xFFFF for w in half_words)))
+        else:
+            for half_word in half_words:
+                self.write_data_half_word(half_word)
 
     def read_half_word(self):
         """Reads a half word of from the controller."""
         return struct.unpack(">H", self.read_bytes(2))[0]
 
     def write_register(self, register_address, value):
+        if self.register_cache and self.registers.get(register_address) == value:
+            self.spi_stats["register_writes_skipped"] += 1
+            return
+        self.spi_stats["register_writes"] += 1
         self.write_command(self.CMD_WRITE_REGISTER)
-        self.write_data_half_word(register_address)
-        self.write_data_half_word(value)
+        self.write_data_half_words(register_address, value)
+        self.registers[register_address] = value
 
     def read_register(self, register_address):
         self.write_command(self.CMD_READ_REGISTER)
         self.write_data_half_word(register_address)
         return self.read_half_word()
 
+    def read_cached_register(self, register_address):
+        """Reads a register that only the driver writes, from the shadow copy
+        if possible. Not for status registers."""
+        if self.register_cache and register_address in self.registers:
+            return self.registers[register_address]
+        value = self.read_register(register_address)
+        self.registers[register_address] = value
+        return value
+
     def wait_for_ready(self):
         """Waits for the busy pin to drop.
 
         When the busy pin is high the controller is busy and may drop any
         commands that are sent to it."""
-        while GPIO.input(self.BUSY_PIN) == 0:
-            self.delay_ms(100)
+        self.wait_strategy.wait_for_pin(
+                GPIO, self.BUSY_PIN, 1, timeout=self.READY_TIMEOUT, name="ready")
 
     def wait_for_display_ready(self):
         """Waits for the display to be finished updating.
@@ -147,8 +302,9 @@ class IT8951(DisplayDriver):
         It is possible for the controller to be ready for more commands but the
         display to still be refreshing. This will wait for the display to be
         stable."""
-        while self.read_register(self.REG_LUTAFSR) != 0:
-            self.delay_ms(100)
+        self.wait_strategy.wait_until(
+                lambda: self.read_register(self.REG_LUTAFSR) == 0,
+                timeout=self.DISPLAY_READY_TIMEOUT, name="display_ready")
 
     def get_vcom(self):
         self.wait_for_ready()
@@ -158,8 +314,7 @@ class IT8951(DisplayDriver):
 
     def set_vcom(self, vcom):
         self.write_command(self.CMD_VCOM)
-        self.write_data_half_word(1)
-        self.write_data_half_word(vcom)
+        self.write_data_half_words(1, vcom)
 
     def fixup_string(self, s):
         result = ""
@@ -177,7 +332,7 @@ class IT8951(DisplayDriver):
         GPIO.setup(self.CS_PIN, GPIO.OUT)
         GPIO.setup(self.BUSY_PIN, GPIO.IN)
         self.SPI = spidev.SpiDev(0, 0)
-        self.SPI.max_speed_hz = 2000000
+        self.SPI.max_speed_hz = self.SPI_SPEED_HZ
         self.SPI.mode = 0b00
 
         # It is unclear why this is necessary but it appears to be. The sample
@@ -189,11 +344,31 @@ class IT8951(DisplayDriver):
 
         GPIO.output(self.CS_PIN, GPIO.HIGH)
 
+        state = self.load_state()
+        if state is not None and self.is_configured():
+            self.width = state["width"]
+            self.height = state["height"]
+            self.img_addr = state["img_addr"]
+            # The controller kept its registers, but the shadow copy is gone.
+            self.registers = {}
+            self.bitmap_mode = None
+            self.restored_frame = self.load_frame(state)
+            # Without a saved frame nothing is known about the display until a
+            # draw covers all of it.
+            self.frame = None
+            if self.restored_frame is not None:
+                self.frame = self.restored_frame.copy()
+            self.state_saved = True
+            logging.info("Warm start with %s, skipping device initialization" % self.state_file)
+            return
+
         # Reset the device to its initial state.
         GPIO.output(self.RST_PIN, GPIO.LOW)
         self.delay_ms(500)
         GPIO.output(self.RST_PIN, GPIO.HIGH)
         self.delay_ms(500)
+        self.registers = {}
+        self.bitmap_mode = False
 
         self.write_command(self.CMD_GET_DEVICE_INFO);
 
@@ -229,83 +404,362 @@ class IT8951(DisplayDriver):
             self.set_vcom(self.VCOM)
             logging.info("VCOM = -%.02fV" % (self.get_vcom() / 1000.0))
 
+        self.device_info = {
+            "width": self.width,
+            "height": self.height,
+            "img_addr": self.img_addr,
+            "firmware": firmware_version,
+            "lut": lut_version,
+            "vcom": self.VCOM,
+        }
+
+        # Whatever a state file says about the display is gone with the reset.
+        if self.state_file:
+            self.invalidate_state()
+
         # Initialize the display with a blank image.
         self.wait_for_ready()
         image = Image.new("L", (self.width, self.height), 0x255)
+        self.frame = Image.new("L", (self.width, self.height), 255)
         self.draw(0, 0, image, self.DISPLAY_UPDATE_MODE_INIT)
 
+    def is_configured(self):
+        """Checks whether the controller still runs with the configuration of
+        an earlier init, i.e. it hasn't been power cycled since.
+
+        I80 packed mode is off after power on and only init turns it on."""
+        try:
+            return self.read_register(self.REG_I80CPCR) == 0x0001
+        except TimeoutError:
+            logging.warning("Controller not responding, falling back to a full initialization")
+            return False
+
+    def frame_file(self):
+        return os.path.splitext(self.state_file)[0] + ".png"
+
+    def load_state(self):
+        """Returns the saved state if there is one and it matches the VCOM
+        setting, otherwise None."""
+        if not self.state_file:
+            return None
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            logging.info("No usable state in %s, cold start" % self.state_file)
+            return None
+        if not isinstance(state, dict) or state.get("vcom") != self.VCOM or not all(
+                state.get(key) for key in ("width", "height", "img_addr")):
+            logging.info("State in %s doesn't match the driver, cold start" % self.state_file)
+            return None
+        self.device_info = {key: state.get(key) for key in (
+                "width", "height", "img_addr", "firmware", "lut", "vcom")}
+        return state
+
+    def load_frame(self, state):
+        """Returns the saved frame if it is the one the state describes."""
+        try:
+            frame = Image.open(self.frame_file()).convert("L")
+        except OSError:
+            return None
+        if (frame.size != (self.width, self.height) or
+                hashlib.sha1(frame.tobytes()).hexdigest() != state.get("frame_hash")):
+            logging.info("Saved frame doesn't match the state, ignoring it")
+            return None
+        return frame
+
+    def save_state(self):
+        """Saves the device info and the frame on the display."""
+        state = dict(self.device_info)
+        state["frame_hash"] = None
+        if self.frame is not None:
+            state["frame_hash"] = hashlib.sha1(self.frame.tobytes()).hexdigest()
+            self.frame.save(self.frame_file() + ".tmp", "PNG", compress_level=1)
+            os.replace(self.frame_file() + ".tmp", self.frame_file())
+        self.write_state(state)
+        self.state_saved = True
+
+    def invalidate_state(self):
+        """Saves the device info without a frame, the display is about to
+        change."""
+        state = dict(self.device_info)
+        state["frame_hash"] = None
+        self.write_state(state)
+        self.state_saved = False
+
+    def write_state(self, state):
+        with open(self.state_file + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    def capabilities(self):
+        return Capabilities(
+                partial=True,
+                alignment={bpp: self.PIXEL_ALIGNMENT[bpp] for bpp in self.bit_depths},
+                gray_bpp=4,
+                modes=(None,) + tuple(self.MODE_NAMES),
+                full_mode=self.DISPLAY_UPDATE_MODE_GC16,
+                frame_cost=self.REFRESH_TIME,
+                region_cost=self.REGION_TIME,
+                bytes_per_second=self.SPI_SPEED_HZ / 8)
+
     def display_area(self, x, y, w, h, display_mode):
         self.write_command(self.CMD_DISPLAY_AREA)
-        self.write_data_half_word(x)
-        self.write_data_half_word(y)
-        self.write_data_half_word(w)
-        self.write_data_half_word(h)
-        self.write_data_half_word(display_mode)
+        self.write_data_half_words(x, y, w, h, display_mode)
 
-    def draw(self, x, y, image, update_mode_override=None):
-        width = image.size[0]
-        height = image.size[1]
+    def flush(self):
+        """Waits until everything that was drawn is on the display and saves
+        the state, if there is a state file."""
+        self.wait_for_refreshes()
+        if self.state_file and not self.state_saved and self.device_info:
+            self.save_state()
 
+    def wait_for_refreshes(self):
+        """Waits until the running refreshes are finished."""
         self.wait_for_display_ready()
-
-        self.write_register(
-                self.REG_MEMORY_CONV_LISAR + 2, (self.img_addr >> 16) & 0xFFFF)
-        self.write_register(self.REG_MEMORY_CONV_LISAR, self.img_addr & 0xFFFF)
-
-        # Define the region being loaded.
-        self.write_command(self.CMD_LOAD_IMAGE_AREA)
-        self.write_data_half_word(
-                (self.LOAD_IMAGE_L_ENDIAN << 8) |
-                (self.BPP_4 << 4) |
-                self.ROTATE_0)
-        self.write_data_half_word(x)
-        self.write_data_half_word(y)
-        self.write_data_half_word(width)
-        self.write_data_half_word(height)
-
-        self.write_data_bytes(self.pack_image(image))
-        self.write_command(self.CMD_LOAD_IMAGE_END);
-
-        if update_mode_override is not None:
-            update_mode = update_mode_override
-        elif image.mode == "1":
-            # Use a faster, non-flashy update mode for pure black and white
-            # images.
-            update_mode = self.DISPLAY_UPDATE_MODE_DU
+        self.pending_regions = []
+
+    def reserve_region(self, region, bitmap_mode):
+        """Waits for the display if the region would interfere with refreshes
+        that are still running: if it overlaps one of them or the bitmap mode
+        has to change."""
+        x, y, w, h = region
+        if bitmap_mode != self.bitmap_mode or any(
+                x < px + pw and px < x + w and y < py + ph and py < y + h
+                for px, py, pw, ph in self.pending_regions):
+            self.wait_for_refreshes()
+        self.pending_regions.append(region)
+
+    def set_bitmap_mode(self, enabled):
+        """Switches the 1bpp (bitmap) mode of the display engine.
+
+        The mode is global, so it can only be changed while the display is not
+        refreshing."""
+        if enabled == self.bitmap_mode:
+            return
+        value = self.read_cached_register(self.REG_UP1SR + 2)
+        if enabled:
+            self.write_register(self.REG_UP1SR + 2, value | (1 << 2))
+            self.write_register(
+                    self.REG_BGVR, (self.BITMAP_WHITE << 8) | self.BITMAP_BLACK)
         else:
-            # Use a slower, flashy update mode for gray scale images.
-            update_mode = self.DISPLAY_UPDATE_MODE_GC16
-        # Blit the image to the display
-        self.display_area(x, y, width, height, update_mode)
+            self.write_register(self.REG_UP1SR + 2, value & ~(1 << 2))
+        self.bitmap_mode = enabled
+
+    @staticmethod
+    def gray_levels(image):
+        """Returns the histogram of the 16 gray levels the display can show."""
+        histogram = image.convert("L").histogram()
+        return [sum(histogram[i:i + 16]) for i in range(0, 256, 16)]
+
+    def select_bpp(self, x, image, levels=None):
+        """Returns the smallest allowed bit depth that preserves the image.
+
+        Only pure black and white images (after dropping the bits that 4bpp
+        would drop anyway) can be sent with 1 or 2 bits per pixel."""
+        if levels is None:
+            levels = self.gray_levels(image)
+        black_white = not any(levels[1:15])
+        for bpp in sorted(self.bit_depths):
+            if bpp == 4:
+                break
+            alignment = self.PIXEL_ALIGNMENT[bpp]
+            if (black_white and x % alignment == 0 and
+                    image.width % alignment == 0):
+                return bpp
+        return 4
 
-    def pack_image(self, image):
-        """Packs a PIL image for transfer over SPI to the driver board."""
+    def draw(self, x, y, image, update_mode_override=None):
+        self.draw_regions([(x, y, image, update_mode_override)])
+
+    def draw_regions(self, regions):
+        """Draws a batch of (x, y, image, update_mode) regions.
+
+        All regions are packed up front, the display is waited for only where
+        a region interferes with a running refresh and the image buffer address
+        is only set when it changes. Returns the time spent on each region in
+        seconds, in the order of the regions argument."""
+        timings = [0.0] * len(regions)
+        transactions = self.spi_stats["transactions"]
+        frame_bytes = frame_bytes_saved = 0
+        batch = []
+        for index, (region_x, region_y, region_image, region_mode) in enumerate(regions):
+            start = time.monotonic()
+            windows = [(region_x, region_y, region_image)]
+            if region_mode is None:
+                windows = self.changed_windows(region_x, region_y, region_image)
+                full_bpp = self.select_bpp(region_x, region_image)
+                frame_bytes_saved += -(-region_image.width * region_image.height * full_bpp // 8)
+            for x, y, image in windows:
+                levels = self.gray_levels(image)
+                bpp = self.select_bpp(x, image, levels)
+                packed_image = self.pack_image(image, bpp)
+                self.record_transfer(bpp, len(packed_image), image.width * image.height)
+                frame_bytes += len(packed_image)
+                if region_mode is None:
+                    frame_bytes_saved -= len(packed_image)
+                update_mode = region_mode
+                if update_mode is None:
+                    source = None
+                    if self.frame is not None:
+                        source = self.gray_levels(self.frame.crop(
+                                (x, y, x + image.width, y + image.height)))
+                    update_mode = self.waveform_policy.select(source, levels)
+                logging.debug("Region %dx%d at (%d, %d): %dbpp, mode %s" % (
+                        image.width, image.height, x, y, bpp,
+                        self.MODE_NAMES.get(update_mode, update_mode)))
+                batch.append((index, x, y, image, update_mode, bpp, packed_image))
+            timings[index] += time.monotonic() - start
+        self.record_frame(frame_bytes, max(frame_bytes_saved, 0))
+
+        # Load the regions that don't need a bitmap mode switch first, so the
+        # mode (which can only change on an idle display) changes at most once.
+        batch.sort(key=lambda region: (region[5] == 1) != self.bitmap_mode)
+
+        if self.state_file and self.state_saved:
+            self.invalidate_state()
+        if not self.pipelined:
+            self.wait_for_refreshes()
+        for index, x, y, image, update_mode, bpp, packed_image in batch:
+            start = time.monotonic()
+            width = image.size[0]
+            height = image.size[1]
+
+            self.reserve_region((x, y, width, height), bpp == 1)
+            self.set_bitmap_mode(bpp == 1)
+
+            self.write_register(
+                    self.REG_MEMORY_CONV_LISAR + 2, (self.img_addr >> 16) & 0xFFFF)
+            self.write_register(self.REG_MEMORY_CONV_LISAR, self.img_addr & 0xFFFF)
+
+            # Define the region being loaded. 1bpp images are loaded as 8bpp
+            # images that are 8 times narrower.
+            if bpp == 1:
+                pixel_format, load_x, load_width = self.BPP_8, x // 8, width // 8
+            else:
+                pixel_format, load_x, load_width = self.BPP_FORMATS[bpp], x, width
+            self.write_command(self.CMD_LOAD_IMAGE_AREA)
+            self.write_data_half_words(
+                    (self.LOAD_IMAGE_L_ENDIAN << 8) |
+                    (pixel_format << 4) |
+                    self.ROTATE_0,
+                    load_x, y, load_width, height)
+
+            self.write_data_bytes(packed_image)
+            self.write_command(self.CMD_LOAD_IMAGE_END);
+
+            # Blit the image to the display
+            self.display_area(x, y, width, height, update_mode)
+            timings[index] += time.monotonic() - start
+        logging.debug("Drew %d regions in %d SPI transactions" % (
+                len(regions), self.spi_stats["transactions"] - transactions))
+
+        for x, y, image, update_mode in regions:
+            if self.frame is None and (x, y, image.size) == (0, 0, (self.width, self.height)):
+                self.frame = Image.new("L", (self.width, self.height), 255)
+            if self.frame is not None:
+                self.frame.paste(image.convert("L"), (x, y))
+        return timings
+
+    def changed_windows(self, x, y, image):
+        """Splits a region into the (x, y, image) windows that change what the
+        display shows according to the frame, all of it without a shadow.
+
+        Windows are widened to the 1bpp alignment where the region allows it,
+        so they can still be sent at a low bit depth."""
+        if not self.use_shadow or self.frame is None:
+            return [(x, y, image)]
+        image = image.convert("L")
+        width, height = image.size
+        old = self.frame.crop((x, y, x + width, y + height)).tobytes()
+        new = image.tobytes()
+        alignment = self.PIXEL_ALIGNMENT[1]
+        windows = []
+        for first_row, end_row, first, end in packing.changed_windows(
+                old.translate(_VISIBLE_LEVELS), new.translate(_VISIBLE_LEVELS),
+                width, self.shadow_merge_gap):
+            left = max((x + first) // alignment * alignment, x) - x
+            right = min(-(-(x + end) // alignment) * alignment, x + width) - x
+            windows.append((x + left, y + first_row,
+                            image.crop((left, first_row, right, end_row))))
+        return windows
+
+    def record_frame(self, sent, saved):
+        stats = self.delta_stats
+        stats["frames"] += 1
+        stats["bytes"] += sent
+        stats["bytes_saved"] += saved
+        stats["last_bytes"], stats["last_bytes_saved"] = sent, saved
+        logging.debug("Frame %d: %d bytes of image data sent, %d saved by the shadow" % (
+                stats["frames"], sent, saved))
+
+    def record_transfer(self, bpp, size, pixels):
+        stats = self.transfer_stats.setdefault(
+                bpp, {"draws": 0, "bytes": 0, "bytes_4bpp": 0})
+        stats["draws"] += 1
+        stats["bytes"] += size
+        stats["bytes_4bpp"] += (pixels + 1) // 2
+        logging.debug("Transfer %d pixels at %dbpp: %d bytes, %d saved" % (
+                pixels, bpp, size, (pixels + 1) // 2 - size))
+
+    def pack_image(self, image, bpp=4):
+        """Packs a PIL image for transfer over SPI to the driver board.
+
+        Supports 1, 2 and 4 bits per pixel and returns a bytearray that can be
+        passed straight to write_data_bytes."""
         # Convert the image to 8 bit / BW. Then converting to a smaller
         # bits-per-pixel gray scale image is just a matter of chopping off the
         # least significant bytes.
-        image_grey = image.convert("L")
-        pixels = image_grey.load()
-        frame_buffer = [
-            pixels[x, y]
-            for y in range(image.height)
-            for x in range(image.width)
-        ]
-
-        # For now, only 4 bit packing is supported. Theoretically we could
-        # achieve a transfer speed up by using 2 bit packing for black and white
-        # images. However, 2bpp doesn't seem to play well with the DU rendering
-        # mode.
-        packed_buffer = []
-        for i in range(0, len(frame_buffer), 2):
-            value = (frame_buffer[i] >> 4) & 0x0F
-            if i + 1 < len(frame_buffer):
-                value |= frame_buffer[i + 1] & 0xF0
-            packed_buffer += [value]
+        pixels = image.convert("L").tobytes()
+
+        # Every byte holds 8 / bpp pixels, the first pixel in the least
+        # significant bits. The pixels for each position within a byte are
+        # extracted and shifted into place with a translation table and then
+        # merged with a big integer OR, which keeps the whole operation out of
+        # Python loops.
+        pixels_per_byte = 8 // bpp
+        size = -(-len(pixels) // pixels_per_byte)
+        size += size % 2
+        packed = 0
+        for position, table in enumerate(_PACK_TABLES[bpp]):
+            part = pixels[position::pixels_per_byte].translate(table)
+            packed |= int.from_bytes(part, "big") << 8 * (size - len(part))
+        packed_buffer = bytearray(packed.to_bytes(size, "big"))
 
         # The driver board assumes all data is read in as 16bit ints. To match
         # the endianness every pair of bytes must be swapped.
-        for i in range(0, len(packed_buffer), 2):
-            packed_buffer[i], packed_buffer[i + 1] = (
-                    packed_buffer[i + 1], packed_buffer[i])
+        packed_buffer[0::2], packed_buffer[1::2] = (
+                packed_buffer[1::2], packed_buffer[0::2])
 
         return packed_buffer
+
+
+class WaveformPolicy:
+    """Chooses the update mode of an IT8951 region from its gray levels.
+
+    Subclass it and override select to tune the choice, then assign an
+    instance to IT8951.waveform_policy."""
+
+    def __init__(self, use_a2=True, use_gl16=False):
+        self.use_a2 = use_a2
+        self.use_gl16 = use_gl16
+
+    def select(self, source, target):
+        """Returns the update mode for a region.
+
+        source and target are the IT8951.gray_levels histograms of the region
+        before and after the update, source is None when the display content
+        is unknown."""
+        if not any(target[1:15]):
+            # A2 only works when no pixel starts out gray.
+            if self.use_a2 and source is not None and not any(source[1:15]):
+                return IT8951.DISPLAY_UPDATE_MODE_A2
+            return IT8951.DISPLAY_UPDATE_MODE_DU
+        if (self.use_gl16 and source is not None and
+                self.mostly_white(source) and self.mostly_white(target)):
+            return IT8951.DISPLAY_UPDATE_MODE_GL16
+        return IT8951.DISPLAY_UPDATE_MODE_GC16
+
+    @staticmethod
+    def mostly_white(levels):
+        return levels[15] * 2 >= sum(levels)
@@ -15,8 +15,14 @@
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
 from PIL import Image
 
+import json
+import os
+import queue
+import threading
 import time
 
 # if rpi libs are not found, don't care - hope that we don't end up
@@ -28,6 +34,37 @@ except ImportError:
     pass
 
 
+@dataclass(frozen=True)
+class Capabilities:
+    """What a display can do and what drawing on it costs - for planning updates.
+
+    alignment maps the bit depths regions can be sent with to the multiple of pixels that
+    the x coordinate and the width of a region must be at that depth. Depths below
+    gray_bpp only work for pure black and white regions. modes are the update modes
+    draw_regions accepts (None lets the driver pick one) and full_mode is the mode of a
+    full refresh that clears ghosting. Costs are in seconds: frame_cost for every
+    draw_regions call, region_cost for every region in it, and the image data goes at
+    bytes_per_second."""
+    partial: bool
+    alignment: Dict[int, int]
+    gray_bpp: int = 1
+    modes: Tuple[Optional[int], ...] = (None,)
+    full_mode: Optional[int] = None
+    frame_cost: float = 0.0
+    region_cost: float = 0.0
+    bytes_per_second: float = float('inf')
+
+    def align(self, box, bpp, width):
+        """Widen the x range of a (left, top, right, bottom) box to the alignment of bpp,
+        within the width of the display"""
+        alignment = self.alignment[bpp]
+        return box[0] // alignment * alignment, box[1], min(-(-box[2] // alignment) * alignment, width), box[3]
+
+    def cost(self, box, bpp):
+        """Seconds it takes to draw the box as one region, apart from frame_cost"""
+        return self.region_cost + (box[2] - box[0]) * (box[3] - box[1]) * bpp / 8 / self.bytes_per_second
+
+
 class DisplayDriver(ABC):
     """Abstract base class for a display driver - be it Waveshare e-Paper, PaPiRus, OLED..."""
 
@@ -35,6 +72,11 @@ class DisplayDriver(ABC):
     white = 255
     black = 0
 
+    # How much ghosting a tile of the display may collect between clean refreshes: the
+    # number of partial updates and the changed pixels, as a multiple of the tile area.
+    GHOSTING_UPDATES = 5
+    GHOSTING_CHANGED = 2.0
+
     def __init__(self):
         super().__init__()
         self.name = None
@@ -44,6 +86,8 @@ class DisplayDriver(ABC):
         self.type = None
         self.supports_partial = None
         self.partial_refresh = None
+        # what the display shows after init, if the driver knows it (e.g. from a warm restart)
+        self.restored_frame = None
 
     @abstractmethod
     def init(self, **kwargs):
@@ -55,6 +99,27 @@ class DisplayDriver(ABC):
         """Draw an image object on the display at (x,y)"""
         pass
 
+    def draw_regions(self, regions):
+        """Draw a batch of (x, y, image, mode) regions and return the seconds spent on each.
+        This generic version draws them one by one and ignores the mode, drivers override it
+        to share setup and refreshes between the regions"""
+        timings = []
+        for x, y, image, mode in regions:
+            start = time.monotonic()
+            self.draw(x, y, image)
+            timings.append(time.monotonic() - start)
+        return timings
+
+    def flush(self):
+        """Wait until everything drawn so far is on the display - for drivers that draw asynchronously"""
+        pass
+
+    def capabilities(self):
+        """What the display can do right now (after init), see Capabilities. This generic
+        version only knows whether it takes partial updates, with byte aligned rows"""
+        return Capabilities(partial=bool(self.supports_partial) and self.partial_refresh is not False,
+                            alignment={1: 8})
+
     def scrub(self, fillsize=16):
         """Scrub display - only works properly with partial refresh"""
         self.fill(self.black, fillsize=fillsize)
@@ -90,6 +155,9 @@ class SpecialDriver(DisplayDriver):
     def scrub(self, fillsize=16):
         pass
 
+    def capabilities(self):
+        return Capabilities(partial=True, alignment={8: 1}, gray_bpp=8)
+
 
 class Dummy(SpecialDriver):
     """Dummy display driver - does not do anything"""
@@ -107,22 +175,103 @@ class Dummy(SpecialDriver):
 class Bitmap(SpecialDriver):
     """Output a bitmap for each frame - overwrite old ones"""
 
-    def __init__(self, maxfiles=5, file_format="png"):
+    # file format -> function that writes an 'L' image to a path, given the driver
+    WRITERS = {
+        "png": lambda driver, image, path: image.save(path, "PNG", compress_level=driver.compress_level),
+        "pgm": lambda driver, image, path: driver.write_pgm(image, path),
+    }
+
+    def __init__(self, maxfiles=5, file_format="png", compress_level=0, queue_size=2, log_file=None, directory=""):
+        """Frames are encoded and written by a worker thread, draw only waits when queue_size
+        frames are already waiting. PNG files are stored without compression by default,
+        raw PGM files skip the encoding altogether. With log_file every frame appends a
+        JSON line with its regions and timings to that file. The bitmaps go to directory,
+        the current one by default."""
         super().__init__(name="Bitmap output driver", width=self.default_width, height=self.default_height, )
+        if file_format not in self.WRITERS:
+            raise ValueError("Unsupported bitmap format {}, choose from {}".format(
+                file_format, ", ".join(sorted(self.WRITERS))))
         self.maxfiles = maxfiles
         self.current_frame = 0
         self.frame_buffer = None
         self.file_format = file_format
+        self.directory = directory
+        self.compress_level = compress_level
+        self.log_file = log_file
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.worker = None
+        self.worker_error = None
 
     def init(self, **kwargs):
+        self.flush()
         self.frame_buffer = Image.new('L', (self.width, self.height), 255)
         self.current_frame = 0
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.write_frames, name="Bitmap writer", daemon=True)
+            self.worker.start()
 
     def draw(self, x, y, image):
-        self.frame_buffer.paste(image, box=(x, y))
-        self.frame_buffer.save("bitmap_frame_{}.{}".format(self.current_frame, self.file_format))
+        self.draw_regions([(x, y, image, None)])
+
+    def draw_regions(self, regions):
+        """Paste all the regions and queue them as one frame"""
+        timings = []
+        for x, y, image, mode in regions:
+            start = time.monotonic()
+            self.frame_buffer.paste(image, box=(x, y))
+            timings.append(time.monotonic() - start)
+        self.queue_frame(regions, sum(timings))
+        return timings
+
+    def queue_frame(self, regions, paste_time):
+        self.raise_worker_error()
+        path = os.path.join(self.directory, "bitmap_frame_{}.{}".format(self.current_frame, self.file_format))
+        entry = {
+            "frame": self.current_frame,
+            "file": path,
+            "time": time.time(),
+            "regions": [{"x": x, "y": y, "width": image.width, "height": image.height, "mode": mode}
+                        for x, y, image, mode in regions],
+            "paste": paste_time,
+        }
+        self.frames.put((self.frame_buffer.copy(), entry, time.monotonic()))
         self.current_frame = (self.current_frame + 1) % self.maxfiles
 
+    def write_frames(self):
+        """Worker loop - encode and write the queued frames in order"""
+        while True:
+            image, entry, queued = self.frames.get()
+            try:
+                start = time.monotonic()
+                entry["queued"] = start - queued
+                self.WRITERS[self.file_format](self, image, entry["file"])
+                entry["write"] = time.monotonic() - start
+                if self.log_file:
+                    with open(self.log_file, "a") as log:
+                        log.write(json.dumps(entry) + "\n")
+            except Exception as e:
+                self.worker_error = e
+            finally:
+                self.frames.task_done()
+
+    @staticmethod
+    def write_pgm(image, path):
+        """Binary PGM - a short header followed by the pixels as they are in memory"""
+        with open(path, "wb") as file:
+            file.write("P5\n{} {}\n255\n".format(image.width, image.height).encode("ascii"))
+            file.write(image.tobytes())
+
+    def flush(self):
+        """Wait until all the queued frames are written"""
+        self.frames.join()
+        self.raise_worker_error()
+
+    def raise_worker_error(self):
+        """Raise an error of the worker in the drawing thread - once"""
+        error, self.worker_error = self.worker_error, None
+        if error is not None:
+            raise error
+
 
 class WaveshareEPD(DisplayDriver):
     """Base class for Waveshare displays with common code for all - the 'epdif.py'
@@ -150,6 +299,10 @@ class WaveshareEPD(DisplayDriver):
     ROTATE_270 = 0x03
 
     # SPI device, bus = 0, device = 0
+    SPI_SPEED_HZ = 2000000
+
+    # nominal seconds of a full refresh
+    REFRESH_TIME = 4.0
 
     # SPI methods
 
@@ -168,6 +321,10 @@ class WaveshareEPD(DisplayDriver):
     def spi_transfer(self, data):
         self.SPI.writebytes(data)
 
+    def spi_transfer_bulk(self, data):
+        # writebytes2 takes any buffer and doesn't build a list of ints on the way
+        self.SPI.writebytes2(data)
+
     def epd_init(self):
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
@@ -176,7 +333,7 @@ class WaveshareEPD(DisplayDriver):
         GPIO.setup(self.CS_PIN, GPIO.OUT)
         GPIO.setup(self.BUSY_PIN, GPIO.IN)
         self.SPI = spidev.SpiDev(0, 0)
-        self.SPI.max_speed_hz = 2000000
+        self.SPI.max_speed_hz = self.SPI_SPEED_HZ
         self.SPI.mode = 0b00
         return 0
 
@@ -188,6 +345,8 @@ class WaveshareEPD(DisplayDriver):
         self.width = width
         self.height = height
         self.type = 'Waveshare e-Paper'
+        # largest SPI transfer of send_data_bulk, spidev's default buffer size
+        self.spi_chunk_size = 4096
 
     def digital_write(self, pin, value):
         self.epd_digital_write(pin, value)
@@ -210,6 +369,18 @@ class WaveshareEPD(DisplayDriver):
         # so use [data] instead of data
         self.spi_transfer([data])
 
+    def send_data_bulk(self, data):
+        """Send a whole buffer of data bytes - a bytes-like object or a list of ints.
+        DC is set once and the bytes go out in transfers of up to spi_chunk_size."""
+        self.digital_write(self.DC_PIN, GPIO.HIGH)
+        view = memoryview(bytes(data) if isinstance(data, list) else data).cast('B')
+        for start in range(0, len(view), self.spi_chunk_size):
+            self.spi_transfer_bulk(view[start:start + self.spi_chunk_size])
+
+    def send_data_fill(self, value, count):
+        """Send the same data byte count times, e.g. to clear the display RAM"""
+        self.send_data_bulk(bytes((value,)) * count)
+
     def reset(self):
         self.digital_write(self.RST_PIN, GPIO.LOW)
         self.delay_ms(200)
@@ -221,3 +392,8 @@ class WaveshareEPD(DisplayDriver):
 
     def draw(self, x, y, image):
         pass
+
+    def capabilities(self):
+        # the drivers without partial refresh ignore x and y, every draw is a full refresh
+        return Capabilities(partial=False, alignment={1: 8}, frame_cost=self.REFRESH_TIME,
+                            bytes_per_second=self.SPI_SPEED_HZ / 8)
@@ -14,6 +14,9 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from PIL import Image
+
+from drivers import packing
 from drivers.drivers_full import WaveshareFull
 
 
@@ -25,9 +28,27 @@ class WaveshareColor(WaveshareFull):
 
     VCM_DC_SETTING = 0x82
 
+    REFRESH_TIME = 15.0
+
+    # value of the bits of black and red pixels in the black and the red frame buffer
+    INK_BIT = 0
+
+    # Whether gray levels between black_threshold and red_threshold are red by default -
+    # otherwise gray is black or white like on the monochrome panels, dithered by PIL
+    GRAY_TO_RED = False
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.colors = 3
+        # With gray_to_red, levels below black_threshold are black, below red_threshold red
+        # and the rest white - anti-aliased edges come out red then. Set it to False for black
+        # and white gray on the panels that threshold by default.
+        self.gray_to_red = self.GRAY_TO_RED
+        self.black_threshold = 64
+        self.red_threshold = 192
+        # optional {palette index: 'black' / 'red' / 'white'} for 'P' images, indexes
+        # that are missing are white - without it 'P' images are gray levels as well
+        self.palette_colors = None
 
     def display_frame(self, frame_buffer, *args):
         pass
@@ -36,9 +57,36 @@ class WaveshareColor(WaveshareFull):
         pass
 
     def draw(self, x, y, image):
-        """Display an image - this module does not support partial refresh: x, y are ignored
-        IMPORTANT NOTE: this method IGNORES the red buffer completely!"""
-        self.display_frame(self.get_frame_buffer(image))
+        """Display an image - this module does not support partial refresh: x, y are ignored"""
+        self.display_frame(*self.get_frame_buffers(image))
+
+    def color_codes(self, image, black, red, white):
+        """One byte per pixel of image with the black, red or white code for the pixel.
+        'P' images are mapped with palette_colors if it is set, anything else by gray level:
+        black and white only, unless gray_to_red is set."""
+        if image.mode == 'P' and self.palette_colors is not None:
+            codes = {'black': black, 'red': red, 'white': white}
+            table = bytes(codes[self.palette_colors.get(index, 'white')] for index in range(256))
+        elif self.gray_to_red:
+            image = image.convert('L')
+            table = bytes(black if level < self.black_threshold else red if level < self.red_threshold else white
+                          for level in range(256))
+        else:
+            image = image.convert('1').convert('L')
+            table = bytes(black if level < 128 else white for level in range(256))
+        imwidth, imheight = image.size
+        if imwidth != self.width or imheight != self.height:
+            raise ValueError('Image must be same dimensions as display \
+                ({0}x{1}).'.format(self.width, self.height))
+        return image.tobytes().translate(table)
+
+    def get_frame_buffers(self, image):
+        """The black and the red frame buffer of an image, 1 bit per pixel each, from a single
+        color_codes pass over the image"""
+        # bit 0 of a code is the pixel in the black plane, bit 1 the one in the red plane
+        codes = self.color_codes(image, black=0b10, red=0b01, white=0b11)
+        return tuple(packing.pack_mask(codes.translate(bit), (self.width, self.height), invert=self.INK_BIT)
+                     for bit in (packing.BIT_0, packing.BIT_1))
 
 
 class EPD4in2b(WaveshareColor):
@@ -80,21 +128,19 @@ class EPD4in2b(WaveshareColor):
         self.send_data(0x0F)  # LUT from OTP
 
     def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
+        return super().get_frame_buffer(image, reverse=reverse)
 
     def display_frame(self, frame_buffer_black, *args):
         frame_buffer_red = args[0] if args else None
         if frame_buffer_black:
             self.send_command(self.DATA_START_TRANSMISSION_1)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer_black[i])
+            self.send_data_bulk(frame_buffer_black)
             self.delay_ms(2)
         if frame_buffer_red:
             self.send_command(self.DATA_START_TRANSMISSION_2)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer_red[i])
+            self.send_data_bulk(frame_buffer_red)
             self.delay_ms(2)
 
         self.send_command(self.DISPLAY_REFRESH)
@@ -113,6 +159,9 @@ class EPD4in2b(WaveshareColor):
 class EPD7in5b(WaveshareColor):
     """Waveshare 7.5" B - black / white / red"""
 
+    # the original frame buffer of this panel turned gray into red
+    GRAY_TO_RED = True
+
     IMAGE_PROCESS = 0x13
     LUT_BLUE = 0x21
     LUT_GRAY_1 = 0x23
@@ -129,6 +178,12 @@ class EPD7in5b(WaveshareColor):
     TCON_RESOLUTION = 0x61
     TEMPERATURE_CALIBRATION = 0x41
 
+    # the controller takes 4 bits per pixel: black, red, white
+    FRAME_COLORS = (0x0, 0x4, 0x3)
+    # 2 bits per pixel frame buffer byte -> 2 bytes of 2 pixels with 4 bits each,
+    # anything but black (0b00) and white (0b11) shows red
+    FRAME_TABLES = packing.expansion_tables((0x0, 0x4, 0x4, 0x3), bpp_in=2, bpp_out=4)
+
     def __init__(self):
         super().__init__(name='7.5" B', width=640, height=384)
 
@@ -167,56 +222,27 @@ class EPD7in5b(WaveshareColor):
         self.send_data(0x03)
 
     def get_frame_buffer(self, image, reverse=False):
-        buf = [0x00] * int(self.width * self.height / 4)
-        # Set buffer to value of Python Imaging Library image.
-        # Image must be in mode L.
-        image_grayscale = image.convert('L')
-        imwidth, imheight = image_grayscale.size
-        if imwidth != self.width or imheight != self.height:
-            raise ValueError('Image must be same dimensions as display \
-                ({0}x{1}).'.format(self.width, self.height))
+        # 2 bits per pixel: 0b00 black, 0b01 red, 0b11 white
+        return packing.pack_codes(self.color_codes(image, 0x0, 0x1, 0x3), bpp=2)
 
-        pixels = image_grayscale.load()
-        for y in range(self.height):
-            for x in range(self.width):
-                # Set the bits for the column of pixels at the current position.
-                if pixels[x, y] < 64:  # black
-                    buf[int((x + y * self.width) / 4)] &= ~(0xC0 >> (x % 4 * 2))
-                elif pixels[x, y] < 192:  # convert gray to red
-                    buf[int((x + y * self.width) / 4)] &= ~(0xC0 >> (x % 4 * 2))
-                    buf[int((x + y * self.width) / 4)] |= 0x40 >> (x % 4 * 2)
-                else:  # white
-                    buf[int((x + y * self.width) / 4)] |= 0xC0 >> (x % 4 * 2)
-        return buf
+    def get_frame_data(self, image):
+        """The controller byte stream for an image in one pass, without the 2 bits per pixel frame buffer"""
+        return packing.pack_codes(self.color_codes(image, *self.FRAME_COLORS), bpp=4)
 
     def display_frame(self, frame_buffer, *args):
+        self.display_frame_data(packing.expand(frame_buffer, self.FRAME_TABLES))
+
+    def display_frame_data(self, data):
         self.send_command(self.DATA_START_TRANSMISSION_1)
-        for i in range(0, int(self.width / 4 * self.height)):
-            temp1 = frame_buffer[i]
-            j = 0
-            while j < 4:
-                if (temp1 & 0xC0) == 0xC0:
-                    temp2 = 0x03
-                elif (temp1 & 0xC0) == 0x00:
-                    temp2 = 0x00
-                else:
-                    temp2 = 0x04
-                temp2 = (temp2 << 4) & 0xFF
-                temp1 = (temp1 << 2) & 0xFF
-                j += 1
-                if (temp1 & 0xC0) == 0xC0:
-                    temp2 |= 0x03
-                elif (temp1 & 0xC0) == 0x00:
-                    temp2 |= 0x00
-                else:
-                    temp2 |= 0x04
-                temp1 = (temp1 << 2) & 0xFF
-                self.send_data(temp2)
-                j += 1
+        self.send_data_bulk(data)
         self.send_command(self.DISPLAY_REFRESH)
         self.delay_ms(100)
         self.wait_until_idle()
 
+    def draw(self, x, y, image):
+        """Display an image - this module does not support partial refresh: x, y are ignored"""
+        self.display_frame_data(self.get_frame_data(image))
+
     def sleep(self):
         self.send_command(self.POWER_OFF)
         self.wait_until_idle()
@@ -313,37 +339,19 @@ class EPD5in83b(EPD5in83):
         self.send_data(0x03)
 
     def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
+        return super().get_frame_buffer(image, reverse=reverse)
+
+    def merge_frame_buffers(self, frame_buffer_black, frame_buffer_red):
+        """The controller byte stream for a black and a red frame buffer - red wins"""
+        size = (self.width, self.height)
+        black, red, white = self.FRAME_COLORS
+        codes = Image.new('L', size, white)
+        for frame_buffer, color in ((frame_buffer_black, black), (frame_buffer_red, red)):
+            if frame_buffer:
+                ink = frame_buffer if self.INK_BIT else packing.invert(frame_buffer)
+                codes.paste(color, mask=Image.frombytes('1', size, bytes(ink)))
+        return packing.pack_codes(codes.tobytes(), bpp=4)
 
     def display_frame(self, frame_buffer_black, *args):
         frame_buffer_red = args[0] if args else None
-        self.send_command(self.DATA_START_TRANSMISSION_1)
-        for i in range(0, int(self.width / 8 * self.height)):
-            temp1 = frame_buffer_black[i]
-            temp2 = frame_buffer_red[i]
-            j = 0
-            while j < 8:
-                if (temp2 & 0x80) == 0x00:
-                    temp3 = 0x04  # red
-                elif (temp1 & 0x80) == 0x00:
-                    temp3 = 0x00  # black
-                else:
-                    temp3 = 0x03  # white
-
-                temp3 = (temp3 << 4) & 0xFF
-                temp1 = (temp1 << 1) & 0xFF
-                temp2 = (temp2 << 1) & 0xFF
-                j += 1
-                if (temp2 & 0x80) == 0x00:
-                    temp3 |= 0x04  # red
-                elif (temp1 & 0x80) == 0x00:
-                    temp3 |= 0x00  # black
-                else:
-                    temp3 |= 0x03  # white
-                temp1 = (temp1 << 1) & 0xFF
-                temp2 = (temp2 << 1) & 0xFF
-                self.send_data(temp3)
-                j += 1
-        self.send_command(self.DISPLAY_REFRESH)
-        self.delay_ms(100)
-        self.wait_until_idle()
+        self.display_frame_data(self.merge_frame_buffers(frame_buffer_black, frame_buffer_red))
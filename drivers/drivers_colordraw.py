@@ -15,6 +15,7 @@
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from PIL import Image, ImageDraw
+from drivers import packing
 from drivers.drivers_color import WaveshareColor
 
 
@@ -34,6 +35,13 @@ class WaveshareColorDraw(WaveshareColor):
     READ_OTP_DATA = 0xA2
     VCOM_VALUE = 0x81
 
+    # rotation -> transpose that turns an image in that rotation into the panel orientation
+    ROTATE_TRANSPOSE = {
+        WaveshareColor.ROTATE_90: Image.ROTATE_270,
+        WaveshareColor.ROTATE_180: Image.ROTATE_180,
+        WaveshareColor.ROTATE_270: Image.ROTATE_90,
+    }
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.colors = 3
@@ -41,6 +49,8 @@ class WaveshareColorDraw(WaveshareColor):
         # the rotation aware algorithms refer to and swap the screen dimensions, so set them here
         self.EPD_WIDTH = kwargs['width']
         self.EPD_HEIGHT = kwargs['height']
+        # (xx, xy, x0, yx, yy, y0): absolute x = xx * x + xy * y + x0, absolute y = yx * x + yy * y + y0
+        self.rotate_transform = (1, 0, 0, 0, 1, 0)
 
     # EPD1in54b and EPD1in54c use 0x17
     # EPD2in13b and EPD2in9b use 0x37
@@ -63,18 +73,22 @@ class WaveshareColorDraw(WaveshareColor):
             self.rotate = self.ROTATE_0
             self.width = self.EPD_WIDTH
             self.height = self.EPD_HEIGHT
+            self.rotate_transform = (1, 0, 0, 0, 1, 0)
         elif rotate == self.ROTATE_90:
             self.rotate = self.ROTATE_90
             self.width = self.EPD_HEIGHT
             self.height = self.EPD_WIDTH
+            self.rotate_transform = (0, -1, self.EPD_WIDTH - 1, 1, 0, 0)
         elif rotate == self.ROTATE_180:
             self.rotate = self.ROTATE_180
             self.width = self.EPD_WIDTH
             self.height = self.EPD_HEIGHT
+            self.rotate_transform = (-1, 0, self.EPD_WIDTH - 1, 0, -1, self.EPD_HEIGHT - 1)
         elif rotate == self.ROTATE_270:
             self.rotate = self.ROTATE_270
             self.width = self.EPD_HEIGHT
             self.height = self.EPD_WIDTH
+            self.rotate_transform = (0, 1, 0, -1, 0, self.EPD_HEIGHT - 1)
 
     # this variant is for EPD1in54c, EPD2in13b and EPD2in9b - EPD1in54b and EPD2in7b override it
     def display_frame(self, frame_buffer_black, *args):
@@ -82,14 +96,12 @@ class WaveshareColorDraw(WaveshareColor):
         if frame_buffer_black:
             self.send_command(self.DATA_START_TRANSMISSION_1)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer_black[i])
+            self.send_data_bulk(frame_buffer_black)
             self.delay_ms(2)
         if frame_buffer_red:
             self.send_command(self.DATA_START_TRANSMISSION_2)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer_red[i])
+            self.send_data_bulk(frame_buffer_red)
             self.delay_ms(2)
 
         self.send_command(self.DISPLAY_REFRESH)
@@ -98,32 +110,24 @@ class WaveshareColorDraw(WaveshareColor):
     # for EPD154* - override elsewhere
     def set_lut_bw(self):
         self.send_command(0x20)  # vcom
-        for count in range(0, 15):
-            self.send_data(self.lut_vcom0[count])
+        self.send_data_bulk(self.lut_vcom0)
         self.send_command(0x21)  # ww --
-        for count in range(0, 15):
-            self.send_data(self.lut_w[count])
+        self.send_data_bulk(self.lut_w)
         self.send_command(0x22)  # bw r
-        for count in range(0, 15):
-            self.send_data(self.lut_b[count])
+        self.send_data_bulk(self.lut_b)
         self.send_command(0x23)  # wb w
-        for count in range(0, 15):
-            self.send_data(self.lut_g1[count])
+        self.send_data_bulk(self.lut_g1)
         self.send_command(0x24)  # bb b
-        for count in range(0, 15):
-            self.send_data(self.lut_g2[count])
+        self.send_data_bulk(self.lut_g2)
 
     # for EPD154* - override elsewhere
     def set_lut_red(self):
         self.send_command(0x25)
-        for count in range(0, 15):
-            self.send_data(self.lut_vcom1[count])
+        self.send_data_bulk(self.lut_vcom1)
         self.send_command(0x26)
-        for count in range(0, 15):
-            self.send_data(self.lut_red0[count])
+        self.send_data_bulk(self.lut_red0)
         self.send_command(0x27)
-        for count in range(0, 15):
-            self.send_data(self.lut_red1[count])
+        self.send_data_bulk(self.lut_red1)
 
     # these LUTs are for EPD154* - override in 2.7"
     lut_vcom0 = [
@@ -166,37 +170,64 @@ class WaveshareColorDraw(WaveshareColor):
         0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
     ]
 
+    def new_frame_buffer(self, colored=False):
+        """A frame buffer for the drawing methods, 1 bit per pixel in the panel orientation"""
+        return bytearray((0xFF if bool(colored) == bool(self.INK_BIT) else 0x00,)) * (self.EPD_WIDTH * self.EPD_HEIGHT // 8)
+
+    def to_absolute(self, x, y):
+        """Rotated (x, y) -> (x, y) in the panel orientation"""
+        xx, xy, x0, yx, yy, y0 = self.rotate_transform
+        return xx * x + xy * y + x0, yx * x + yy * y + y0
+
     def set_pixel(self, frame_buffer, x, y, colored):
         if x < 0 or x >= self.width or y < 0 or y >= self.height:
             return
-        if self.rotate == self.ROTATE_0:
-            self.set_absolute_pixel(frame_buffer, x, y, colored)
-        elif self.rotate == self.ROTATE_90:
-            point_temp = x
-            x = self.EPD_WIDTH - y
-            y = point_temp
-            self.set_absolute_pixel(frame_buffer, x, y, colored)
-        elif self.rotate == self.ROTATE_180:
-            x = self.EPD_WIDTH - x
-            y = self.EPD_HEIGHT - y
-            self.set_absolute_pixel(frame_buffer, x, y, colored)
-        elif self.rotate == self.ROTATE_270:
-            point_temp = x
-            x = y
-            y = self.EPD_HEIGHT - point_temp
-            self.set_absolute_pixel(frame_buffer, x, y, colored)
-
-    # overridden in EPD2in7b
-    def set_absolute_pixel(self, frame_buffer, x, y, colored, reverse=False):
+        self.set_absolute_pixel(frame_buffer, *self.to_absolute(x, y), colored)
+
+    def set_absolute_pixel(self, frame_buffer, x, y, colored, reverse=None):
         # To avoid display orientation effects
         # use EPD_WIDTH instead of self.width
         # use EPD_HEIGHT instead of self.height
         if x < 0 or x >= self.EPD_WIDTH or y < 0 or y >= self.EPD_HEIGHT:
             return
+        if reverse is None:
+            reverse = self.INK_BIT
         if not colored if reverse else colored:
-            frame_buffer[(x + y * self.EPD_WIDTH) / 8] &= ~(0x80 >> (x % 8))
+            frame_buffer[(x + y * self.EPD_WIDTH) // 8] &= ~(0x80 >> (x % 8))
         else:
-            frame_buffer[(x + y * self.EPD_WIDTH) / 8] |= 0x80 >> (x % 8)
+            frame_buffer[(x + y * self.EPD_WIDTH) // 8] |= 0x80 >> (x % 8)
+
+    def fill_rectangle(self, frame_buffer, x0, y0, x1, y1, colored):
+        """Fill the rotated rectangle from (x0, y0) to (x1, y1), both included.
+        Rows of the panel are set with slice assignment, single columns with a translate."""
+        x0, x1 = max(min(x0, x1), 0), min(max(x0, x1), self.width - 1)
+        y0, y1 = max(min(y0, y1), 0), min(max(y0, y1), self.height - 1)
+        if x0 > x1 or y0 > y1:
+            return
+        (ax0, ay0), (ax1, ay1) = self.to_absolute(x0, y0), self.to_absolute(x1, y1)
+        ax0, ax1 = min(ax0, ax1), max(ax0, ax1)
+        ay0, ay1 = min(ay0, ay1), max(ay0, ay1)
+        set_bits = bool(colored) == bool(self.INK_BIT)
+        stride = self.EPD_WIDTH // 8
+        first, last = ax0 // 8, ax1 // 8
+        if first == last:
+            # a column of bytes, one translate for all of them
+            mask = (0xFF >> (ax0 % 8)) & (0xFF << (7 - ax1 % 8))
+            table = bytes(value | mask if set_bits else value & ~mask for value in range(256))
+            span = slice(ay0 * stride + first, ay1 * stride + first + 1, stride)
+            frame_buffer[span] = bytes(frame_buffer[span]).translate(table)
+            return
+        left_mask = 0xFF >> (ax0 % 8)
+        right_mask = (0xFF << (7 - ax1 % 8)) & 0xFF
+        middle = bytes((0xFF if set_bits else 0x00,)) * (last - first - 1)
+        for row in range(ay0 * stride, ay1 * stride + 1, stride):
+            if set_bits:
+                frame_buffer[row + first] |= left_mask
+                frame_buffer[row + last] |= right_mask
+            else:
+                frame_buffer[row + first] &= ~left_mask
+                frame_buffer[row + last] &= ~right_mask
+            frame_buffer[row + first + 1:row + last] = middle
 
     def draw_circle(self, frame_buffer, x, y, radius, colored):
         # Bresenham algorithm
@@ -224,45 +255,56 @@ class WaveshareColorDraw(WaveshareColor):
 
     # this only appears in EPD1in54b and EPD1in54c source
     def display_string_at(self, frame_buffer, x, y, text, font, colored):
+        """Render the text into a mask and blit it into the frame buffer in one paste"""
         image = Image.new('1', (self.width, self.height))
         draw = ImageDraw.Draw(image)
         draw.text((x, y), text, font=font, fill=255)
-        # Set buffer to value of Python Imaging Library image.
-        # Image must be in mode 1.
-        pixels = image.load()
-        for y in range(self.height):
-            for x in range(self.width):
-                # Set the bits for the column of pixels at the current position.
-                if pixels[x, y] != 0:
-                    self.set_pixel(frame_buffer, x, y, colored)
+        box = image.getbbox()
+        if box is None:
+            return
+        mask = image.crop(box)
+        if self.rotate in self.ROTATE_TRANSPOSE:
+            mask = mask.transpose(self.ROTATE_TRANSPOSE[self.rotate])
+        corners = [self.to_absolute(box[0], box[1]), self.to_absolute(box[2] - 1, box[3] - 1)]
+        origin = (min(corner[0] for corner in corners), min(corner[1] for corner in corners))
+        size = (self.EPD_WIDTH, self.EPD_HEIGHT)
+        frame = Image.frombytes('1', size, bytes(frame_buffer))
+        frame.paste(255 if bool(colored) == bool(self.INK_BIT) else 0, origin, mask=mask)
+        frame_buffer[:] = frame.tobytes()
 
     # this, on the other hand, appears in the EPD2in7b source - same method, different name
     def draw_string_at(self, frame_buffer, x, y, text, font, colored):
         self.display_string_at(frame_buffer, x, y, text, font, colored)
 
     def draw_line(self, frame_buffer, x0, y0, x1, y1, colored):
+        if x0 == x1 or y0 == y1:
+            self.fill_rectangle(frame_buffer, x0, y0, x1, y1, colored)
+            return
         # Bresenham algorithm
         dx = abs(x1 - x0)
         sx = 1 if x0 < x1 else -1
         dy = -abs(y1 - y0)
         sy = 1 if y0 < y1 else -1
         err = dx + dy
-        while (x0 != x1) and (y0 != y1):
+        while True:
             self.set_pixel(frame_buffer, x0, y0, colored)
-            if 2 * err >= dy:
+            if x0 == x1 and y0 == y1:
+                break
+            e2 = 2 * err
+            if e2 >= dy:
                 err += dy
                 x0 += sx
-            if 2 * err <= dx:
+            if e2 <= dx:
                 err += dx
                 y0 += sy
 
     def draw_horizontal_line(self, frame_buffer, x, y, width, colored):
-        for i in range(x, x + width):
-            self.set_pixel(frame_buffer, i, y, colored)
+        if width > 0:
+            self.fill_rectangle(frame_buffer, x, y, x + width - 1, y, colored)
 
     def draw_vertical_line(self, frame_buffer, x, y, height, colored):
-        for i in range(y, y + height):
-            self.set_pixel(frame_buffer, x, i, colored)
+        if height > 0:
+            self.fill_rectangle(frame_buffer, x, y, x, y + height - 1, colored)
 
     def draw_rectangle(self, frame_buffer, x0, y0, x1, y1, colored):
         min_x = x0 if x1 > x0 else x1
@@ -275,12 +317,7 @@ class WaveshareColorDraw(WaveshareColor):
         self.draw_vertical_line(frame_buffer, max_x, min_y, max_y - min_y + 1, colored)
 
     def draw_filled_rectangle(self, frame_buffer, x0, y0, x1, y1, colored):
-        min_x = x0 if x1 > x0 else x1
-        max_x = x1 if x1 > x0 else x0
-        min_y = y0 if y1 > y0 else y1
-        max_y = y1 if y1 > y0 else y0
-        for i in range(min_x, max_x + 1):
-            self.draw_vertical_line(frame_buffer, i, min_y, max_y - min_y + 1, colored)
+        self.fill_rectangle(frame_buffer, x0, y0, x1, y1, colored)
 
     def draw_filled_circle(self, frame_buffer, x, y, radius, colored):
         # Bresenham algorithm
@@ -290,10 +327,6 @@ class WaveshareColorDraw(WaveshareColor):
         if x >= self.width or y >= self.height:
             return
         while True:
-            self.set_pixel(frame_buffer, x - x_pos, y + y_pos, colored)
-            self.set_pixel(frame_buffer, x + x_pos, y + y_pos, colored)
-            self.set_pixel(frame_buffer, x + x_pos, y - y_pos, colored)
-            self.set_pixel(frame_buffer, x - x_pos, y - y_pos, colored)
             self.draw_horizontal_line(frame_buffer, x + x_pos, y + y_pos, 2 * (-x_pos) + 1, colored)
             self.draw_horizontal_line(frame_buffer, x + x_pos, y - y_pos, 2 * (-x_pos) + 1, colored)
             e2 = err
@@ -316,6 +349,9 @@ class EPD1in54b(WaveshareColorDraw):
     TCON_RESOLUTION = 0x61
     TEMPERATURE_SENSOR_CALIBRATION = 0x41
 
+    # the black plane goes out with 2 bits per pixel: 0x3 for a set bit
+    BLACK_TABLES = packing.expansion_tables((0x0, 0x3), bpp_in=1, bpp_out=2)
+
     def __init__(self):
         super().__init__(name='1.54" B', width=200, height=200)
 
@@ -354,30 +390,19 @@ class EPD1in54b(WaveshareColorDraw):
         return 0
 
     def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
+        return super().get_frame_buffer(image, reverse=reverse)
 
     def display_frame(self, frame_buffer_black, *args):
         frame_buffer_red = args[0] if args else None
         if frame_buffer_black:
             self.send_command(self.DATA_START_TRANSMISSION_1)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                temp = 0x00
-                for bit in range(0, 4):
-                    if frame_buffer_black[i] & (0x80 >> bit) != 0:
-                        temp |= 0xC0 >> (bit * 2)
-                self.send_data(temp)
-                temp = 0x00
-                for bit in range(4, 8):
-                    if frame_buffer_black[i] & (0x80 >> bit) != 0:
-                        temp |= 0xC0 >> ((bit - 4) * 2)
-                self.send_data(temp)
+            self.send_data_bulk(packing.expand(frame_buffer_black, self.BLACK_TABLES))
             self.delay_ms(2)
         if frame_buffer_red:
             self.send_command(self.DATA_START_TRANSMISSION_2)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer_red[i])
+            self.send_data_bulk(frame_buffer_red)
             self.delay_ms(2)
 
         self.send_command(self.DISPLAY_REFRESH)
@@ -430,7 +455,7 @@ class EPD1in54c(WaveshareColorDraw):
         return 0
 
     def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
+        return super().get_frame_buffer(image, reverse=reverse)
 
 
 class EPD2in13b(WaveshareColorDraw):
@@ -472,7 +497,7 @@ class EPD2in13b(WaveshareColorDraw):
         self.send_data(0xD4)
 
     def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
+        return super().get_frame_buffer(image, reverse=reverse)
 
     def sleep(self, sleepbyte=0x37):
         super().sleep(sleepbyte=sleepbyte)
@@ -492,6 +517,9 @@ class EPD2in7b(WaveshareColorDraw):
     TCON_RESOLUTION = 0x61
     TEMPERATURE_SENSOR_CALIBRATION = 0x41
 
+    # set bits are black / red
+    INK_BIT = 1
+
     lut_vcom_dc = [
         0x00, 0x00,
         0x00, 0x1A, 0x1A, 0x00, 0x00, 0x01,
@@ -615,27 +643,22 @@ class EPD2in7b(WaveshareColorDraw):
 
     def set_lut(self):
         self.send_command(self.LUT_FOR_VCOM)  # vcom
-        for count in range(0, 44):
-            self.send_data(self.lut_vcom_dc[count])
+        self.send_data_bulk(self.lut_vcom_dc)
 
         self.send_command(self.LUT_WHITE_TO_WHITE)  # ww --
-        for count in range(0, 42):
-            self.send_data(self.lut_ww[count])
+        self.send_data_bulk(self.lut_ww)
 
         self.send_command(self.LUT_BLACK_TO_WHITE)  # bw r
-        for count in range(0, 42):
-            self.send_data(self.lut_bw[count])
+        self.send_data_bulk(self.lut_bw)
 
         self.send_command(self.LUT_WHITE_TO_BLACK)  # wb w
-        for count in range(0, 42):
-            self.send_data(self.lut_bb[count])
+        self.send_data_bulk(self.lut_bb)
 
         self.send_command(self.LUT_BLACK_TO_BLACK)  # bb b
-        for count in range(0, 42):
-            self.send_data(self.lut_wb[count])
+        self.send_data_bulk(self.lut_wb)
 
     def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
+        return super().get_frame_buffer(image, reverse=reverse)
 
     def display_frame(self, frame_buffer_black, *args):
         frame_buffer_red = args[0] if args else None
@@ -648,22 +671,17 @@ class EPD2in7b(WaveshareColorDraw):
         if frame_buffer_black:
             self.send_command(self.DATA_START_TRANSMISSION_1)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer_black[i])
+            self.send_data_bulk(frame_buffer_black)
             self.delay_ms(2)
         if frame_buffer_red:
             self.send_command(self.DATA_START_TRANSMISSION_2)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer_red[i])
+            self.send_data_bulk(frame_buffer_red)
             self.delay_ms(2)
 
         self.send_command(self.DISPLAY_REFRESH)
         self.wait_until_idle()
 
-    def set_absolute_pixel(self, frame_buffer, x, y, colored, reverse=True):
-        super().set_absolute_pixel(frame_buffer, x, y, colored, reverse=reverse)
-
     # After this command is transmitted, the chip would enter the deep-sleep
     # mode to save power. The deep sleep mode would return to standby by
     # hardware reset. The only one parameter is a check code, the command would
@@ -709,7 +727,7 @@ class EPD2in9b(WaveshareColorDraw):
         self.send_data(0x0A)
 
     def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
+        return super().get_frame_buffer(image, reverse=reverse)
 
     def sleep(self, sleepbyte=0x37):
         super().sleep(sleepbyte=sleepbyte)
@@ -15,6 +15,7 @@
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from abc import abstractmethod
+from drivers import packing
 from drivers.drivers_base import WaveshareEPD
 
 
@@ -66,31 +67,23 @@ class WaveshareFull(WaveshareEPD):
         self.display_frame(self.get_frame_buffer(image))
 
     def get_frame_buffer(self, image, reverse=False):
-        buf = [0xFF if reverse else 0x00] * int(self.width * self.height / 8)
+        """Pack the image into a 1 bit per pixel frame buffer, set bits are white pixels.
+        The result doesn't depend on reverse - the original code either set the white bits
+        on a black buffer or cleared the black bits on a white one."""
         # Set buffer to value of Python Imaging Library image.
-        # Image must be in mode 1.
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
+        # Image is converted to mode 1.
+        imwidth, imheight = image.size
         if imwidth != self.width or imheight != self.height:
             raise ValueError('Image must be same dimensions as display \
                 ({0}x{1}).'.format(self.width, self.height))
-
-        pixels = image_monocolor.load()
-        for y in range(self.height):
-            for x in range(self.width):
-                # Set the bits for the column of pixels at the current position.
-                if reverse:
-                    if pixels[x, y] == 0:
-                        buf[int((x + y * self.width) / 8)] &= ~(0x80 >> (x % 8))
-                else:
-                    if pixels[x, y] != 0:
-                        buf[int((x + y * self.width) / 8)] |= (0x80 >> (x % 8))
-        return buf
+        return packing.pack_1bpp(image)
 
 
 class EPD2in7(WaveshareFull):
     """Waveshare 2.7" - monochrome"""
 
+    REFRESH_TIME = 6.0
+
     # EPD2IN7 commands
     ACTIVE_PROGRAM = 0xA1
     DATA_START_TRANSMISSION_2 = 0x13
@@ -228,32 +221,25 @@ class EPD2in7(WaveshareFull):
 
     def set_lut(self):
         self.send_command(self.LUT_FOR_VCOM)  # vcom
-        for count in range(0, 44):
-            self.send_data(self.lut_vcom_dc[count])
+        self.send_data_bulk(self.lut_vcom_dc)
         self.send_command(self.LUT_WHITE_TO_WHITE)  # ww --
-        for count in range(0, 42):
-            self.send_data(self.lut_ww[count])
+        self.send_data_bulk(self.lut_ww)
         self.send_command(self.LUT_BLACK_TO_WHITE)  # bw r
-        for count in range(0, 42):
-            self.send_data(self.lut_bw[count])
+        self.send_data_bulk(self.lut_bw)
         self.send_command(self.LUT_WHITE_TO_BLACK)  # wb w
-        for count in range(0, 42):
-            self.send_data(self.lut_bb[count])
+        self.send_data_bulk(self.lut_bb)
         self.send_command(self.LUT_BLACK_TO_BLACK)  # bb b
-        for count in range(0, 42):
-            self.send_data(self.lut_wb[count])
+        self.send_data_bulk(self.lut_wb)
 
     def display_frame(self, frame_buffer, *args):
         if frame_buffer:
             self.send_command(self.DATA_START_TRANSMISSION_1)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(0xFF)
+            self.send_data_fill(0xFF, int(self.width * self.height / 8))
             self.delay_ms(2)
             self.send_command(self.DATA_START_TRANSMISSION_2)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer[i])
+            self.send_data_bulk(frame_buffer)
             self.delay_ms(2)
             self.send_command(self.DISPLAY_REFRESH)
             self.wait_until_idle()
@@ -368,24 +354,19 @@ class EPD4in2(WaveshareFull):
 
     def set_lut(self):
         self.send_command(self.LUT_FOR_VCOM)  # vcom
-        for count in range(0, 44):
-            self.send_data(self.lut_vcom0[count])
+        self.send_data_bulk(self.lut_vcom0)
 
         self.send_command(self.LUT_WHITE_TO_WHITE)  # ww --
-        for count in range(0, 42):
-            self.send_data(self.lut_ww[count])
+        self.send_data_bulk(self.lut_ww)
 
         self.send_command(self.LUT_BLACK_TO_WHITE)  # bw r
-        for count in range(0, 42):
-            self.send_data(self.lut_bw[count])
+        self.send_data_bulk(self.lut_bw)
 
         self.send_command(self.LUT_WHITE_TO_BLACK)  # wb w
-        for count in range(0, 42):
-            self.send_data(self.lut_bb[count])
+        self.send_data_bulk(self.lut_bb)
 
         self.send_command(self.LUT_BLACK_TO_BLACK)  # bb b
-        for count in range(0, 42):
-            self.send_data(self.lut_wb[count])
+        self.send_data_bulk(self.lut_wb)
 
     def display_frame(self, frame_buffer, *args):
         self.send_command(self.RESOLUTION_SETTING)
@@ -402,12 +383,10 @@ class EPD4in2(WaveshareFull):
 
         if frame_buffer:
             self.send_command(self.DATA_START_TRANSMISSION_1)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(0xFF)  # bit set: white, bit reset: black
+            self.send_data_fill(0xFF, int(self.width * self.height / 8))  # bit set: white, bit reset: black
             self.delay_ms(2)
             self.send_command(self.DATA_START_TRANSMISSION_2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer[i])
+            self.send_data_bulk(frame_buffer)
             self.delay_ms(2)
 
         self.set_lut()
@@ -465,6 +444,9 @@ class EPD7in5(WaveshareFull):
     TEMPERATURE_CALIBRATION = 0x41
     VCM_DC_SETTING = 0x82
 
+    # 1 bit per pixel frame buffer byte -> 4 bytes of 2 pixels with 4 bits each
+    FRAME_TABLES = packing.expansion_tables((0x0, 0x3), bpp_in=1, bpp_out=4)
+
     def __init__(self):
         super().__init__(name='7.5" BW', width=640, height=384)
 
@@ -513,26 +495,13 @@ class EPD7in5(WaveshareFull):
         self.send_command(0xe5)  # FLASH MODE
         self.send_data(0x03)
 
+    def expand_frame_buffer(self, frame_buffer):
+        """The controller takes 4 bits per pixel: 0x3 for white, 0x0 for black"""
+        return packing.expand(frame_buffer, self.FRAME_TABLES)
+
     def display_frame(self, frame_buffer, *args):
         self.send_command(self.DATA_START_TRANSMISSION_1)
-        for i in range(0, 30720):
-            temp1 = frame_buffer[i]
-            j = 0
-            while j < 8:
-                if temp1 & 0x80:
-                    temp2 = 0x03
-                else:
-                    temp2 = 0x00
-                temp2 = (temp2 << 4) & 0xFF
-                temp1 = (temp1 << 1) & 0xFF
-                j += 1
-                if temp1 & 0x80:
-                    temp2 |= 0x03
-                else:
-                    temp2 |= 0x00
-                temp1 = (temp1 << 1) & 0xFF
-                self.send_data(temp2)
-                j += 1
+        self.send_data_bulk(self.expand_frame_buffer(frame_buffer))
         self.send_command(self.DISPLAY_REFRESH)
         self.delay_ms(100)
         self.wait_until_idle()
@@ -595,13 +564,11 @@ class EPD7in5v2(WaveshareFull):
         if frame_buffer:
             self.send_command(self.DATA_START_TRANSMISSION_1)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(0xFF)
+            self.send_data_fill(0xFF, int(self.width * self.height / 8))
             self.delay_ms(2)
             self.send_command(self.DATA_START_TRANSMISSION_2)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(~frame_buffer[i])
+            self.send_data_bulk(packing.invert(frame_buffer))
             self.delay_ms(2)
 
             self.send_command(self.DISPLAY_REFRESH)
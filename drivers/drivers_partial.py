@@ -14,7 +14,12 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from drivers import drivers_base
+import logging
+import time
+
+from PIL import Image
+
+from drivers import drivers_base, packing
 
 
 class WavesharePartial(drivers_base.WaveshareEPD):
@@ -43,6 +48,18 @@ class WavesharePartial(drivers_base.WaveshareEPD):
     WRITE_RAM = 0x24
     WRITE_VCOM_REGISTER = 0x2C
 
+    # nominal seconds of a refresh with the full and the partial LUT
+    REFRESH_TIME = 2.0
+    PARTIAL_REFRESH_TIME = 0.3
+
+    # update mode of draw_regions for a refresh with the full LUT, that clears ghosting
+    UPDATE_MODE_FULL = 1
+
+    # the partial LUT ghosts quickly, Waveshare recommends a full refresh after a few
+    # partial ones
+    GHOSTING_UPDATES = 5
+    GHOSTING_CHANGED = 2.0
+
     # these LUTs are used by 1.54" and 2.9" - 2.13" overrides them
     lut_full_update = [
         0x02, 0x02, 0x01, 0x11, 0x12, 0x12, 0x22, 0x22,
@@ -63,9 +80,24 @@ class WavesharePartial(drivers_base.WaveshareEPD):
         self.supports_partial = True
         self.colors = 2
         self.lut = None
+        # Shadow copies of the controller RAM (packed like get_frame_buffer), None while
+        # unknown. With the partial LUT the controller swaps between two RAM buffers on
+        # every refresh, so there is one per buffer. set_frame_memory only writes the
+        # windows that differ from the shadow; shadow_merge_gap unchanged rows between
+        # changed ones are sent along instead of starting a new window.
+        self.use_shadow = True
+        self.shadows = [None, None]
+        self.shadow_bank = 0
+        self.shadow_merge_gap = 2
+        # Bytes of image data sent and saved by the shadow, in total and for the last frame.
+        self.delta_stats = {"frames": 0, "bytes": 0, "bytes_saved": 0, "last_bytes": 0, "last_bytes_saved": 0}
+        self.frame_bytes = 0
+        self.frame_bytes_saved = 0
 
     def init(self, partial=True):
         self.partial_refresh = partial
+        self.shadows = [None, None]
+        self.shadow_bank = 0
         if self.epd_init() != 0:
             return -1
         # EPD hardware init start
@@ -99,28 +131,17 @@ class WavesharePartial(drivers_base.WaveshareEPD):
         self.lut = lut
         self.send_command(self.WRITE_LUT_REGISTER)
         # the length of look-up table is 30 bytes
-        for i in range(0, len(lut)):
-            self.send_data(self.lut[i])
+        self.send_data_bulk(self.lut)
 
     def get_frame_buffer(self, image):
-        buf = [0x00] * int(self.width * self.height / 8)
         # Set buffer to value of Python Imaging Library image.
-        # Image must be in mode 1.
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
+        # Image is converted to mode 1, set bits are white pixels.
+        imwidth, imheight = image.size
         if imwidth != self.width or imheight != self.height:
             raise ValueError('Image must be same dimensions as display \
                 ({0}x{1}).'.format(self.width, self.height))
+        return packing.pack_1bpp(image)
 
-        pixels = image_monocolor.load()
-        for y in range(self.height):
-            for x in range(self.width):
-                # Set the bits for the column of pixels at the current position.
-                if pixels[x, y] != 0:
-                    buf[int((x + y * self.width) / 8)] |= 0x80 >> (x % 8)
-        return buf
-
-    # this differs with 2.13" but is the same for 1.54" and 2.9"
     def set_frame_memory(self, image, x, y):
         if image is None or x < 0 or y < 0:
             return
@@ -137,29 +158,57 @@ class WavesharePartial(drivers_base.WaveshareEPD):
             y_end = self.height - 1
         else:
             y_end = y + image_height - 1
+        # 1 byte = 8 pixels
+        data = packing.pack_1bpp(image_monocolor.crop((0, 0, x_end - x + 1, y_end - y + 1)))
+        region_width = x_end - x + 1
+        row_bytes = region_width // 8
+        rows = y_end - y + 1
+        shadow = self.shadows[self.shadow_bank] if self.use_shadow else None
+        if shadow is None:
+            windows = [(0, rows, 0, row_bytes)]
+        else:
+            old = packing.extract_window(shadow, self.width, x, y, x_end + 1, y_end + 1)
+            windows = packing.changed_windows(old, data, row_bytes, self.shadow_merge_gap)
+        sent = 0
+        for first_row, end_row, first_byte, end_byte in windows:
+            window = packing.extract_window(data, region_width, first_byte * 8, first_row, end_byte * 8, end_row)
+            self.write_window(x + first_byte * 8, y + first_row, x + end_byte * 8 - 1, y + end_row - 1, window)
+            sent += len(window)
+        self.frame_bytes += sent
+        self.frame_bytes_saved += len(data) - sent
+        self.update_shadow(data, x, y, x_end, y_end)
+
+    def write_window(self, x, y, x_end, y_end, data):
+        """Write the bytes of the window from (x, y) to (x_end, y_end), both included, to the RAM"""
         self.set_memory_area(x, y, x_end, y_end)
         self.set_memory_pointer(x, y)
         self.send_command(self.WRITE_RAM)
-        # send the image data
-        pixels = image_monocolor.load()
-        byte_to_send = 0x00
-        for j in range(0, y_end - y + 1):
-            # 1 byte = 8 pixels, steps of i = 8
-            for i in range(0, x_end - x + 1):
-                # Set the bits for the column of pixels at the current position.
-                if pixels[i, j] != 0:
-                    byte_to_send |= 0x80 >> (i % 8)
-                if i % 8 == 7:
-                    self.send_data(byte_to_send)
-                    byte_to_send = 0x00
+        self.send_data_bulk(data)
+
+    def update_shadow(self, data, x, y, x_end, y_end):
+        """Record a write of the packed window to the RAM in the shadow copy, a shadow
+        becomes known with the first write of the whole screen"""
+        if not self.use_shadow:
+            return
+        stride = self.width // 8
+        if x == 0 and y == 0 and x_end == self.width - 1 and y_end == self.height - 1:
+            self.shadows[self.shadow_bank] = bytearray(data)
+            return
+        shadow = self.shadows[self.shadow_bank]
+        if shadow is None:
+            return
+        row_bytes = (x_end - x + 1) // 8
+        for row in range(y_end - y + 1):
+            start = (y + row) * stride + x // 8
+            shadow[start:start + row_bytes] = data[row * row_bytes:(row + 1) * row_bytes]
 
     def clear_frame_memory(self, color):
         self.set_memory_area(0, 0, self.width - 1, self.height - 1)
         self.set_memory_pointer(0, 0)
         self.send_command(self.WRITE_RAM)
         # send the color data
-        for i in range(0, int(self.width / 8 * self.height)):
-            self.send_data(color)
+        self.send_data_fill(color, int(self.width / 8 * self.height))
+        self.update_shadow(bytes((color,)) * int(self.width / 8 * self.height), 0, 0, self.width - 1, self.height - 1)
 
     def display_frame(self):
         self.send_command(self.DISPLAY_UPDATE_CONTROL_2)
@@ -167,6 +216,19 @@ class WavesharePartial(drivers_base.WaveshareEPD):
         self.send_command(self.MASTER_ACTIVATION)
         self.send_command(self.TERMINATE_FRAME_READ_WRITE)
         self.wait_until_idle()
+        if self.partial_refresh:
+            self.shadow_bank = 1 - self.shadow_bank
+        self.record_frame()
+
+    def record_frame(self):
+        stats = self.delta_stats
+        stats["frames"] += 1
+        stats["bytes"] += self.frame_bytes
+        stats["bytes_saved"] += self.frame_bytes_saved
+        stats["last_bytes"], stats["last_bytes_saved"] = self.frame_bytes, self.frame_bytes_saved
+        logging.debug("Frame %d: %d bytes of image data sent, %d saved by the shadow" % (
+            stats["frames"], self.frame_bytes, self.frame_bytes_saved))
+        self.frame_bytes = self.frame_bytes_saved = 0
 
     def set_memory_area(self, x_start, y_start, x_end, y_end):
         self.send_command(self.SET_RAM_X_ADDRESS_START_END_POSITION)
@@ -201,6 +263,39 @@ class WavesharePartial(drivers_base.WaveshareEPD):
             self.set_frame_memory(image, x, y)
             self.display_frame()
 
+    def capabilities(self):
+        modes = (None, self.UPDATE_MODE_FULL)
+        if not self.partial_refresh:
+            return drivers_base.Capabilities(partial=True, alignment={1: 8}, modes=modes,
+                                             full_mode=self.UPDATE_MODE_FULL, frame_cost=self.REFRESH_TIME,
+                                             bytes_per_second=self.SPI_SPEED_HZ / 8)
+        # all regions share the two refreshes, but are written twice
+        return drivers_base.Capabilities(partial=True, alignment={1: 8}, modes=modes,
+                                         full_mode=self.UPDATE_MODE_FULL, frame_cost=2 * self.PARTIAL_REFRESH_TIME,
+                                         region_cost=0.001, bytes_per_second=self.SPI_SPEED_HZ / 8 / 2)
+
+    def draw_regions(self, regions):
+        """Replace several areas on the display with one refresh (two with the partial LUT).
+        The refresh time is split evenly between the regions in the returned timings.
+
+        If a region has UPDATE_MODE_FULL, the first refresh uses the full LUT - for all the
+        regions - and the second one, with the partial LUT again, only fills the other RAM
+        buffer like after init."""
+        timings = [0.0] * len(regions)
+        full = self.partial_refresh and any(mode == self.UPDATE_MODE_FULL for _, _, _, mode in regions)
+        for refresh_pass in range(2 if self.partial_refresh else 1):
+            if full:
+                self.set_lut(self.lut_full_update if refresh_pass == 0 else self.lut_partial_update)
+            for index, (x, y, image, mode) in enumerate(regions):
+                start = time.monotonic()
+                self.set_frame_memory(image, x, y)
+                timings[index] += time.monotonic() - start
+            start = time.monotonic()
+            self.display_frame()
+            refresh = (time.monotonic() - start) / max(len(regions), 1)
+            timings = [timing + refresh for timing in timings]
+        return timings
+
 
 class EPD1in54(WavesharePartial):
     """Waveshare 1.54" - monochrome"""
@@ -230,37 +325,15 @@ class EPD2in13(WavesharePartial):
         # the actual pixel width is 122, but 128 is the 'logical' width
         super().__init__(name='2.13" BW', width=128, height=250)
 
-    def set_frame_memory(self, image, x, y):
-        if image is None or x < 0 or y < 0:
-            return
-        image_monocolor = image.convert('1')
-        image_width, image_height = image_monocolor.size
-        # x point must be the multiple of 8 or the last 3 bits will be ignored
-        x = x & 0xF8
-        image_width = image_width & 0xF8
-        if x + image_width >= self.width:
-            x_end = self.width - 1
-        else:
-            x_end = x + image_width - 1
-        if y + image_height >= self.height:
-            y_end = self.height - 1
-        else:
-            y_end = y + image_height - 1
+    def write_window(self, x, y, x_end, y_end, data):
+        # the RAM pointer is set for every row
         self.set_memory_area(x, y, x_end, y_end)
-        # send the image data
-        pixels = image_monocolor.load()
-        byte_to_send = 0x00
+        row_bytes = (x_end - x + 1) // 8
+        rows = memoryview(data)
         for j in range(y, y_end + 1):
             self.set_memory_pointer(x, j)
             self.send_command(self.WRITE_RAM)
-            # 1 byte = 8 pixels, steps of i = 8
-            for i in range(x, x_end + 1):
-                # Set the bits for the column of pixels at the current position.
-                if pixels[i - x, j - y] != 0:
-                    byte_to_send |= 0x80 >> (i % 8)
-                if i % 8 == 7:
-                    self.send_data(byte_to_send)
-                    byte_to_send = 0x00
+            self.send_data_bulk(rows[(j - y) * row_bytes:(j - y + 1) * row_bytes])
 
 
 class EPD2in13v2(WavesharePartial):
@@ -322,6 +395,8 @@ class EPD2in13d(WavesharePartial):
 
     def __init__(self):
         super().__init__(name='2.13" D', width=104, height=212)
+        # the whole picture, for the bytes around a partial window that isn't byte aligned
+        self.frame = Image.new('1', (self.width, self.height), 255)
 
     lut_vcomDC = [
         0x00, 0x08, 0x00, 0x00, 0x00, 0x02,
@@ -432,6 +507,7 @@ class EPD2in13d(WavesharePartial):
             self.delay_ms(100)
 
     def init(self, **kwargs):
+        self.partial_refresh = kwargs.get('partial', True)
         if self.epd_init() != 0:
             return -1
         self.reset()
@@ -477,20 +553,15 @@ class EPD2in13d(WavesharePartial):
         self.send_data(0xb7)
 
         self.send_command(0x20)  # vcom
-        for count in range(0, 44):
-            self.send_data(self.lut_vcomDC[count])
+        self.send_data_bulk(self.lut_vcomDC)
         self.send_command(0x21)  # ww --
-        for count in range(0, 42):
-            self.send_data(self.lut_ww[count])
+        self.send_data_bulk(self.lut_ww)
         self.send_command(0x22)  # bw r
-        for count in range(0, 42):
-            self.send_data(self.lut_bw[count])
+        self.send_data_bulk(self.lut_bw)
         self.send_command(0x23)  # wb w
-        for count in range(0, 42):
-            self.send_data(self.lut_wb[count])
+        self.send_data_bulk(self.lut_wb)
         self.send_command(0x24)  # bb b
-        for count in range(0, 42):
-            self.send_data(self.lut_bb[count])
+        self.send_data_bulk(self.lut_bb)
 
     def set_part_reg(self):
         self.send_command(0x82)
@@ -499,20 +570,15 @@ class EPD2in13d(WavesharePartial):
         self.send_data(0x47)
 
         self.send_command(0x20)  # vcom
-        for count in range(0, 44):
-            self.send_data(self.lut_vcom1[count])
+        self.send_data_bulk(self.lut_vcom1)
         self.send_command(0x21)  # ww --
-        for count in range(0, 42):
-            self.send_data(self.lut_ww1[count])
+        self.send_data_bulk(self.lut_ww1)
         self.send_command(0x22)  # bw r
-        for count in range(0, 42):
-            self.send_data(self.lut_bw1[count])
+        self.send_data_bulk(self.lut_bw1)
         self.send_command(0x23)  # wb w
-        for count in range(0, 42):
-            self.send_data(self.lut_wb1[count])
+        self.send_data_bulk(self.lut_wb1)
         self.send_command(0x24)  # bb b
-        for count in range(0, 42):
-            self.send_data(self.lut_bb1[count])
+        self.send_data_bulk(self.lut_bb1)
 
     def turn_on_display(self):
         self.send_command(0x12)
@@ -520,14 +586,13 @@ class EPD2in13d(WavesharePartial):
         self.wait_until_idle()
 
     def clear(self):
+        self.frame = Image.new('1', (self.width, self.height), 255)
         self.send_command(0x10)
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(0x00)
+        self.send_data_fill(0x00, int(self.width * self.height / 8))
         self.delay_ms(10)
 
         self.send_command(0x13)
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(0xFF)
+        self.send_data_fill(0xFF, int(self.width * self.height / 8))
         self.delay_ms(10)
 
         self.set_full_reg()
@@ -538,21 +603,24 @@ class EPD2in13d(WavesharePartial):
             return
 
         self.send_command(0x10)
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(0x00)
+        self.send_data_fill(0x00, int(self.width * self.height / 8))
         self.delay_ms(10)
 
         self.send_command(0x13)
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(frame_buffer[i])
+        self.send_data_bulk(frame_buffer)
         self.delay_ms(10)
 
         self.set_full_reg()
         self.turn_on_display()
 
     def display_partial(self, frame_buffer, x_start, y_start, x_end, y_end):
+        """Refresh the window of the full frame buffer from (x_start, y_start) up to, but not
+        including, (x_end, y_end). Only the bytes inside the window are sent, its columns are
+        widened to whole bytes."""
         if not frame_buffer:
             return
+        x_start, x_end = packing.align_window(x_start, x_end)
+        window = packing.extract_window(frame_buffer, self.width, x_start, y_start, x_end, y_end)
 
         self.set_part_reg()
         self.send_command(0x91)
@@ -560,22 +628,18 @@ class EPD2in13d(WavesharePartial):
         self.send_data(x_start)
         self.send_data(x_end - 1)
 
-        self.send_data(y_start / 256)
-        self.send_data(y_start % 256)
-        self.send_data(y_end / 256)
-        self.send_data(y_end % 256 - 1)
+        self.send_data(y_start >> 8)
+        self.send_data(y_start & 0xff)
+        self.send_data((y_end - 1) >> 8)
+        self.send_data((y_end - 1) & 0xff)
         self.send_data(0x28)
 
         self.send_command(0x10)
-        for i in range(0, int(self.width * self.height / 8)):
-            # print(frame_buffer[i],'%d','0x10')
-            self.send_data(frame_buffer[i])
+        self.send_data_bulk(window)
         self.delay_ms(10)
 
         self.send_command(0x13)
-        for i in range(0, int(self.width * self.height / 8)):
-            # print(~frame_buffer[i],'%d','0x13')
-            self.send_data(~frame_buffer[i])
+        self.send_data_bulk(packing.invert(window))
         self.delay_ms(10)
 
         # self.set_full_reg()
@@ -589,9 +653,34 @@ class EPD2in13d(WavesharePartial):
         self.send_command(0x07)  # deep sleep
         self.send_data(0xA5)
 
+    def capabilities(self):
+        capabilities = super().capabilities()
+        if not self.partial_refresh:
+            # every region would be a full refresh of its own, one frame is the cheapest
+            return drivers_base.Capabilities(partial=False, alignment={1: 8}, frame_cost=self.REFRESH_TIME,
+                                             bytes_per_second=capabilities.bytes_per_second)
+        # every region is a refresh of its own
+        return drivers_base.Capabilities(partial=True, alignment={1: 8}, modes=capabilities.modes,
+                                         full_mode=self.UPDATE_MODE_FULL, region_cost=self.PARTIAL_REFRESH_TIME,
+                                         bytes_per_second=capabilities.bytes_per_second)
+
+    def draw_regions(self, regions):
+        """The partial window only covers one region at a time. If a region has
+        UPDATE_MODE_FULL, all the regions go in one refresh of the whole frame with the full
+        LUT instead."""
+        if not self.partial_refresh or not any(mode == self.UPDATE_MODE_FULL for _, _, _, mode in regions):
+            return drivers_base.DisplayDriver.draw_regions(self, regions)
+        start = time.monotonic()
+        for x, y, image, mode in regions:
+            self.frame.paste(image.convert('1'), (x, y))
+        self.display_full(self.get_frame_buffer(self.frame))
+        return [(time.monotonic() - start) / len(regions)] * len(regions)
+
     def draw(self, x, y, image):
         """Replace a particular area on the display with an image"""
+        self.frame.paste(image.convert('1'), (x, y))
         if self.partial_refresh:
-            self.display_partial(self.get_frame_buffer(image), x, y, x + image.width, x + image.height)
+            self.display_partial(self.get_frame_buffer(self.frame), x, y,
+                                 min(x + image.width, self.width), min(y + image.height, self.height))
         else:
-            self.display_full(self.get_frame_buffer(image))
+            self.display_full(self.get_frame_buffer(self.frame))
@@ -0,0 +1,130 @@
+"""Helpers that turn PIL images into the byte streams the display controllers expect.
+
+They work on whole buffers with PIL's encoders and bytes.translate, never pixel by pixel."""
+from PIL import Image
+
+# byte -> byte with all bits flipped
+INVERT = bytes(0xFF - value for value in range(256))
+# byte -> its lowest bit, its second lowest bit
+BIT_0 = bytes(value & 1 for value in range(256))
+BIT_1 = bytes(value >> 1 & 1 for value in range(256))
+
+# bits per pixel -> for every pixel position within a byte: pixel value -> value shifted into place
+_CODE_TABLES = {
+    bpp: [
+        bytes((value & ((1 << bpp) - 1)) << (8 - bpp * (position + 1)) for value in range(256))
+        for position in range(8 // bpp)
+    ]
+    for bpp in (1, 2, 4)
+}
+
+
+def pack_1bpp(image, invert=False):
+    """Pack an image into 1 bit per pixel, 8 pixels per byte, most significant bit first.
+
+    The image is converted to mode '1' the way PIL does it (with dithering), a set bit
+    is a white pixel - or a black one with invert. Every row starts at a new byte - all
+    the panels have widths divisible by 8, so there is no padding in practice."""
+    data = image.convert('1').tobytes()
+    if invert:
+        data = data.translate(INVERT)
+    return bytearray(data)
+
+
+def pack_mask(mask, size, invert=False):
+    """Pack a buffer with one byte per pixel of an image of the given size into 1 bit per
+    pixel, most significant bit first - non-zero bytes become set bits, or cleared ones with
+    invert. Rows start at a new byte, like in pack_1bpp."""
+    data = Image.frombytes('1', size, bytes(mask), 'raw', '1;8').tobytes()
+    if invert:
+        data = data.translate(INVERT)
+    return bytearray(data)
+
+
+def align_window(x_start, x_end):
+    """Widen the columns x_start (included) to x_end (excluded) to whole bytes of a 1 bit per pixel row"""
+    return x_start & ~7, (x_end + 7) & ~7
+
+
+def extract_window(frame_buffer, width, x_start, y_start, x_end, y_end):
+    """The bytes of a 1 bit per pixel frame buffer of the given width that cover the window,
+    row by row. The ends are excluded and the columns are widened with align_window."""
+    stride = width // 8
+    first, last = x_start // 8, -(-x_end // 8)
+    view = memoryview(bytes(frame_buffer) if isinstance(frame_buffer, list) else frame_buffer)
+    if first == 0 and last == stride:
+        return bytes(view[y_start * stride:y_end * stride])
+    return b''.join(view[row + first:row + last] for row in range(y_start * stride, y_end * stride, stride))
+
+
+def changed_windows(old, new, row_bytes, merge_gap=0):
+    """Windows (first_row, end_row, first_byte, end_byte) that cover every byte that differs
+    between two equally long buffers made of rows of row_bytes. Changed rows with at most
+    merge_gap unchanged rows between them share a window. The ends are excluded."""
+    windows = []
+    if old == new:
+        return windows
+    old, new = memoryview(old), memoryview(new)
+    for row in range(len(new) // row_bytes):
+        start = row * row_bytes
+        if old[start:start + row_bytes] == new[start:start + row_bytes]:
+            continue
+        # the outermost set bits of the XOR are the first and the last changed byte
+        diff = int.from_bytes(old[start:start + row_bytes], "big") ^ int.from_bytes(new[start:start + row_bytes], "big")
+        first = row_bytes - 1 - (diff.bit_length() - 1) // 8
+        end = row_bytes - ((diff & -diff).bit_length() - 1) // 8
+        if windows and row - windows[-1][1] <= merge_gap:
+            first_row, _, window_first, window_end = windows[-1]
+            windows[-1] = (first_row, row + 1, min(window_first, first), max(window_end, end))
+        else:
+            windows.append((row, row + 1, first, end))
+    return windows
+
+
+def invert(data):
+    """Flip every bit of a buffer - ~ on each byte, kept within 0..255"""
+    return bytes(data).translate(INVERT)
+
+
+def expansion_tables(codes, bpp_in, bpp_out):
+    """Tables for expand() that convert packed pixels from bpp_in to bpp_out bits per pixel.
+
+    codes maps every input pixel value to the output pixel value. Pixels are packed most
+    significant bits first on both sides, each input byte turns into bpp_out / bpp_in
+    output bytes - one translation table for each of them."""
+    pixels_in = 8 // bpp_in
+    pixels_out = 8 // bpp_out
+    tables = []
+    for out_byte in range(pixels_in // pixels_out):
+        table = bytearray(256)
+        for value in range(256):
+            for pixel in range(pixels_out):
+                shift_in = 8 - bpp_in * (out_byte * pixels_out + pixel + 1)
+                code = codes[(value >> shift_in) & ((1 << bpp_in) - 1)]
+                table[value] |= code << (8 - bpp_out * (pixel + 1))
+        tables.append(bytes(table))
+    return tables
+
+
+def expand(data, tables):
+    """Convert a buffer with the tables from expansion_tables(), one translate per table"""
+    data = bytes(data)
+    expanded = bytearray(len(data) * len(tables))
+    for index, table in enumerate(tables):
+        expanded[index::len(tables)] = data.translate(table)
+    return expanded
+
+
+def pack_codes(codes, bpp):
+    """Pack a buffer with one pixel value (0 .. 2**bpp - 1) per byte into bpp bits per pixel,
+    most significant bits first.
+
+    The values of each position within a byte are shifted into place with a translate
+    and then merged with a big integer OR, like IT8951.pack_image does."""
+    pixels_per_byte = 8 // bpp
+    size = -(-len(codes) // pixels_per_byte)
+    packed = 0
+    for position, table in enumerate(_CODE_TABLES[bpp]):
+        part = codes[position::pixels_per_byte].translate(table)
+        packed |= int.from_bytes(part, "big") << 8 * (size - len(part))
+    return bytearray(packed.to_bytes(size, "big"))
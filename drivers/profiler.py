@@ -0,0 +1,158 @@
+"""Opt-in profiler that shows where the time of a display driver goes.
+
+DriverProfiler wraps the methods of one driver instance that move data to the
+controller, wait for it or sleep, and the methods that draw a frame. Nothing
+changes for drivers that aren't profiled. Every top level call of draw,
+draw_regions, init or flush becomes a frame:
+
+    { 'method': 'draw', 'total': <SECONDS>,
+      'phases': { 'python': <SECONDS>, 'spi': <SECONDS>, 'wait': <SECONDS>, 'delay': <SECONDS> },
+      'commands': <N>, 'data_bytes': <N>, 'spi_bytes': <N>, 'transactions': <N> }
+
+The time of a phase is exclusive: a command sent while waiting for the
+controller counts as SPI time, not as waiting. 'python' is whatever is left,
+mostly packing the image. The frames are logged at debug level, the last ones
+are kept in frames and summary() adds all of them up."""
+import collections
+import logging
+import time
+
+PHASES = ("python", "spi", "wait", "delay")
+
+# method -> phase its own time counts for
+PHASE_METHODS = {
+    "spi_transfer": "spi",
+    "spi_transfer_bulk": "spi",
+    "spi_write": "spi",
+    "spi_read": "spi",
+    "wait_until_idle": "wait",
+    "wait_for_ready": "wait",
+    "wait_for_display_ready": "wait",
+    "delay_ms": "delay",
+}
+
+# method -> (counter, amount for the call arguments) for every counter the method adds to.
+# A transaction is an SPI transfer for the Waveshare drivers and a chip select frame for the
+# IT8951, which drives the chip select itself.
+COUNTER_METHODS = {
+    "spi_transfer": [("transactions", lambda data: 1), ("spi_bytes", len)],
+    "spi_transfer_bulk": [("transactions", lambda data: 1), ("spi_bytes", len)],
+    "spi_write": [("spi_bytes", len)],
+    "spi_read": [("spi_bytes", lambda n: n)],
+    "send_command": [("commands", lambda command: 1)],
+    "send_data": [("data_bytes", lambda data: 1)],
+    "send_data_bulk": [("data_bytes", len)],
+    "write_command": [("commands", lambda command: 1), ("transactions", lambda command: 1)],
+    "write_data_bytes": [("data_bytes", lambda data: memoryview(data).nbytes), ("transactions", lambda data: 1)],
+    "read_bytes": [("transactions", lambda n: 1)],
+}
+
+FRAME_METHODS = ("init", "draw", "draw_regions", "flush")
+
+COUNTERS = ("commands", "data_bytes", "spi_bytes", "transactions")
+
+
+class DriverProfiler:
+    """Profiles one driver instance between attach() and detach()"""
+
+    def __init__(self, driver, keep_frames=100):
+        self.driver = driver
+        self.frames = collections.deque(maxlen=keep_frames)
+        self.totals = self.new_frame(None)
+        self.frame_count = 0
+        self.frame = None
+        # [phase, start, time spent in nested phases] of the running phase methods
+        self.stack = []
+        self.originals = {}
+
+    @staticmethod
+    def new_frame(method):
+        frame = {"method": method, "total": 0.0, "phases": dict.fromkeys(PHASES, 0.0)}
+        frame.update(dict.fromkeys(COUNTERS, 0))
+        return frame
+
+    def attach(self):
+        """Wrap the methods of the driver"""
+        for name in set(PHASE_METHODS) | set(COUNTER_METHODS) | set(FRAME_METHODS):
+            method = getattr(self.driver, name, None)
+            if method is None or name in self.originals:
+                continue
+            # keep what the instance itself had, e.g. a delay_ms of the simulated hardware
+            self.originals[name] = self.driver.__dict__.get(name)
+            if name in FRAME_METHODS:
+                wrapper = self.wrap_frame(name, method)
+            else:
+                wrapper = self.wrap(method, PHASE_METHODS.get(name), COUNTER_METHODS.get(name, ()))
+            setattr(self.driver, name, wrapper)
+        return self
+
+    def detach(self):
+        """Put the original methods back"""
+        for name, original in self.originals.items():
+            if original is None:
+                delattr(self.driver, name)
+            else:
+                setattr(self.driver, name, original)
+        self.originals = {}
+
+    def wrap(self, method, phase, counters):
+        def wrapper(*args, **kwargs):
+            if self.frame is not None:
+                for counter, amount in counters:
+                    self.frame[counter] += amount(*args, **kwargs)
+            if phase is None:
+                return method(*args, **kwargs)
+            self.stack.append([phase, time.perf_counter(), 0.0])
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.leave()
+        return wrapper
+
+    def wrap_frame(self, name, method):
+        def wrapper(*args, **kwargs):
+            if self.frame is not None:
+                # e.g. the generic draw_regions calling draw - part of the running frame
+                return method(*args, **kwargs)
+            self.frame = self.new_frame(name)
+            self.stack = [["python", time.perf_counter(), 0.0]]
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.frame["total"] = time.perf_counter() - self.stack[0][1]
+                self.leave()
+                self.finish_frame()
+        return wrapper
+
+    def leave(self):
+        phase, start, nested = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        if self.frame is not None:
+            self.frame["phases"][phase] += elapsed - nested
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def finish_frame(self):
+        frame, self.frame = self.frame, None
+        self.frames.append(frame)
+        self.frame_count += 1
+        self.totals["total"] += frame["total"]
+        for phase in PHASES:
+            self.totals["phases"][phase] += frame["phases"][phase]
+        for counter in COUNTERS:
+            self.totals[counter] += frame[counter]
+        logging.debug("%s profile: %s" % (type(self.driver).__name__, self.format(frame)))
+
+    def summary(self):
+        """All frames so far added up, with the number of frames"""
+        summary = dict(self.totals, method=None, frames=self.frame_count)
+        summary["phases"] = dict(self.totals["phases"])
+        return summary
+
+    @staticmethod
+    def format(frame):
+        """One line with the times and counters of a frame or a summary"""
+        phases = " ".join("%s %.1f ms" % (phase, frame["phases"][phase] * 1000) for phase in PHASES)
+        counters = " ".join("%s %d" % (counter, frame[counter]) for counter in COUNTERS)
+        prefix = "%d frames" % frame["frames"] if "frames" in frame else frame["method"]
+        return "%s: %.1f ms (%s), %s" % (prefix, frame["total"] * 1000, phases, counters)
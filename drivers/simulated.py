@@ -0,0 +1,407 @@
+"""Simulated display hardware, so that the drivers can run without a Raspberry Pi.
+
+The drivers talk to the hardware through the RPi.GPIO and spidev modules they
+import. SimulatedHardware stands in for both: install() puts it in place of
+them, attach() also makes the driver's delays simulated. A controller model
+behind it decodes what the driver sends - the stream of commands and data is
+recorded - drives the BUSY pin and answers reads:
+
+    hardware = SimulatedHardware(controller_for(driver))
+    hardware.attach(driver)
+    driver.init()
+    driver.draw(0, 0, image)
+    hardware.stats, hardware.clock, hardware.stream_digest()
+
+Time is modelled instead of spent: SPI transfers take their bytes at the SPI
+clock, refreshes keep the display busy for the nominal time of the controller
+and waiting for the BUSY pin skips ahead to the end of the refresh. The
+modelled seconds are added up in clock - with time_scale the simulation also
+sleeps that many real seconds per modelled one."""
+import hashlib
+import struct
+import time
+
+import drivers.drivers_base as drivers_base
+import drivers.driver_it8951 as driver_it8951
+from drivers.drivers_partial import WavesharePartial, EPD2in13d
+
+# modules that import RPi.GPIO and spidev
+DRIVER_MODULES = (drivers_base, driver_it8951)
+
+
+class SimulatedGPIO:
+    """Stand-in for the RPi.GPIO module, the pins are wired to the controller model"""
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+
+    def __init__(self, hardware):
+        self.hardware = hardware
+        self.levels = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, **kwargs):
+        self.levels.setdefault(pin, self.LOW)
+
+    def output(self, pin, value):
+        self.levels[pin] = value
+        self.hardware.controller.pin_changed(pin, value)
+
+    def input(self, pin):
+        return self.hardware.controller.read_pin(pin)
+
+    def wait_for_edge(self, pin, edge, timeout=None):
+        """The pin changes when the controller is done, which a read of the pin skips ahead to"""
+        self.input(pin)
+        return pin
+
+    def cleanup(self, *args):
+        pass
+
+
+class SimulatedSpiDev:
+    """Stand-in for spidev.SpiDev, the transfers go to the controller model"""
+
+    def __init__(self, hardware, bus=0, device=0):
+        self.hardware = hardware
+        self.bus = bus
+        self.device = device
+        self.max_speed_hz = 500000
+        self.mode = 0
+        self.no_cs = False
+
+    def writebytes(self, data):
+        self.hardware.transfer(self, bytes(data))
+
+    def writebytes2(self, data):
+        self.hardware.transfer(self, bytes(data))
+
+    def readbytes(self, n):
+        self.hardware.transfer(self, bytes(n))
+        return list(self.hardware.controller.read(n))
+
+    def close(self):
+        pass
+
+
+class SimulatedHardware:
+    """GPIO and SPI of a Raspberry Pi with a display controller model attached.
+
+    stats counts the SPI transfers and bytes, the commands the controller saw and
+    the times it was busy, and the modelled seconds spent in SPI transfers,
+    waiting for the controller and in delays. With record, stream keeps everything that was
+    sent as ("command", <CODE>) and ("data", <BYTES>) entries."""
+
+    def __init__(self, controller, spi_speed_hz=None, transfer_overhead=0.00002, time_scale=0.0, record=True):
+        """spi_speed_hz overrides the SPI clock the driver sets, transfer_overhead is the
+        modelled setup time of one SPI transfer in seconds"""
+        self.controller = controller
+        self.spi_speed_hz = spi_speed_hz
+        self.transfer_overhead = transfer_overhead
+        self.time_scale = time_scale
+        self.record = record
+        self.gpio = SimulatedGPIO(self)
+        self.stream = []
+        self.stats = {
+            "transfers": 0, "bytes": 0, "commands": 0, "busy_periods": 0,
+            "spi_time": 0.0, "busy_time": 0.0, "delay_time": 0.0,
+        }
+        controller.hardware = self
+
+    @property
+    def clock(self):
+        """Modelled seconds since the simulation started"""
+        return self.stats["spi_time"] + self.stats["busy_time"] + self.stats["delay_time"]
+
+    def SpiDev(self, bus=0, device=0):
+        """Like spidev.SpiDev, so that the simulation can take the place of the spidev module"""
+        return SimulatedSpiDev(self, bus, device)
+
+    def install(self, modules=DRIVER_MODULES):
+        """Use the simulation instead of RPi.GPIO and spidev in the driver modules"""
+        for module in modules:
+            module.GPIO = self.gpio
+            module.spidev = self
+
+    def attach(self, driver):
+        """Install the simulation and make the delays of the driver simulated too"""
+        self.install()
+        driver.delay_ms = lambda delaytime: self.advance(float(delaytime) / 1000.0, "delay_time")
+        return driver
+
+    def advance(self, seconds, kind):
+        self.stats[kind] += seconds
+        if self.time_scale and seconds > 0:
+            time.sleep(seconds * self.time_scale)
+
+    def transfer(self, spi, data):
+        self.stats["transfers"] += 1
+        self.stats["bytes"] += len(data)
+        speed = self.spi_speed_hz or spi.max_speed_hz
+        self.advance(self.transfer_overhead + len(data) * 8.0 / speed, "spi_time")
+        self.controller.write(data)
+
+    def wait_until(self, deadline):
+        """A read of a busy signal - skip ahead to when the controller is done"""
+        self.advance(max(deadline - self.clock, 0.0), "busy_time")
+
+    def record_command(self, command):
+        self.stats["commands"] += 1
+        if self.record:
+            self.stream.append(("command", command))
+
+    def record_data(self, data):
+        if not self.record or not data:
+            return
+        if self.stream and self.stream[-1][0] == "data":
+            self.stream[-1][1].extend(data)
+        else:
+            self.stream.append(("data", bytearray(data)))
+
+    def stream_digest(self):
+        """SHA-256 of the recorded stream, for comparing runs"""
+        digest = hashlib.sha256()
+        for kind, value in self.stream:
+            if kind == "command":
+                digest.update(b"C" + value.to_bytes(2, "big"))
+            else:
+                digest.update(b"D" + len(value).to_bytes(4, "big") + bytes(value))
+        return digest.hexdigest()
+
+
+class ControllerModel:
+    """Base class for controller models - the pins and the SPI bus as seen by the controller"""
+
+    def __init__(self, busy_pin, busy_level):
+        self.hardware = None
+        self.busy_pin = busy_pin
+        self.busy_level = busy_level
+        self.busy_until = 0.0
+
+    def busy(self, seconds):
+        self.hardware.stats["busy_periods"] += 1
+        self.busy_until = max(self.busy_until, self.hardware.clock + seconds)
+
+    def pin_changed(self, pin, value):
+        pass
+
+    def read_pin(self, pin):
+        if pin != self.busy_pin:
+            return self.hardware.gpio.levels.get(pin, SimulatedGPIO.LOW)
+        if self.hardware.clock < self.busy_until:
+            # report busy once, the driver waits for the rest of the refresh
+            self.hardware.wait_until(self.busy_until)
+            return self.busy_level
+        return 1 - self.busy_level
+
+    def write(self, data):
+        pass
+
+    def read(self, n):
+        return bytes(n)
+
+
+class WaveshareController(ControllerModel):
+    """The controllers of the Waveshare SPI displays: a DC pin selects between command
+    and data bytes, some commands keep the BUSY pin busy for a while.
+
+    refresh_latency maps those commands to seconds. The time of a refresh can depend
+    on the LUT instead: lut_latency maps the contents of a LUT written with lut_command
+    to the seconds refresh_command takes with it."""
+
+    def __init__(self, dc_pin, busy_pin, busy_level, refresh_latency,
+                 lut_command=None, lut_latency=None, refresh_command=None):
+        super().__init__(busy_pin, busy_level)
+        self.dc_pin = dc_pin
+        self.refresh_latency = refresh_latency
+        self.lut_command = lut_command
+        self.lut_latency = lut_latency or {}
+        self.refresh_command = refresh_command
+        self.command = None
+        self.lut = bytearray()
+
+    def write(self, data):
+        if self.hardware.gpio.levels.get(self.dc_pin) == SimulatedGPIO.HIGH:
+            self.hardware.record_data(data)
+            if self.command == self.lut_command:
+                self.lut.extend(data)
+            return
+        for command in data:
+            self.hardware.record_command(command)
+            self.command = command
+            if command == self.lut_command:
+                self.lut = bytearray()
+            latency = self.refresh_latency.get(command)
+            if command == self.refresh_command:
+                latency = self.lut_latency.get(bytes(self.lut), latency)
+            if latency:
+                self.busy(latency)
+
+
+class IT8951Controller(ControllerModel):
+    """The IT8951 with its I80 over SPI protocol: every chip select frame starts with a
+    preamble for a command, data or a read, data are 16 bit big endian words.
+
+    The device info is configurable, the default is the 6" 800x600 display. Refreshes
+    keep the LUT status register busy for the time in mode_latency of their mode."""
+
+    PREAMBLE_COMMAND = 0x6000
+    PREAMBLE_WRITE = 0x0000
+    PREAMBLE_READ = 0x1000
+
+    # nominal refresh times of the update modes in seconds
+    MODE_LATENCY = {0: 2.0, 1: 0.26, 2: 0.45, 3: 0.45, 4: 0.12, 6: 0.12}
+
+    def __init__(self, width=800, height=600, img_addr=0x1236E0, firmware="SWv_0.1.1",
+                 lut="M641_TFA5210", vcom=1500, mode_latency=None, cs_pin=8, busy_pin=24, rst_pin=17):
+        super().__init__(busy_pin, busy_level=0)
+        self.device_info = {
+            "width": width, "height": height, "img_addr": img_addr, "firmware": firmware, "lut": lut,
+        }
+        self.vcom = vcom
+        self.mode_latency = mode_latency or self.MODE_LATENCY
+        self.cs_pin = cs_pin
+        self.rst_pin = rst_pin
+        self.registers = {}
+        self.preamble = None
+        self.command = None
+        self.arguments = bytearray()
+        self.loading = False
+        self.response = bytearray()
+        self.image_bytes = 0
+
+    def pin_changed(self, pin, value):
+        if pin == self.cs_pin and value == SimulatedGPIO.LOW:
+            self.preamble = None
+        elif pin == self.rst_pin and value == SimulatedGPIO.LOW:
+            # a reset loses the configuration, like a power cycle
+            self.registers = {}
+            self.loading = False
+
+    def write(self, data):
+        if self.preamble is None:
+            self.preamble, data = int.from_bytes(data[:2], "big"), data[2:]
+        if not data or self.preamble == self.PREAMBLE_READ:
+            return
+        if self.preamble == self.PREAMBLE_COMMAND:
+            self.start_command(int.from_bytes(data[:2], "big"))
+        elif self.loading:
+            self.image_bytes += len(data)
+            self.hardware.record_data(data)
+        elif self.command is not None:
+            self.hardware.record_data(data)
+            self.arguments.extend(data)
+            self.run_command()
+
+    def read_pin(self, pin):
+        # the host interface stays ready during refreshes, they show in the LUT status register
+        if pin == self.busy_pin:
+            return SimulatedGPIO.HIGH
+        return super().read_pin(pin)
+
+    def read(self, n):
+        data, self.response = bytes(self.response[:n]).ljust(n, b"\0"), self.response[n:]
+        return data
+
+    def start_command(self, command):
+        self.hardware.record_command(command)
+        self.command = command
+        self.arguments = bytearray()
+        if command == 0x0302:
+            info = self.device_info
+            self.response = bytearray(struct.pack(
+                    ">HHHH16s16s", info["width"], info["height"], info["img_addr"] & 0xFFFF,
+                    info["img_addr"] >> 16, self.swap_string(info["firmware"]), self.swap_string(info["lut"])))
+            self.command = None
+        elif command == 0x0022:
+            self.loading = False
+            self.command = None
+
+    def run_command(self):
+        """Run the current command once all of its arguments are there"""
+        words = len(self.arguments) // 2
+        arguments = struct.unpack(">%dH" % words, self.arguments[:words * 2])
+        if self.command == 0x0010 and words >= 1:
+            self.response = bytearray(struct.pack(">H", self.read_register(arguments[0])))
+        elif self.command == 0x0011 and words >= 2:
+            self.registers[arguments[0]] = arguments[1]
+        elif self.command == 0x0039 and words >= 1 and arguments[0] == 0:
+            self.response = bytearray(struct.pack(">H", self.vcom))
+        elif self.command == 0x0039 and words >= 2:
+            self.vcom = arguments[1]
+        elif self.command == 0x0021 and words >= 5:
+            self.loading = True
+        elif self.command in (0x0034, 0x0037) and words >= (5 if self.command == 0x0034 else 7):
+            self.busy(self.mode_latency.get(arguments[4], self.mode_latency[2]))
+        else:
+            return
+        self.command = None
+
+    def read_register(self, address):
+        if address == driver_it8951.IT8951.REG_LUTAFSR:
+            if self.hardware.clock < self.busy_until:
+                self.hardware.wait_until(self.busy_until)
+                return 0xFFFF
+            return 0
+        return self.registers.get(address, 0)
+
+    @staticmethod
+    def swap_string(text):
+        """The controller sends strings as little endian words, IT8951.fixup_string swaps them back"""
+        data = text.encode("ascii").ljust(16, b"\0")[:16]
+        return bytes(data[i ^ 1] for i in range(16))
+
+
+# Nominal seconds the commands keep the BUSY pin busy, per driver class. The first
+# class in the method resolution order of a driver that is listed here applies.
+REFRESH_LATENCY = {
+    "EPD2in13d": {0x04: 0.1, 0x12: 2.0},
+    "WavesharePartial": {0x20: 0.3},
+    "EPD2in7": {0x04: 0.1, 0x12: 6.0, 0x16: 0.5},
+    "EPD2in7b": {0x04: 0.1, 0x12: 15.0, 0x16: 0.5},
+    "WaveshareColorDraw": {0x04: 0.1, 0x12: 15.0},
+    "WaveshareColor": {0x04: 0.1, 0x12: 15.0},
+    "WaveshareFull": {0x04: 0.1, 0x12: 4.0},
+}
+
+# seconds of a refresh of the partial refresh displays with their full refresh LUT
+FULL_LUT_LATENCY = 2.0
+
+
+def controller_for(driver, **kwargs):
+    """A controller model that matches the driver, kwargs go to its constructor"""
+    if isinstance(driver, driver_it8951.IT8951):
+        return IT8951Controller(cs_pin=driver.CS_PIN, busy_pin=driver.BUSY_PIN, rst_pin=driver.RST_PIN, **kwargs)
+    latencies = [REFRESH_LATENCY[cls.__name__] for cls in type(driver).__mro__ if cls.__name__ in REFRESH_LATENCY]
+    if not latencies:
+        raise ValueError("No controller model for {}".format(type(driver).__name__))
+    latency = latencies[0]
+    if isinstance(driver, WavesharePartial) and not isinstance(driver, EPD2in13d):
+        kwargs.setdefault("lut_command", driver.WRITE_LUT_REGISTER)
+        kwargs.setdefault("lut_latency", {bytes(driver.lut_full_update): FULL_LUT_LATENCY})
+        kwargs.setdefault("refresh_command", driver.MASTER_ACTIVATION)
+    # the partial refresh displays signal busy with a high BUSY pin, the others with a low one
+    busy_level = 1 if isinstance(driver, WavesharePartial) and not isinstance(driver, EPD2in13d) else 0
+    kwargs.setdefault("refresh_latency", latency)
+    return WaveshareController(driver.DC_PIN, driver.BUSY_PIN, busy_level, **kwargs)
+
+
+def simulate(driver, controller=None, **kwargs):
+    """Attach the driver to simulated hardware with a matching controller model, kwargs go
+    to SimulatedHardware. controller is the model to use, or a dict of arguments for
+    controller_for, e.g. {"width": 1872, "height": 1404} for the device info of an IT8951"""
+    if not isinstance(controller, ControllerModel):
+        controller = controller_for(driver, **(controller or {}))
+    hardware = SimulatedHardware(controller, **kwargs)
+    hardware.attach(driver)
+    return hardware
@@ -0,0 +1,119 @@
+"""Strategies for waiting on a display controller.
+
+Drivers wait either for a GPIO pin (usually BUSY) to reach a level or for an
+arbitrary condition such as a status register to clear. A strategy decides how
+the waiting is done and records how long every wait took, per wait name:
+
+    { '<NAME>': { 'calls': <N>, 'total': <SECONDS>, 'max': <SECONDS>, 'last': <SECONDS> }, ... }
+
+The GPIO module is passed in by the caller, so the strategies work the same way
+with RPi.GPIO and with a fake module that implements input() (and
+wait_for_edge() for EdgeWait)."""
+import time
+from abc import ABC, abstractmethod
+
+
+class WaitStrategy(ABC):
+    """Base class for wait strategies"""
+
+    def __init__(self, timeout=None):
+        """timeout caps every wait to that many seconds, None leaves it to the callers"""
+        self.timeout = timeout
+        self.stats = {}
+
+    def wait_for_pin(self, gpio, pin, ready_level, timeout=None, name="pin"):
+        """Waits until the input pin reads ready_level"""
+        self.wait_until(lambda: gpio.input(pin) == ready_level, timeout=timeout, name=name)
+
+    def wait_until(self, is_ready, timeout=None, name="condition"):
+        """Waits until is_ready() returns True"""
+        start = time.monotonic()
+        if not is_ready():
+            self._wait_until(is_ready, self._deadline(start, timeout), name)
+        self._record(name, time.monotonic() - start)
+
+    @abstractmethod
+    def _wait_until(self, is_ready, deadline, name):
+        """Waits until is_ready() returns True, the first check has already failed"""
+        pass
+
+    def _deadline(self, start, timeout):
+        timeouts = [t for t in (self.timeout, timeout) if t is not None]
+        return start + min(timeouts) if timeouts else None
+
+    @staticmethod
+    def _check_deadline(deadline, name):
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError("Timed out waiting for {}".format(name))
+
+    def _record(self, name, elapsed):
+        stats = self.stats.setdefault(name, {"calls": 0, "total": 0.0, "max": 0.0, "last": 0.0})
+        stats["calls"] += 1
+        stats["total"] += elapsed
+        stats["max"] = max(stats["max"], elapsed)
+        stats["last"] = elapsed
+
+
+class PollingWait(WaitStrategy):
+    """Check the condition at a fixed interval - the original behaviour of the drivers"""
+
+    def __init__(self, interval=0.1, timeout=None):
+        super().__init__(timeout=timeout)
+        self.interval = interval
+
+    def _wait_until(self, is_ready, deadline, name):
+        while True:
+            self._check_deadline(deadline, name)
+            time.sleep(self.interval)
+            if is_ready():
+                return
+
+
+class AdaptiveWait(WaitStrategy):
+    """Spin on the condition for a short while, then sleep with exponential backoff.
+
+    Short waits (the controller digesting a command) finish within the spin
+    phase, long ones (a display refresh) settle at max_sleep between checks."""
+
+    def __init__(self, spin_time=0.0005, min_sleep=0.0001, max_sleep=0.02, timeout=None):
+        super().__init__(timeout=timeout)
+        self.spin_time = spin_time
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+
+    def _wait_until(self, is_ready, deadline, name):
+        spin_end = time.monotonic() + self.spin_time
+        while time.monotonic() < spin_end:
+            if is_ready():
+                return
+        sleep = self.min_sleep
+        while True:
+            self._check_deadline(deadline, name)
+            time.sleep(sleep)
+            if is_ready():
+                return
+            sleep = min(sleep * 2, self.max_sleep)
+
+
+class EdgeWait(AdaptiveWait):
+    """Block on a GPIO edge interrupt instead of polling the pin.
+
+    Waits that don't involve a pin fall back to AdaptiveWait. The edge wait is
+    done in slices of at most edge_timeout, so an edge that happens between
+    reading the pin and arming the interrupt only costs one slice."""
+
+    def __init__(self, edge_timeout=0.1, **kwargs):
+        super().__init__(**kwargs)
+        self.edge_timeout = edge_timeout
+
+    def wait_for_pin(self, gpio, pin, ready_level, timeout=None, name="pin"):
+        start = time.monotonic()
+        deadline = self._deadline(start, timeout)
+        edge = gpio.RISING if ready_level else gpio.FALLING
+        while gpio.input(pin) != ready_level:
+            self._check_deadline(deadline, name)
+            slice_timeout = self.edge_timeout
+            if deadline is not None:
+                slice_timeout = max(min(slice_timeout, deadline - time.monotonic()), 0.001)
+            gpio.wait_for_edge(pin, edge, timeout=int(slice_timeout * 1000) or 1)
+        self._record(name, time.monotonic() - start)
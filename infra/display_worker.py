@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+from typing import List, Optional
+
+from PIL import Image
+
+from infra.refresh_ledger import RefreshLedger
+from infra.update_planner import UpdatePlanner
+from ui.render_result import BoundingBox
+
+
+class DisplayWorker:
+    """Draws the frames on the display in a thread of its own, so the next frame can be
+    loaded and rendered while the panel refreshes.
+
+    Only the newest frame waits for the display: a frame submitted while the previous one
+    is still waiting supersedes it and takes over its boxes, the display never lags behind
+    by more than the frame it is drawing. Once the worker runs, only the worker uses the
+    driver."""
+
+    def __init__(self, driver, planner: UpdatePlanner, ledger: RefreshLedger,
+                 previous: Optional[Image.Image] = None, profiler=None) -> None:
+        self.driver = driver
+        self.planner = planner
+        self.ledger = ledger
+        # what the display shows, None for a full redraw
+        self.previous = previous
+        self.profiler = profiler
+        self.condition = threading.Condition()
+        # (image, boxes, submit time) of the frame waiting for the display
+        self.pending = None
+        self.busy = False
+        self.stopping = False
+        self.drawn = 0
+        self.superseded = 0
+        self.error = None
+        self.thread = None
+
+    def start(self) -> "DisplayWorker":
+        self.thread = threading.Thread(target=self.run, name="Display worker", daemon=True)
+        self.thread.start()
+        return self
+
+    def submit(self, image: Image.Image, boxes: List[BoundingBox]) -> None:
+        """Queue a frame, boxes are where it may differ from the frame before it"""
+        self.raise_error()
+        with self.condition:
+            if self.pending is not None:
+                # the display has to catch up with the changes of the superseded frame too
+                boxes = self.pending[1] + list(boxes)
+                self.superseded += 1
+                logging.debug("Frame superseded before it was drawn")
+            self.pending = (image, list(boxes), time.monotonic())
+            self.condition.notify_all()
+
+    def run(self) -> None:
+        """Worker loop - draw the newest frame whenever there is one"""
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopping:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                (image, boxes, submitted), self.pending = self.pending, None
+                self.busy = True
+            try:
+                logging.debug("Frame waited %.3f s for the display", time.monotonic() - submitted)
+                self.draw(image, boxes)
+                self.previous = image
+                self.drawn += 1
+            except Exception as e:
+                # nobody knows what the display shows now
+                self.previous = None
+                self.error = e
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def draw(self, image: Image.Image, boxes: List[BoundingBox]) -> None:
+        """Bring the display from previous to image"""
+        if self.previous is None:
+            logging.debug("Full redraw")
+            self.driver.draw_regions(self.planner.full(image))
+            if self.planner.cleans():
+                self.ledger.cleaned((0, 0, self.driver.width, self.driver.height))
+        else:
+            logging.debug("Partial redraw")
+            regions = self.planner.plan(image, self.previous, boxes)
+            self.ledger.record(image, self.previous, regions)
+            worn = self.ledger.worn()
+            # clean refresh of the parts that collected too much ghosting, if the display can
+            clean = self.planner.clean(image, worn) if worn else []
+            if clean:
+                logging.debug("Clean refresh of %d worn tiles in %d regions", len(worn), len(clean))
+                regions = [region for region in regions if not self.planner.covered(region, clean)] + clean
+                for x, y, clean_image, _ in clean:
+                    self.ledger.cleaned((x, y, x + clean_image.width, y + clean_image.height))
+            if regions:
+                timings = self.driver.draw_regions(regions)
+                for (x, y, region_image, _), timing in zip(regions, timings):
+                    logging.debug("Region %dx%d at (%d, %d) drawn in %.3f s",
+                                  region_image.width, region_image.height, x, y, timing)
+        if self.profiler and self.profiler.frames:
+            logging.info("Display profile: %s", self.profiler.format(self.profiler.frames[-1]))
+
+    def join(self) -> None:
+        """Wait until the submitted frames are on the display"""
+        with self.condition:
+            while self.pending is not None or self.busy:
+                self.condition.wait()
+        self.raise_error()
+
+    def stop(self) -> None:
+        """Draw the waiting frame, then stop the worker"""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.raise_error()
+
+    def raise_error(self) -> None:
+        """Raise an error of the worker in the submitting thread - once"""
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
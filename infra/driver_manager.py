@@ -1,33 +1,52 @@
-# display drivers - note: they are GPL licensed, unlike this file
-import drivers.drivers_base as drivers_base
-import drivers.drivers_partial as drivers_partial
-import drivers.drivers_full as drivers_full
-import drivers.drivers_color as drivers_color
-import drivers.drivers_colordraw as drivers_colordraw
-import drivers.driver_it8951 as driver_it8951
+import importlib
 # for tidy driver list
 from collections import OrderedDict
+from functools import lru_cache
+
+# display drivers - note: they are GPL licensed, unlike this file
+# Driver class name -> (module, description). The module of a driver is only imported when
+# the driver is used, the description is the first line of its docstring.
+DRIVERS = OrderedDict([
+    ('EPD1in54', ('drivers.drivers_partial', 'Waveshare 1.54" - monochrome')),
+    ('EPD2in13', ('drivers.drivers_partial', 'Waveshare 2.13" - monochrome')),
+    ('EPD2in13v2', ('drivers.drivers_partial', 'Waveshare 2.13" V2 - monochrome')),
+    ('EPD2in9', ('drivers.drivers_partial', 'Waveshare 2.9" - monochrome')),
+    ('EPD2in13d', ('drivers.drivers_partial', 'Waveshare 2.13" D - monochrome (flexible)')),
+    ('EPD2in7', ('drivers.drivers_full', 'Waveshare 2.7" - monochrome')),
+    ('EPD4in2', ('drivers.drivers_full', 'Waveshare 4.2" - monochrome')),
+    ('EPD7in5', ('drivers.drivers_full', 'Waveshare 7.5" - monochrome')),
+    ('EPD7in5v2', ('drivers.drivers_full', 'WaveShare 7.5" GDEW075T7 - monochrome')),
+    ('EPD4in2b', ('drivers.drivers_color', 'Waveshare 4.2" B - black / white / red')),
+    ('EPD7in5b', ('drivers.drivers_color', 'Waveshare 7.5" B - black / white / red')),
+    ('EPD5in83', ('drivers.drivers_color', 'Waveshare 5.83" - monochrome')),
+    ('EPD5in83b', ('drivers.drivers_color', 'Waveshare 5.83" B - black / white / red')),
+    ('EPD1in54b', ('drivers.drivers_colordraw', 'Waveshare 1.54" B - black / white / red')),
+    ('EPD1in54c', ('drivers.drivers_colordraw', 'Waveshare 1.54" C - black / white / yellow')),
+    ('EPD2in13b', ('drivers.drivers_colordraw', 'Waveshare 2.13" B - black / white / red')),
+    ('EPD2in7b', ('drivers.drivers_colordraw', 'Waveshare 2.7" B - black / white / red')),
+    ('EPD2in9b', ('drivers.drivers_colordraw', 'Waveshare 2.9" B - black / white / red')),
+    ('IT8951', ('drivers.driver_it8951', 'A generic driver for displays that use a IT8951 controller board.')),
+    ('Dummy', ('drivers.drivers_base', 'Dummy display driver - does not do anything')),
+    ('Bitmap', ('drivers.drivers_base', 'Output a bitmap for each frame - overwrite old ones')),
+])
 
 
 class DriverManager:
 
     def __init__(self) -> None:
         self.driverdict = {}
-        driverlist = [drivers_partial.EPD1in54, drivers_partial.EPD2in13, drivers_partial.EPD2in13v2, drivers_partial.EPD2in9,
-                      drivers_partial.EPD2in13d,
-                      drivers_full.EPD2in7, drivers_full.EPD4in2, drivers_full.EPD7in5, drivers_full.EPD7in5v2,
-                      drivers_color.EPD4in2b, drivers_color.EPD7in5b, drivers_color.EPD5in83, drivers_color.EPD5in83b,
-                      drivers_colordraw.EPD1in54b, drivers_colordraw.EPD1in54c, drivers_colordraw.EPD2in13b,
-                      drivers_colordraw.EPD2in7b, drivers_colordraw.EPD2in9b, driver_it8951.IT8951,
-                      drivers_base.Dummy, drivers_base.Bitmap]
-        for driver in driverlist:
-            self.driverdict[driver.__name__] = {'desc': driver.__doc__, 'class': driver}
+        for driver, (module, desc) in DRIVERS.items():
+            self.driverdict[driver] = {'desc': desc, 'module': module}
 
     def get_drivers(self):
         """Get the list of available drivers as a dict
-        Format: { '<NAME>': { 'desc': '<DESCRIPTION>', 'class': <CLASS> }, ... }"""
+        Format: { '<NAME>': { 'desc': '<DESCRIPTION>', 'module': '<MODULE>' }, ... }"""
         return self.driverdict
 
+    def get_driver_class(self, driver):
+        """Get the class of a driver, importing its module if that hasn't happened yet"""
+        return getattr(importlib.import_module(self.driverdict[driver]['module']), driver)
+
     def get_driver_list(self):
         """Get a neat printable driver list"""
         order = OrderedDict(sorted(self.get_drivers().items()))
@@ -36,3 +55,9 @@ class DriverManager:
     def get_driver_by_name(self, driver):
         matched_drivers = [n for n in self.get_drivers() if n.lower() == driver.lower()]
         return matched_drivers
+
+
+@lru_cache(maxsize=None)
+def get_driver_manager():
+    """The DriverManager of the process, created on first use"""
+    return DriverManager()
@@ -0,0 +1,67 @@
+from typing import List
+
+from PIL import Image, ImageChops
+
+from ui.render_result import BoundingBox
+
+
+class RefreshLedger:
+    """Keeps track of the ghosting of every tile of the display: the partial updates that
+    touched it and the pixels they changed since its last clean refresh.
+
+    A tile is worn out after more than max_updates partial updates, or once the changed
+    pixels add up to max_changed times its area."""
+
+    def __init__(self, width: int, height: int, max_updates: int, max_changed: float, tile_size: int = 64) -> None:
+        self.width = width
+        self.height = height
+        self.max_updates = max_updates
+        self.max_changed = max_changed
+        self.tile_size = tile_size
+        columns = -(-width // tile_size)
+        rows = -(-height // tile_size)
+        self.tiles = [(x * tile_size, y * tile_size, min((x + 1) * tile_size, width), min((y + 1) * tile_size, height))
+                      for y in range(rows) for x in range(columns)]
+        self.updates = [0] * len(self.tiles)
+        self.changed = [0] * len(self.tiles)
+
+    def record(self, image: Image.Image, previous: Image.Image, regions) -> None:
+        """Count the (x, y, image, mode) regions drawn to turn previous into image"""
+        touched = set()
+        for x, y, region_image, mode in regions:
+            box = (x, y, x + region_image.width, y + region_image.height)
+            diff = ImageChops.difference(image.crop(box).convert('L'), previous.crop(box).convert('L'))
+            for index in self.overlapping(box):
+                tile = self.tiles[index]
+                left, top = max(tile[0], box[0]), max(tile[1], box[1])
+                right, bottom = min(tile[2], box[2]), min(tile[3], box[3])
+                histogram = diff.crop((left - x, top - y, right - x, bottom - y)).histogram()
+                changed = (right - left) * (bottom - top) - histogram[0]
+                if changed:
+                    self.changed[index] += changed
+                    touched.add(index)
+        for index in touched:
+            self.updates[index] += 1
+
+    def worn(self) -> List[BoundingBox]:
+        """The tiles that need a clean refresh"""
+        return [tile for index, tile in enumerate(self.tiles)
+                if self.updates[index] > self.max_updates or
+                self.changed[index] >= self.max_changed * (tile[2] - tile[0]) * (tile[3] - tile[1])]
+
+    def cleaned(self, box: BoundingBox) -> None:
+        """Start over for the tiles that are completely inside a clean refresh of the box"""
+        for index in self.overlapping(box):
+            tile = self.tiles[index]
+            if box[0] <= tile[0] and box[1] <= tile[1] and tile[2] <= box[2] and tile[3] <= box[3]:
+                self.updates[index] = 0
+                self.changed[index] = 0
+
+    def overlapping(self, box: BoundingBox) -> List[int]:
+        """Indices of the tiles the box overlaps"""
+        columns = -(-self.width // self.tile_size)
+        first_column, last_column = box[0] // self.tile_size, min((box[2] - 1) // self.tile_size, columns - 1)
+        first_row = box[1] // self.tile_size
+        last_row = min((box[3] - 1) // self.tile_size, -(-self.height // self.tile_size) - 1)
+        return [row * columns + column
+                for row in range(first_row, last_row + 1) for column in range(first_column, last_column + 1)]
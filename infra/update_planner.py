@@ -0,0 +1,98 @@
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageChops
+
+from drivers.drivers_base import Capabilities
+from ui.render_result import BoundingBox
+
+# (x, y, image, update mode) as taken by DisplayDriver.draw_regions
+Region = Tuple[int, int, Image.Image, Optional[int]]
+
+
+class UpdatePlanner:
+    """Turns the changes between two frames into the cheapest list of regions the display
+    takes, according to the capabilities of its driver"""
+
+    def __init__(self, capabilities: Capabilities, width: int, height: int) -> None:
+        self.capabilities = capabilities
+        self.width = width
+        self.height = height
+
+    def full(self, image: Image.Image) -> List[Region]:
+        """A full refresh, with the mode that clears ghosting"""
+        return [(0, 0, image, self.capabilities.full_mode)]
+
+    def cleans(self) -> bool:
+        """Whether the full refresh clears ghosting"""
+        return not self.capabilities.partial or self.capabilities.full_mode is not None
+
+    def plan(self, image: Image.Image, previous: Image.Image, boxes: List[BoundingBox]) -> List[Region]:
+        """Regions that turn previous into image, nothing if they are the same. Only the
+        boxes are compared, that's where the renderer draws."""
+        changes = []
+        for box in boxes:
+            diff = ImageChops.difference(image.crop(box), previous.crop(box)).getbbox()
+            if diff:
+                changes.append((box[0] + diff[0], box[1] + diff[1], box[0] + diff[2], box[1] + diff[3]))
+        if not changes:
+            return []
+        if not self.capabilities.partial:
+            return [(0, 0, image, None)]
+        planned = self.merge([self.choose(image, box) for box in changes], image)
+        if sum(cost for _, _, cost in planned) >= self.choose(image, (0, 0, self.width, self.height))[2]:
+            planned = [self.choose(image, (0, 0, self.width, self.height))]
+        return [(box[0], box[1], image.crop(box), None) for box, _, _ in planned]
+
+    def clean(self, image: Image.Image, boxes: List[BoundingBox]) -> List[Region]:
+        """Clean refreshes of the boxes with the full mode, of the whole display if every
+        refresh is a full one. Nothing if the driver has no mode that clears ghosting."""
+        if not self.capabilities.partial:
+            return self.full(image)
+        if self.capabilities.full_mode is None:
+            return []
+        planned = self.merge([self.choose(image, box) for box in boxes], image)
+        return [(box[0], box[1], image.crop(box), self.capabilities.full_mode) for box, _, _ in planned]
+
+    @staticmethod
+    def covered(region: Region, regions: List[Region]) -> bool:
+        """Whether the region is inside one of the regions"""
+        x, y, image, _ = region
+        return any(other_x <= x and other_y <= y and x + image.width <= other_x + other.width and
+                   y + image.height <= other_y + other.height for other_x, other_y, other, _ in regions)
+
+    def choose(self, image: Image.Image, box: BoundingBox) -> Tuple[BoundingBox, int, float]:
+        """The cheapest (aligned box, bits per pixel, cost) to draw the box with"""
+        capabilities = self.capabilities
+        depths = list(capabilities.alignment)
+        if min(depths) < capabilities.gray_bpp and not self.black_white(image.crop(box)):
+            depths = [bpp for bpp in depths if bpp >= capabilities.gray_bpp]
+        options = []
+        for bpp in depths:
+            aligned = capabilities.align(box, bpp, self.width)
+            options.append((aligned, bpp, capabilities.cost(aligned, bpp)))
+        return min(options, key=lambda option: option[2])
+
+    def merge(self, planned, image):
+        """Merge regions while that is cheaper or they overlap - overlapping regions would
+        wait for each other anyway"""
+        while len(planned) > 1:
+            best = None
+            for i in range(len(planned)):
+                for j in range(i + 1, len(planned)):
+                    a, b = planned[i][0], planned[j][0]
+                    merged = self.choose(image, (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])))
+                    overlap = a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+                    saving = planned[i][2] + planned[j][2] - merged[2]
+                    if (overlap or saving > 0) and (best is None or saving > best[0]):
+                        best = (saving, i, j, merged)
+            if best is None:
+                break
+            _, i, j, merged = best
+            planned = [region for k, region in enumerate(planned) if k not in (i, j)] + [merged]
+        return planned
+
+    @staticmethod
+    def black_white(image: Image.Image) -> bool:
+        """Whether the image only has the darkest and lightest of 16 gray levels"""
+        histogram = image.convert('L').histogram()
+        return not any(histogram[16:240])
@@ -1,16 +1,17 @@
 import os
 
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 
 import pytz
-from PIL import Image, ImageDraw, ImageFont, ImageChops
+from PIL import Image, ImageDraw, ImageFont
 
 from model.open import WeatherGenericData
-from model.weather import WeatherModel, WeatherInsideModel, WeatherOutsideModel, DEFAULT_NONE_TEMPERATURE
+from model.weather import WeatherModel, DEFAULT_NONE_TEMPERATURE
 from ui.icon_mapping import IconMappingLookup
 from ui.render_result import RenderResult
 from widget.alignments import Alignments
+from widget.line import LineWidget
 from widget.panel import PanelWidget
 from widget.text import TextWidget
 from ui.weather_icon_lookup import WeatherIconLookup
@@ -57,127 +58,156 @@ class Desktop:
         # https://gist.github.com/tbranyen/62d974681dea8ee0caa1
         self.icon_mapping = IconMappingLookup(os.path.join(resource_dir, 'icons-mapping.json'))
 
-        # self.window = PanelWidget(800, 600)
-
-    @staticmethod
-    def band(bb: Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
-        """Stretch a bounding box's X coordinates to be divisible by 8,
-           otherwise weird artifacts occur as some bits are skipped."""
-        return (int(bb[0] / 8) * 8, bb[1], int((bb[2] + 7) / 8) * 8, bb[3]) if bb else None
-
-    @staticmethod
-    def img_diff(img1: Image, img2: Image) -> Optional[Tuple[int, int, int, int]]:
-        """Return the bounding box of differences between two images"""
-        return ImageChops.difference(img1, img2).getbbox()
-
+        # retained widget tree of the modern layout, the canvas it is drawn on and the
+        # (data, generic data) it was built for
+        self.window: Optional[PanelWidget] = None
+        self.canvas: Optional[Image.Image] = None
+        self.layout: Optional[Tuple[bool, bool]] = None
+        self.fields: Dict[str, TextWidget] = {}
 
     def render_modern(self, data: Optional[WeatherModel], gen_data: Optional[WeatherGenericData]) -> RenderResult:
-        image = Image.new('L', (800, 600), 255)
-        draw = ImageDraw.Draw(image)
-        result = RenderResult(image)
+        """Render the modern layout. Its widget tree is kept between the calls, only the texts
+        that changed are repainted and the result has the rectangles that changed since the
+        previous call - the whole screen when the layout changed."""
+        layout = (data is not None, bool(gen_data))
+        if layout != self.layout:
+            self.layout = layout
+            self.canvas = Image.new('L', (800, 600), 255)
+            self.window = self.build_modern(data is not None, bool(gen_data))
+            damage = [(0, 0, 800, 600)]
+        else:
+            damage = None
+        for name, text in self.modern_texts(data, gen_data).items():
+            self.fields[name].text = text
+        repainted = self.window.repaint(self.canvas)
+
+        # the display worker may still use the previous image
+        result = RenderResult(self.canvas.copy())
+        for bb in damage or repainted:
+            result.add_bounding_box(bb)
+        return result
+
+    def build_modern(self, with_data: bool, with_gen_data: bool) -> PanelWidget:
+        """The widget tree of the modern layout, the texts that depend on the data are in
+        self.fields"""
+        self.fields = {}
+        main_panel: PanelWidget = PanelWidget(800,600)
 
         # ------
-        draw.line((20, 300, 780, 300), fill=0, width=3)
+        main_panel.add_child(self.render_line(20, 299, 761, 3))
         # |
-        draw.line((400, 20, 400, 290), fill=0, width=3)
+        main_panel.add_child(self.render_line(399, 20, 3, 271))
         # |
-        draw.line((400, 310, 400, 580), fill=0, width=3)
-
-        main_panel: PanelWidget = PanelWidget(800,600)
+        main_panel.add_child(self.render_line(399, 310, 3, 271))
 
-        if data is None:
-            pass
-        else:
-            indoor_panel: PanelWidget = self.render_indoor(data.inside)
+        if with_data:
+            indoor_panel: PanelWidget = self.render_indoor()
             indoor_panel.left = 0
             indoor_panel.top = 0
             main_panel.add_child(indoor_panel)
 
-            outdoor_panel: PanelWidget = self.render_outdoor(data.outside)
+            outdoor_panel: PanelWidget = self.render_outdoor()
             outdoor_panel.left = 400
             outdoor_panel.top = 300
             main_panel.add_child(outdoor_panel)
 
-        if gen_data:
-            gen_data_panel: PanelWidget = self.render_generic_data(gen_data)
+        if with_gen_data:
+            gen_data_panel: PanelWidget = self.render_generic_data()
             gen_data_panel.left = 0
             gen_data_panel.top = 300
             main_panel.add_child(gen_data_panel)
 
         # time
-        today: datetime = datetime.today()
-
         clock_text: TextWidget = TextWidget(400, 150, font=self.font_huge)
         clock_text.left = 400
         clock_text.top = 80
-        clock_text.text = today.strftime("%k:%M")
+        self.fields['clock'] = clock_text
         main_panel.add_child(clock_text)
 
         date_text: TextWidget = TextWidget(400, 50, font=self.font_medium)
         date_text.left = 400
         date_text.top = 40
         date_text.horizontal_alignment = Alignments.CENTER
-        date_text.text = today.strftime("%-d %B %Y")
+        self.fields['date'] = date_text
         main_panel.add_child(date_text)
 
         weekday_text: TextWidget = TextWidget(400, 50, font=self.font_medium)
         weekday_text.left = 400
         weekday_text.top = 220
         weekday_text.horizontal_alignment = Alignments.CENTER
-        weekday_text.text = today.strftime("%A")
+        self.fields['weekday'] = weekday_text
         main_panel.add_child(weekday_text)
 
         main_panel.is_children_draw_border(False)
-        main_panel.draw(draw)
+        return main_panel
 
-        result.add_bounding_box((0,0,400,300))
-        result.add_bounding_box((0,300,400,600))
-        result.add_bounding_box((400,0,800,300))
-        result.add_bounding_box((400,300,800,600))
+    def modern_texts(self, data: Optional[WeatherModel], gen_data: Optional[WeatherGenericData]) -> Dict[str, str]:
+        """Name of a text widget of the modern layout -> its text"""
+        today: datetime = datetime.today()
+        texts = {
+            'clock': today.strftime("%k:%M"),
+            'date': today.strftime("%-d %B %Y"),
+            'weekday': today.strftime("%A"),
+        }
+        if data is not None:
+            for name, temperature in (('indoor_temp', data.inside.temperature),
+                                      ('outdoor_temp', data.outside.temperature)):
+                degree_val, subdegree_val = convert_float(temperature, DEFAULT_NONE_TEMPERATURE).split(".")
+                texts[name] = degree_val
+                texts[name + '_decimals'] = "." + subdegree_val
+            texts['indoor_humidity'] = "%s%%" % data.inside.humidity
+            texts['outdoor_humidity'] = "%s%%" % data.outside.humidity
+            texts['indoor_co2'] = str(data.inside.co2)
+        if gen_data:
+            is_day: bool = gen_data.sunrise.astimezone(pytz.utc) < today.astimezone(pytz.utc) < gen_data.sunset.astimezone(pytz.utc)
+            for name, code in (('weather', gen_data.weather_code), ('forecast_1', gen_data.forecast_code_1),
+                               ('forecast_2', gen_data.forecast_code_2), ('forecast_3', gen_data.forecast_code_3)):
+                texts[name] = self.icon_lookup.look_up_with_name(self.icon_mapping.lookup_icon(code, is_day))
+        return texts
 
-        return result
+    @staticmethod
+    def render_line(left: int, top: int, width: int, height: int) -> LineWidget:
+        line: LineWidget = LineWidget(width, height)
+        line.left = left
+        line.top = top
+        return line
 
-    def render_outdoor(self, outdoor_data: WeatherOutsideModel) -> PanelWidget:
+    def render_outdoor(self) -> PanelWidget:
         p: PanelWidget = PanelWidget(400, 300)
 
-        temp_orig: float = outdoor_data.temperature
-        temp_val: str = convert_float(temp_orig, DEFAULT_NONE_TEMPERATURE)
-
-        temp_panel: PanelWidget = self.render_temp(temp_val)
+        temp_panel: PanelWidget = self.render_temp('outdoor_temp')
         temp_panel.left = 80
         temp_panel.top = 100
         p.add_child(temp_panel)
 
-        humidity_panel: PanelWidget = self.render_humidity(str(outdoor_data.humidity))
+        humidity_panel: PanelWidget = self.render_humidity('outdoor_humidity')
         humidity_panel.top = 40
         humidity_panel.left = 190
         p.add_child(humidity_panel)
 
         return p
 
-    def render_indoor(self, indoor_data: WeatherInsideModel) -> PanelWidget:
+    def render_indoor(self) -> PanelWidget:
         p: PanelWidget = PanelWidget(400, 300)
 
-        temp_in: str = convert_float(indoor_data.temperature, DEFAULT_NONE_TEMPERATURE)
-
-        temp_panel: PanelWidget = self.render_temp(temp_in)
+        temp_panel: PanelWidget = self.render_temp('indoor_temp')
         temp_panel.left = 80
         temp_panel.top = 100
         p.add_child(temp_panel)
 
-        co2_panel: PanelWidget = self.render_co2(str(indoor_data.co2))
+        co2_panel: PanelWidget = self.render_co2('indoor_co2')
         co2_panel.top = temp_panel.top + temp_panel.height + 10
         co2_panel.left = 60
         p.add_child(co2_panel)
 
-        humidity_panel: PanelWidget = self.render_humidity(str(indoor_data.humidity))
+        humidity_panel: PanelWidget = self.render_humidity('indoor_humidity')
         humidity_panel.top = 40
         humidity_panel.left = 190
         p.add_child(humidity_panel)
 
         return p
 
-    def render_humidity(self, value: str) -> PanelWidget:
+    def render_humidity(self, name: str) -> PanelWidget:
         p: PanelWidget = PanelWidget(150, 40)
 
         t5: TextWidget = TextWidget(40,40, font=self.font_weather_medium)
@@ -189,15 +219,15 @@ class Desktop:
 
         t4: TextWidget = TextWidget(90,40, font=self.font_medium)
         t4.horizontal_alignment = Alignments.RIGHT
-        t4.text = "%s%%" % value
         t4.left = t5.left + t5.width
         t4.top = 0
+        self.fields[name] = t4
         p.add_child(t4)
 
 
         return p
 
-    def render_co2(self, value: str) -> PanelWidget:
+    def render_co2(self, name: str) -> PanelWidget:
         p: PanelWidget = PanelWidget(200, 40)
 
         t1: TextWidget = TextWidget(30,30, font=self.font_weather_medium)
@@ -208,9 +238,9 @@ class Desktop:
 
         t2: TextWidget = TextWidget(100,30, font=self.font_medium)
         t2.horizontal_alignment = Alignments.RIGHT
-        t2.text = value
         t2.left = t1.left + t1.width
         t2.top = 0
+        self.fields[name] = t2
         p.add_child(t2)
 
         t3: TextWidget = TextWidget(50,30, font=self.font_small)
@@ -222,57 +252,31 @@ class Desktop:
         p.add_child(t3)
         return p
 
-    def render_generic_data(self, gen_data):
+    def render_generic_data(self):
         p: PanelWidget = PanelWidget(400, 300)
 
-        today: datetime = datetime.today()
-        is_day: bool = gen_data.sunrise.astimezone(pytz.utc) < today.astimezone(pytz.utc) < gen_data.sunset.astimezone(pytz.utc)
-        icon: str = self.icon_mapping.lookup_icon(gen_data.weather_code, is_day)
-
         m: TextWidget = TextWidget(240,240, self.font_weather_huge)
         m.left = 10
         m.top = 50
         m.horizontal_alignment = Alignments.CENTER
         m.vertical_alignment = Alignments.CENTER
-        m.text = self.icon_lookup.look_up_with_name(icon)
+        self.fields['weather'] = m
         p.add_child(m)
 
-        f1_icon: str = self.icon_mapping.lookup_icon(gen_data.forecast_code_1, is_day)
-        f1: TextWidget = TextWidget(70,70, self.font_weather_large)
-        f1.left = 120
-        f1.top = 20
-        f1.horizontal_alignment = Alignments.CENTER
-        f1.vertical_alignment = Alignments.CENTER
-        f1.text = self.icon_lookup.look_up_with_name(f1_icon)
-        p.add_child(f1)
-
-        f2_icon: str = self.icon_mapping.lookup_icon(gen_data.forecast_code_2, is_day)
-        f2: TextWidget = TextWidget(70,70, self.font_weather_large)
-        f2.left = 190
-        f2.top = 20
-        f2.horizontal_alignment = Alignments.CENTER
-        f2.vertical_alignment = Alignments.CENTER
-        f2.text = self.icon_lookup.look_up_with_name(f2_icon)
-        p.add_child(f2)
-
-        f3_icon: str = self.icon_mapping.lookup_icon(gen_data.forecast_code_3, is_day)
-        f3: TextWidget = TextWidget(70,70, self.font_weather_large)
-        f3.left = 260
-        f3.top = 20
-        f3.horizontal_alignment = Alignments.CENTER
-        f3.vertical_alignment = Alignments.CENTER
-        f3.text = self.icon_lookup.look_up_with_name(f3_icon)
-        p.add_child(f3)
+        for index, left in ((1, 120), (2, 190), (3, 260)):
+            forecast: TextWidget = TextWidget(70,70, self.font_weather_large)
+            forecast.left = left
+            forecast.top = 20
+            forecast.horizontal_alignment = Alignments.CENTER
+            forecast.vertical_alignment = Alignments.CENTER
+            self.fields['forecast_%d' % index] = forecast
+            p.add_child(forecast)
 
         return p
 
-    def render_temp(self, value: str) -> PanelWidget:
+    def render_temp(self, name: str) -> PanelWidget:
         p: PanelWidget = PanelWidget(280, 130)
 
-        split = value.split(".")
-        degree_val = split[0]
-        subdegree_val = split[1]
-
         m: TextWidget = TextWidget(50,80, self.font_weather_large)
         m.left = 0
         m.top = 0
@@ -286,7 +290,7 @@ class Desktop:
         temp2.top = 5
         temp2.horizontal_alignment = Alignments.LEFT
         temp2.vertical_alignment = Alignments.TOP
-        temp2.text = "." + subdegree_val
+        self.fields[name + '_decimals'] = temp2
         p.add_child(temp2)
 
         temp_text: TextWidget = TextWidget(190, 120, font=self.font_huge)
@@ -294,7 +298,7 @@ class Desktop:
         temp_text.top = 5
         temp_text.horizontal_alignment = Alignments.RIGHT
         temp_text.vertical_alignment = Alignments.TOP
-        temp_text.text = degree_val
+        self.fields[name] = temp_text
         p.add_child(temp_text)
 
         degree_char: TextWidget = TextWidget(90, 40, font=self.font_weather_large)
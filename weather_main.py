@@ -11,14 +11,17 @@ from model.weather import NetatmoDataLoader, WeatherModel, WeatherOutsideModel,
 from schedule import configure_signals, ProgramKilled
 import click
 import sys
-from infra.driver_manager import DriverManager
+from drivers.profiler import DriverProfiler
+from infra.display_worker import DisplayWorker
+from infra.driver_manager import get_driver_manager
+from infra.refresh_ledger import RefreshLedger
+from infra.update_planner import UpdatePlanner
 from PIL import Image
 
 from ui.desktop import Desktop
-from ui.render_result import RenderResult, BoundingBox
+from ui.render_result import RenderResult
 
 REDRAW_INTERVAL_SECONDS:int = 30
-REDRAW_PARTIAL_NUMBER:int = 5
 
 locale.setlocale(locale.LC_ALL, 'cs_CZ.UTF-8')
 
@@ -31,10 +34,23 @@ class WeatherClientMain:
     black = None
     encoding = None
 
-    def __init__(self, driver, partial=None, encoding='utf-8'):
+    def __init__(self, driver, partial=None, encoding='utf-8', pipelined=False, state_file=None, frame_log=None,
+                 simulate=False, simulate_controller=None, profile=False):
         """Create a PaperTTY with the chosen driver and settings"""
-        manager = DriverManager()
-        self.driver = manager.get_drivers()[driver]['class']()
+        self.driver = get_driver_manager().get_driver_class(driver)()
+        if pipelined and hasattr(self.driver, 'pipelined'):
+            self.driver.pipelined = True
+        if state_file and hasattr(self.driver, 'state_file'):
+            self.driver.state_file = state_file
+        if frame_log and hasattr(self.driver, 'log_file'):
+            self.driver.log_file = frame_log
+        # SPI and GPIO of the display without the hardware, with the refresh times modelled
+        self.hardware = None
+        if simulate:
+            # imports the hardware drivers it models, so only when needed
+            from drivers import simulated
+            self.hardware = simulated.simulate(self.driver, controller=simulate_controller, time_scale=1.0)
+        self.profiler = DriverProfiler(self.driver).attach() if profile else None
         self.partial = partial
         self.white = self.driver.white
         self.black = self.driver.black
@@ -123,9 +139,13 @@ def main(settings: Settings):
     loader = NetatmoDataLoader()
     owm_loader = OpenWeatherDataLoader()
     desktop = Desktop(settings.resources_dir)
+    # regions and modes that suit the display
+    planner = UpdatePlanner(wcm.driver.capabilities(), wcm.driver.width, wcm.driver.height)
+    # where the display needs a clean refresh
+    ledger = RefreshLedger(wcm.driver.width, wcm.driver.height, wcm.driver.GHOSTING_UPDATES, wcm.driver.GHOSTING_CHANGED)
 
-    updates: int = 0
-    previous_image: Optional[Image] = None
+    # continue with partial updates if the driver knows what is on the display
+    worker = DisplayWorker(wcm.driver, planner, ledger, wcm.driver.restored_frame, wcm.profiler).start()
     logging.info("Starting data loop")
     while True:
         try:
@@ -145,43 +165,16 @@ def main(settings: Settings):
                 gen_data = None
 
             rr: RenderResult = desktop.render_modern(data, gen_data)
-            image = rr.image
-            bbs = rr.bounding_boxes
-
-            if updates == 0:
-                # full redraw
-                updates = (updates + 1) % REDRAW_PARTIAL_NUMBER
-                logging.debug("Full redraw")
-                wcm.driver.draw(0, 0, image)
-            else:
-                change_detected = False
-                logging.debug("Partial redraw")
-                for bb in bbs:
-                    banded_bb = desktop.band(bb)
-                    cropped_image = image.crop(banded_bb)
-                    cropped_previous_image = previous_image.crop(banded_bb)
-
-                    img_diff: BoundingBox = desktop.img_diff(cropped_image, cropped_previous_image)
-
-                    if img_diff:
-                        # there is some difference
-                        change_detected = True
-
-                        diff_bbox: BoundingBox = desktop.band(img_diff)
-                        changed_image_area = cropped_image.crop(diff_bbox)
-                        x = banded_bb[0] + diff_bbox[0]
-                        y = banded_bb[1] + diff_bbox[1]
-                        wcm.driver.draw(x, y, changed_image_area)
-
-                if change_detected:
-                    # increment update counter
-                    updates = (updates + 1) % REDRAW_PARTIAL_NUMBER
-
-            previous_image = image.copy()
+            # drawn while the next frame is loaded and rendered
+            worker.submit(rr.image, rr.bounding_boxes)
             logging.debug("Iteration finished")
             time.sleep(REDRAW_INTERVAL_SECONDS)
         except ProgramKilled:
             logging.info("Weather main killed")
+            worker.stop()
+            wcm.driver.flush()
+            if wcm.profiler:
+                logging.info("Display profile: %s", wcm.profiler.format(wcm.profiler.summary()))
             break
 
 
@@ -194,27 +187,52 @@ def print_bitmap(settings, file):
     wcm.init_display()
     image = Image.open(file)
     wcm.driver.draw(0,0,image)
+    wcm.driver.flush()
     WeatherClientMain.error(file, code=0)
 
 
 @click.command(name='list')
 def list_drivers():
     """List available display drivers"""
-    manager = DriverManager()
+    manager = get_driver_manager()
     WeatherClientMain.error(manager.get_driver_list(), code=0)
 
 
+def parse_settings(settings: Optional[str]) -> Optional[dict]:
+    """NAME=VALUE,... to a dict, the values that are numbers (0x... too) become numbers"""
+    if not settings:
+        return None
+    parsed = {}
+    for setting in settings.split(','):
+        name, _, value = setting.partition('=')
+        for convert in (lambda v: int(v, 0), float):
+            try:
+                value = convert(value)
+                break
+            except ValueError:
+                pass
+        parsed[name.strip()] = value
+    return parsed
+
+
 @click.group()
 @click.option('--driver', default=None, help='Select display driver')
 @click.option('--nopartial', is_flag=True, default=False, help="Don't use partial updates even if display supports it")
 @click.option('--encoding', default='utf-8', help='Encoding to use for the buffer', show_default=True)
+@click.option('--pipelined', is_flag=True, default=False, help="Overlap loading of regions with display refreshes (IT8951)")
+@click.option('--state-file', default=None, help="Save the display state to this file on exit to skip the initialization on restart (IT8951)")
+@click.option('--frame-log', default=None, help="Append a JSON line with the regions and timings of every frame to this file (Bitmap)")
+@click.option('--simulate', is_flag=True, default=False, help="Run the driver on simulated display hardware")
+@click.option('--simulate-controller', default=None, help="Settings of the simulated controller as NAME=VALUE,... e.g. width=1872,height=1404,vcom=2000 (IT8951)")
+@click.option('--profile', is_flag=True, default=False, help="Log where the time of every frame goes: Python, SPI, waiting")
 @click.option('--debug', is_flag=True, default=False, help="Enable debug logging")
 @click.pass_context
-def cli(ctx, driver, nopartial, encoding, debug):
+def cli(ctx, driver, nopartial, encoding, pipelined, state_file, frame_log, simulate, simulate_controller, profile,
+        debug):
     """CLI configuration"""
     if debug:
         logging.getLogger().setLevel(logging.DEBUG)
-    manager = DriverManager()
+    manager = get_driver_manager()
     if not driver:
         WeatherClientMain.error(
             "You must choose a display driver. If your 'C' variant is not listed, use the 'B' driver.\n\n{}".format(
@@ -228,7 +246,13 @@ def cli(ctx, driver, nopartial, encoding, debug):
 
     s = Settings(driver=matched_drivers[0],
                    partial=not nopartial,
-                   encoding=encoding)
+                   encoding=encoding,
+                   pipelined=pipelined,
+                   state_file=state_file,
+                   frame_log=frame_log,
+                   simulate=simulate,
+                   simulate_controller=parse_settings(simulate_controller),
+                   profile=profile)
     s.project_dir=project_dir
     s.output_dir=os.path.join(project_dir, "output")
     s.resources_dir=os.path.join(project_dir, "resources")
@@ -0,0 +1,22 @@
+from PIL import ImageDraw
+
+from widget.widget_base import WidgetBase
+
+
+class LineWidget(WidgetBase):
+    """A horizontal or vertical line through the middle of the widget, as thick as the
+    widget is high (wide for a vertical one)"""
+
+    def __init__(self, width: int, height: int):
+        super().__init__(width, height)
+
+    def draw(self, draw: ImageDraw):
+        super().draw(draw)
+        if self.width >= self.height:
+            middle = self.abs_top + self.height // 2
+            draw.line((self.abs_left, middle, self.abs_left + self.width - 1, middle),
+                      fill=self.foreground, width=self.height)
+        else:
+            middle = self.abs_left + self.width // 2
+            draw.line((middle, self.abs_top, middle, self.abs_top + self.height - 1),
+                      fill=self.foreground, width=self.width)
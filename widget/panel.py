@@ -12,3 +12,9 @@ class PanelWidget(WidgetBase):
         for child in self._children:
             child.draw(draw)
 
+    def draw_within(self, draw: ImageDraw, box):
+        if self.overlaps(box):
+            super().draw(draw)
+            for child in self._children:
+                child.draw_within(draw, box)
+
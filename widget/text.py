@@ -18,7 +18,9 @@ class TextWidget(WidgetBase):
 
     @text.setter
     def text(self, text: str):
-        self._text = text
+        if text != self._text:
+            self._text = text
+            self.invalidate()
 
     @property
     def vertical_alignment(self):
@@ -26,7 +28,9 @@ class TextWidget(WidgetBase):
 
     @vertical_alignment.setter
     def vertical_alignment(self, vertical_alignment):
-        self._vertical_align = vertical_alignment
+        if vertical_alignment != self._vertical_align:
+            self._vertical_align = vertical_alignment
+            self.invalidate()
 
     @property
     def horizontal_alignment(self):
@@ -34,7 +38,9 @@ class TextWidget(WidgetBase):
 
     @horizontal_alignment.setter
     def horizontal_alignment(self, horizontal_alignment):
-        self._horizontal_align = horizontal_alignment
+        if horizontal_alignment != self._horizontal_align:
+            self._horizontal_align = horizontal_alignment
+            self.invalidate()
 
     def draw(self, draw: ImageDraw):
         super().draw(draw)
@@ -1,4 +1,8 @@
-from PIL import ImageDraw
+from typing import List, Tuple
+
+from PIL import Image, ImageChops, ImageDraw
+
+Box = Tuple[int, int, int, int]
 
 
 class WidgetBase:
@@ -14,6 +18,8 @@ class WidgetBase:
         self._children_draw_border = False
         self._background = 255
         self._foreground = 0
+        # the widget has to be repainted, see repaint
+        self._dirty = True
 
     @property
     def height(self):
@@ -67,7 +73,9 @@ class WidgetBase:
 
     @background.setter
     def background(self, background):
-        self._background = background
+        if background != self._background:
+            self._background = background
+            self.invalidate()
 
     @property
     def foreground(self):
@@ -75,10 +83,26 @@ class WidgetBase:
 
     @foreground.setter
     def foreground(self, foreground):
-        self._foreground = foreground
+        if foreground != self._foreground:
+            self._foreground = foreground
+            self.invalidate()
+
+    @property
+    def box(self) -> Box:
+        return self.abs_left, self.abs_top, self.abs_left + self.width, self.abs_top + self.height
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def invalidate(self):
+        """Repaint the widget with the next repaint"""
+        self._dirty = True
 
     def is_draw_border(self, draw_border: bool):
-        self._draw_border = draw_border
+        if draw_border != self._draw_border:
+            self._draw_border = draw_border
+            self.invalidate()
 
     def is_children_draw_border(self, children_draw_border: bool = False):
         for child in self._children:
@@ -92,7 +116,53 @@ class WidgetBase:
                             self.abs_top + self.height - 1),
                            outline=self.foreground, fill=self.background)
 
+    def draw_within(self, draw: ImageDraw, box: Box):
+        """Draw the widgets of the tree that overlap the box"""
+        if self.overlaps(box):
+            self.draw(draw)
+
+    def overlaps(self, box: Box) -> bool:
+        left, top, right, bottom = self.box
+        return left < box[2] and box[0] < right and top < box[3] and box[1] < bottom
+
+    def dirty_boxes(self) -> List[Box]:
+        """The boxes of the dirty widgets, the children of a dirty widget are part of its box"""
+        if self._dirty:
+            return [self.box]
+        return [box for child in self._children for box in child.dirty_boxes()]
+
+    def clean(self):
+        self._dirty = False
+        for child in self._children:
+            child.clean()
+
+    def repaint(self, image: Image) -> List[Box]:
+        """Repaint the dirty widgets on the image the tree is drawn on - this widget is its
+        background - and return the rectangles where pixels changed. A dirty box is painted
+        from scratch with every widget that overlaps it, the rest of the image stays."""
+        damage = []
+        abs_left, abs_top = self.abs_left, self.abs_top
+        for box in self.dirty_boxes():
+            left, top = max(box[0], 0), max(box[1], 0)
+            right, bottom = min(box[2], image.width), min(box[3], image.height)
+            if left >= right or top >= bottom:
+                continue
+            scratch = Image.new(image.mode, (right - left, bottom - top), self.background)
+            # draw the tree shifted so that the box starts at the origin of the scratch image
+            self.abs_left, self.abs_top = abs_left - left, abs_top - top
+            try:
+                self.draw_within(ImageDraw.Draw(scratch), (0, 0, scratch.width, scratch.height))
+            finally:
+                self.abs_left, self.abs_top = abs_left, abs_top
+            changed = ImageChops.difference(scratch, image.crop((left, top, right, bottom))).getbbox()
+            if changed:
+                image.paste(scratch.crop(changed), (left + changed[0], top + changed[1]))
+                damage.append((left + changed[0], top + changed[1], left + changed[2], top + changed[3]))
+        self.clean()
+        return damage
+
     def add_child(self, child):
         self._children.append(child)
         child.abs_left = self.abs_left + child.left
         child.abs_top = self.abs_top + child.top
+        self.invalidate()